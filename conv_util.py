@@ -23,8 +23,8 @@ def conv_layer(net, num_filters, filter_size, strides, with_bias = True, elu=Tru
     :param with_bias: If true, add bias to conv layers. The default is not having bias in conv and deconv layers.
     :param elu: whether we apply elu after convolution and normalization.
     :param mirror_padding: If true it uses mirror padding. Otherwise it uses zero padding.
-    :param one_hot_style_vector: The 1d tensor representing which style is currently being trained. It is used with
-    instance norm.
+    :param one_hot_style_vector: The tensor with shape (1, num_styles) representing which style is currently being
+    trained, or with shape (batch_size, num_styles) representing one style per sample. It is used with instance norm.
     :param norm: The normalization applied after convolution. If left blank then no normalization is done.
     :param name: The name for the conv layer.
     :param reuse: If true, it tries to reuse the variable previously defined by the same network with the same name.
@@ -137,8 +137,10 @@ def instance_norm(net, name='', one_hot_style_vector=None, reuse=False):
         scale_init = tf.ones(var_shape)
         scale = tf.get_variable('scale', initializer=scale_init)
         if one_hot_style_vector is not None:
-            shift = tf.matmul(one_hot_style_vector, shift)
-            scale = tf.matmul(one_hot_style_vector, scale)
+            # The style vector has shape (1, num_styles) for the whole batch or (batch_size, num_styles) for one style
+            # (or blend of styles) per sample. Either way the scale and shift broadcast against the layer.
+            shift = tf.reshape(tf.matmul(one_hot_style_vector, shift), [-1, 1, 1, channels])
+            scale = tf.reshape(tf.matmul(one_hot_style_vector, scale), [-1, 1, 1, channels])
         epsilon = 1e-3
         normalized = (net - mu) / (sigma_sq + epsilon) ** (.5)
         return scale * normalized + shift
@@ -28,6 +28,22 @@ class ConvUtilTest(tf.test.TestCase):
             expected_output = np.array([[[[33], [36], [39]], [[42], [45], [48]], [[51], [54], [57]]]])
             self.assertAllEqual(mirror_padded_convoluted_input_layer.eval(feeddict), expected_output)
 
+    def test_instance_norm_per_sample_style(self):
+        with self.test_session() as sess:
+            num_styles = 3
+            net_init = np.random.rand(2, 4, 5, 6).astype(np.float32)
+            styles_init = np.array([[1, 0, 0], [0, 0.5, 0.5]], dtype=np.float32)
+            net = tf.placeholder(tf.float32, shape=(2, 4, 5, 6))
+            styles = tf.placeholder(tf.float32, shape=(None, num_styles))
+            output = instance_norm(net, one_hot_style_vector=styles)
+            with tf.variable_scope('instance_norm', reuse=True):
+                sess.run([tf.get_variable('scale').assign(np.random.rand(num_styles, 6).astype(np.float32)),
+                          tf.get_variable('shift').assign(np.random.rand(num_styles, 6).astype(np.float32))])
+            actual_output = output.eval(feed_dict={net: net_init, styles: styles_init})
+            for i in range(2):
+                expected_output = output.eval(feed_dict={net: net_init, styles: styles_init[i:i + 1]})[i]
+                np.testing.assert_allclose(actual_output[i], expected_output, rtol=1e-5)
+
 
 if __name__ == '__main__':
     tf.test.main()
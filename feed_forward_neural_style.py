@@ -38,6 +38,7 @@ VGG_PATH = 'imagenet-vgg-verydeep-19.mat'
 PRINT_ITERATIONS = 100
 CHECKPOINT_ITERATIONS = 100
 MASK_FOLDER = 'random_masks/'
+STYLE_FEATURES_CACHE_DIR = 'style_features_cache/'
 SEMANTIC_MASKS_WEIGHT = 1.0
 SEMANTIC_MASKS_NUM_LAYERS = 1
 
@@ -183,6 +184,16 @@ def build_parser():
                              'The overall setting and structure must be the same.',
                         action='store_true')
     parser.set_defaults(do_restore_and_train=False)
+    parser.add_argument('--batch_vgg_passes', dest='batch_vgg_passes',
+                        help='If set, the generated images and the content images are passed through the vgg network '
+                             'as one batch instead of two separate passes. (default %(default)s).',
+                        action='store_true')
+    parser.set_defaults(batch_vgg_passes=False)
+    parser.add_argument('--style_features_cache_dir', dest='style_features_cache_dir',
+                        help='The directory to cache the precomputed style features in. Restarting the training with '
+                             'the same style images then skips computing them again. Set it to an empty string to '
+                             'disable the cache. (default %(default)s).',
+                        metavar='STYLE_FEATURES_CACHE_DIR', default=STYLE_FEATURES_CACHE_DIR)
     return parser
 
 
@@ -292,7 +303,9 @@ def main():
                                                         test_img_dir=options.test_img,
                                                         one_hot_vector_for_restore_and_generate=one_hot_vector_for_restore_and_generate,
                                                         content_img_style_weight_mask=content_img_style_weight_mask,
-                                                        style_weight_mask_for_training=style_weight_mask_for_training):
+                                                        style_weight_mask_for_training=style_weight_mask_for_training,
+                                                        batch_vgg_passes=options.batch_vgg_passes,
+                                                        style_features_cache_dir=options.style_features_cache_dir or None):
         if options.do_restore_and_generate:
             imsave(options.output, image)
         else:
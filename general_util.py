@@ -2,6 +2,7 @@
 This file contains utility functions for general purposes like image reading, saving, and resizing. No function here
 contains tensorflow or neural network.
 """
+import hashlib
 import math
 import os
 import urllib
@@ -10,8 +11,9 @@ from os.path import basename, dirname
 
 import numpy as np
 import scipy.misc
+import scipy.ndimage
 from PIL import Image
-from typing import Union, List
+from typing import Union, List, Dict
 
 
 def imread(path, shape=None, bw=False, rgba=False, dtype=np.float32):
@@ -216,6 +218,26 @@ def get_np_array_num_elements(arr):
     return reduce(mul, arr.shape, 1)
 
 
+def np_resize_image(image, height, width):
+    # type: (np.ndarray, int, int) -> np.ndarray
+    """
+    Bilinearly resizes a numpy-represented image without converting it to uint8 first, so it also works on masks and
+    float images.
+    :param image: Numpy represented image with shape (height, width, num_features) or with shape
+    (batch, height, width, num_features)
+    :param height: height of the outputted image.
+    :param width: width of the outputted image.
+    :return: Numpy represented image with the same rank and dtype as the input, resized to height and width.
+    """
+    if image.ndim == 3:
+        zoom = (float(height) / image.shape[0], float(width) / image.shape[1], 1)
+    elif image.ndim == 4:
+        zoom = (1, float(height) / image.shape[1], float(width) / image.shape[2], 1)
+    else:
+        raise AssertionError('The image must have rank 3 or 4. It now has shape %s' % str(image.shape))
+    return scipy.ndimage.zoom(image, zoom, order=1)
+
+
 def np_image_dot_mask(image, mask):
     # type: (np.ndarray, np.ndarray) -> np.ndarray
     """
@@ -371,5 +393,64 @@ def np_total_variation(image_batch):
                      np.linalg.norm(vertical_diff) / horizontal_diff_num_elements)
     return total_var
 
+
+def get_np_arrays_digest(*args):
+    # type: (*Union[np.ndarray,str,int,float,bool,tuple,list,None]) -> str
+    """
+    :param args: numpy arrays or simple python values (strings, numbers, booleans, tuples and lists of them).
+    :return: A sha1 hex digest that changes whenever any of the arrays' content, shape or dtype or any of the values
+    changes.
+    """
+    sha1 = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            sha1.update(('%s%s' % (str(arg.dtype), str(arg.shape))).encode('utf-8'))
+            sha1.update(np.ascontiguousarray(arg).tobytes())
+        else:
+            sha1.update(repr(arg).encode('utf-8'))
+        # Separator so that ('ab', 'c') and ('a', 'bc') give different digests.
+        sha1.update(b'|')
+    return sha1.hexdigest()
+
+
+def load_np_arrays_from_cache(cache_dir, key, names):
+    # type: (str, str, List[str]) -> Union[None,Dict[str,np.ndarray]]
+    """
+    :param cache_dir: The directory containing the cache.
+    :param key: The key of the cache entry, usually obtained from get_np_arrays_digest.
+    :param names: The names of the arrays to load.
+    :return: A dictionary with key = name and value = the cached numpy array, or None if any of them is not cached.
+    """
+    paths = [os.path.join(cache_dir, key, name + '.npy') for name in names]
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    return {name: np.load(path) for name, path in zip(names, paths)}
+
+
+def save_np_arrays_to_cache(cache_dir, key, arrays):
+    # type: (str, str, Dict[str,np.ndarray]) -> None
+    """
+    Save each array as "cache_dir/key/name.npy". Every file is written to a temporary file first and then renamed, so
+    other processes reading the same cache never see a partially written array.
+    :param cache_dir: The directory containing the cache.
+    :param key: The key of the cache entry, usually obtained from get_np_arrays_digest.
+    :param arrays: A dictionary with key = name and value = numpy array.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.exists(entry_dir):
+        try:
+            os.makedirs(entry_dir)
+        except OSError:
+            # Another process may have created it in the meantime.
+            if not os.path.isdir(entry_dir):
+                raise
+    for name, array in arrays.items():
+        path = os.path.join(entry_dir, name + '.npy')
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.rename(tmp_path, path)
+
+
 def rgb2gray(rgb):
     return np.dot(rgb[..., :3], [0.299, 0.587, 0.114])
\ No newline at end of file
@@ -208,6 +208,34 @@ class TestDataUtilMethods(unittest.TestCase):
         expected_output = [9, 0, 1]
         self.assertItemsEqual(actual_output, expected_output)
 
+    def test_get_np_arrays_digest(self):
+        array = np.arange(6, dtype=np.float32)
+        digest = get_np_arrays_digest(array, ('relu1_1',), True)
+        self.assertEqual(digest, get_np_arrays_digest(np.arange(6, dtype=np.float32), ('relu1_1',), True))
+        self.assertNotEqual(digest, get_np_arrays_digest(array.reshape((2, 3)), ('relu1_1',), True))
+        self.assertNotEqual(digest, get_np_arrays_digest(array, ('relu1_1',), False))
+        self.assertNotEqual(digest, get_np_arrays_digest(array + 1, ('relu1_1',), True))
+
+    def test_np_arrays_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        arrays = {'relu1_1': np.ones((2, 2)), 'relu2_1': np.zeros((3, 3))}
+        self.assertIsNone(load_np_arrays_from_cache(cache_dir, 'key', ['relu1_1', 'relu2_1']))
+        save_np_arrays_to_cache(cache_dir, 'key', arrays)
+        actual_output = load_np_arrays_from_cache(cache_dir, 'key', ['relu1_1', 'relu2_1'])
+        for name in arrays:
+            np.testing.assert_array_equal(arrays[name], actual_output[name])
+        # A missing array means the entry is not cached.
+        self.assertIsNone(load_np_arrays_from_cache(cache_dir, 'key', ['relu1_1', 'relu3_1']))
+        shutil.rmtree(cache_dir)
+
+    def test_np_resize_image(self):
+        image = np.ones((4, 6, 3), dtype=np.float32) * 0.5
+        actual_output = np_resize_image(image, 2, 3)
+        self.assertEqual(actual_output.shape, (2, 3, 3))
+        self.assertEqual(actual_output.dtype, np.float32)
+        np.testing.assert_allclose(actual_output, np.ones((2, 3, 3)) * 0.5)
+        self.assertEqual(np_resize_image(np.ones((2, 4, 6, 1)), 8, 12).shape, (2, 8, 12, 1))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,150 @@
+"""
+This file contains a memory planner for stylize. It estimates the peak memory of a configuration from the sizes of the
+vgg layers (computed from the shapes alone, without building any graph) and picks a mode that fits in a memory budget:
+tiling the output, a lower style image scale, or as a last resort a lower output scale.
+"""
+
+import collections
+
+from typing import Union, Tuple, List
+
+import vgg
+from mrf_util import MRF_BLOCK_SIZE
+from neural_util import get_style_batch_size
+
+BYTES_PER_FLOAT = 4
+# The tile sizes tried by the planner, from the largest to the smallest.
+TILE_SIZES = (1024, 768, 512, 384, 256)
+# The planner halves the style image scale and then the output scale at most this many times.
+MAX_SCALE_HALVINGS = 3
+# The coarse pass before a tiled run stops at this size since smaller images do not carry much structure.
+MIN_COARSE_SIZE = 128
+
+# style_scale: The scale to resize the style images by.
+# output_scale: The scale to resize the output by.
+# tile_size: If not None, the output should be stylized in tiles of this size.
+# pyramid_levels: If tile_size is None, the number of pyramid levels for stylize. Otherwise the output is first
+# stylized as a whole at 1/2^(pyramid_levels-1) of its size, and the upsampled result is the initial image of the tiles.
+# estimated_bytes: The estimated peak memory of the plan.
+StylizePlan = collections.namedtuple('StylizePlan', ['style_scale', 'output_scale', 'tile_size', 'pyramid_levels',
+                                                     'estimated_bytes'])
+
+
+def get_activations_num_elements(shape, required_layers):
+    # type: (Tuple[int,int,int,int], Union[List[str],Tuple[str]]) -> int
+    """
+    :return: The number of elements of all vgg layers built for an input of 'shape'.
+    """
+    layer_sizes = vgg.get_layer_sizes(shape, required_layers=required_layers)
+    return sum(batch_size * height * width * num_features
+               for batch_size, height, width, num_features in layer_sizes.values())
+
+
+def estimate_stylize_memory(shape, style_shapes, style_layers, content_layer, use_mrf=False,
+                            semantic_masks_num_layers=0, mrf_patch_size=3, mrf_block_size=MRF_BLOCK_SIZE):
+    # type: (Tuple[int,int,int,int], List[Tuple[int,int]], Union[List[str],Tuple[str]], str, bool, int, int, Union[None,int]) -> int
+    """
+    Estimates the peak memory of stylize in bytes. The style images are passed through vgg before the graph of the
+    output is built, so the peak is the larger one of the two.
+    :param shape: The shape of the output with format (batch_size, height, width, 3).
+    :param style_shapes: The (height, width) of each style image.
+    :param style_layers: The style layers used in the loss.
+    :param content_layer: The content layer used in the loss.
+    :param use_mrf: Whether the mrf loss is used. Its patch matching dominates the memory for large style images.
+    :param semantic_masks_num_layers: The number of semantic masks, or 0 if semantic masks are not used.
+    :param mrf_patch_size: The patch size of the mrf loss.
+    :param mrf_block_size: The number of style patches the mrf loss matches at a time, or None for all of them.
+    :return: The estimated number of bytes.
+    """
+    batch_size, height, width, num_colors = shape
+    required_layers = (content_layer,) + tuple(style_layers)
+    output_layer_sizes = vgg.get_layer_sizes(shape, required_layers=required_layers)
+
+    # The image variable, its two adam slots and the best image.
+    num_elements = 4 * batch_size * height * width * num_colors
+    # Backpropagation keeps every activation and creates a gradient of the same size.
+    num_elements += 2 * get_activations_num_elements(shape, required_layers)
+    for style_layer in style_layers:
+        _, layer_height, layer_width, num_features = output_layer_sizes[style_layer]
+        num_elements += batch_size * layer_height * layer_width * semantic_masks_num_layers
+        if use_mrf:
+            # The generated patches and their gradient.
+            num_elements += 2 * batch_size * layer_height * layer_width * (mrf_patch_size ** 2) * num_features
+            for style_height, style_width in style_shapes:
+                _, style_layer_height, style_layer_width, _ = vgg.get_layer_sizes(
+                    (1, style_height, style_width, num_colors), required_layers=(style_layer,))[style_layer]
+                num_style_patches = max(0, style_layer_height - mrf_patch_size + 1) * \
+                                    max(0, style_layer_width - mrf_patch_size + 1)
+                # The normalized style patches. The original patches are rebuilt from them and their norms.
+                num_elements += num_style_patches * (mrf_patch_size ** 2) * num_features
+                # The similarity of every generated patch to one block of style patches. The blocks are matched one
+                # after another and the matching has no gradient.
+                num_elements += batch_size * layer_height * layer_width * \
+                                min(num_style_patches, mrf_block_size or num_style_patches)
+        else:
+            num_elements += 2 * batch_size * num_features * num_features
+    # Style images with the same shape are passed through vgg in batches, see neural_util.precompute_images_features.
+    style_shape_counts = collections.Counter(style_shapes)
+    style_num_elements = max(get_activations_num_elements(
+        (get_style_batch_size(style_height, style_width, count), style_height, style_width, num_colors), style_layers)
+                             for (style_height, style_width), count in style_shape_counts.items())
+    return BYTES_PER_FLOAT * max(num_elements, style_num_elements)
+
+
+def plan_stylize(height, width, style_shapes, memory_limit, style_layers, content_layer, use_mrf=False,
+                 semantic_masks_num_layers=0, batch_size=1, can_tile=True):
+    # type: (int, int, List[Tuple[int,int]], int, Union[List[str],Tuple[str]], str, bool, int, int, bool) -> StylizePlan
+    """
+    Picks the mode with the best quality that is estimated to fit in memory_limit. In order of preference: the output as
+    a whole, the output in tiles (only with the gramian loss and no semantic masks, with a coarse whole image pass
+    first), the same with smaller style images, and finally a smaller output. If nothing fits, the smallest plan is
+    returned.
+    :param height: The height of the output.
+    :param width: The width of the output.
+    :param memory_limit: The memory budget in bytes.
+    :param can_tile: Set it to false if the caller cannot stylize in tiles for other reasons, e.g. because it uses a
+    style weight mask.
+    For the other parameters, please refer to estimate_stylize_memory.
+    :return: The chosen StylizePlan. For a tiled plan, estimated_bytes is the larger one of the tile and the coarse pass.
+    """
+    can_tile = can_tile and not use_mrf and semantic_masks_num_layers == 0
+
+    def estimate(output_height, output_width, style_scale):
+        scaled_style_shapes = [(max(1, int(style_height * style_scale)), max(1, int(style_width * style_scale)))
+                               for style_height, style_width in style_shapes]
+        return estimate_stylize_memory((batch_size, output_height, output_width, 3), scaled_style_shapes,
+                                       style_layers, content_layer, use_mrf=use_mrf,
+                                       semantic_masks_num_layers=semantic_masks_num_layers)
+
+    plan = None
+    for style_scale in [0.5 ** i for i in range(MAX_SCALE_HALVINGS + 1)]:
+        estimated_bytes = estimate(height, width, style_scale)
+        plan = StylizePlan(style_scale, 1.0, None, 1, estimated_bytes)
+        if estimated_bytes <= memory_limit:
+            return plan
+        if not can_tile:
+            continue
+        # The coarse pass is done at the largest size that fits. It does not depend on the tile size.
+        pyramid_levels = 2
+        coarse_bytes = estimate(height // 2, width // 2, style_scale)
+        while coarse_bytes > memory_limit and min(height, width) // 2 ** pyramid_levels >= MIN_COARSE_SIZE:
+            pyramid_levels += 1
+            coarse_bytes = estimate(height // 2 ** (pyramid_levels - 1), width // 2 ** (pyramid_levels - 1),
+                                    style_scale)
+        if coarse_bytes > memory_limit:
+            continue
+        for tile_size in TILE_SIZES:
+            if tile_size >= max(height, width):
+                continue
+            estimated_bytes = estimate(min(tile_size, height), min(tile_size, width), style_scale)
+            if estimated_bytes > memory_limit:
+                continue
+            return StylizePlan(style_scale, 1.0, tile_size, pyramid_levels, max(estimated_bytes, coarse_bytes))
+    for output_scale in [0.5 ** i for i in range(1, MAX_SCALE_HALVINGS + 1)]:
+        output_height = max(1, int(height * output_scale))
+        output_width = max(1, int(width * output_scale))
+        estimated_bytes = estimate(output_height, output_width, plan.style_scale)
+        plan = StylizePlan(plan.style_scale, output_scale, None, 1, estimated_bytes)
+        if estimated_bytes <= memory_limit:
+            return plan
+    return plan
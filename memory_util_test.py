@@ -0,0 +1,76 @@
+import unittest
+
+from memory_util import *
+
+STYLE_LAYERS = ('relu1_1', 'relu2_1', 'relu3_1', 'relu4_1', 'relu5_1')
+CONTENT_LAYER = 'relu4_2'
+
+
+class MemoryUtilTest(unittest.TestCase):
+    def test_estimate_stylize_memory(self):
+        small = estimate_stylize_memory((1, 256, 256, 3), [(256, 256)], STYLE_LAYERS, CONTENT_LAYER)
+        large = estimate_stylize_memory((1, 512, 512, 3), [(256, 256)], STYLE_LAYERS, CONTENT_LAYER)
+        batch = estimate_stylize_memory((4, 256, 256, 3), [(256, 256)], STYLE_LAYERS, CONTENT_LAYER)
+        mrf = estimate_stylize_memory((1, 256, 256, 3), [(256, 256)], ('relu3_1', 'relu4_1'), CONTENT_LAYER,
+                                      use_mrf=True)
+        self.assertGreater(small, 0)
+        self.assertGreater(large, 3 * small)
+        self.assertGreater(batch, 3 * small)
+        self.assertGreater(mrf, small)
+
+    def test_estimate_stylize_memory_style_batches(self):
+        # The style pass dominates with a small output. Small style images with the same shape are batched and large
+        # ones are passed one at a time.
+        one_small = estimate_stylize_memory((1, 64, 64, 3), [(256, 256)], STYLE_LAYERS, CONTENT_LAYER)
+        four_small = estimate_stylize_memory((1, 64, 64, 3), [(256, 256)] * 4, STYLE_LAYERS, CONTENT_LAYER)
+        one_large = estimate_stylize_memory((1, 64, 64, 3), [(2048, 2048)], STYLE_LAYERS, CONTENT_LAYER)
+        four_large = estimate_stylize_memory((1, 64, 64, 3), [(2048, 2048)] * 4, STYLE_LAYERS, CONTENT_LAYER)
+        self.assertEqual(four_small, 4 * one_small)
+        self.assertEqual(four_large, one_large)
+
+    def test_plan_stylize(self):
+        style_shapes = [(512, 512)]
+        whole_bytes = estimate_stylize_memory((1, 2048, 2048, 3), style_shapes, STYLE_LAYERS, CONTENT_LAYER)
+        plan = plan_stylize(2048, 2048, style_shapes, whole_bytes, STYLE_LAYERS, CONTENT_LAYER)
+        self.assertEqual(plan, StylizePlan(1.0, 1.0, None, 1, whole_bytes))
+
+        plan = plan_stylize(2048, 2048, style_shapes, whole_bytes // 4, STYLE_LAYERS, CONTENT_LAYER)
+        self.assertIsNotNone(plan.tile_size)
+        self.assertEqual(plan.style_scale, 1.0)
+        self.assertGreaterEqual(plan.pyramid_levels, 2)
+        self.assertLessEqual(plan.estimated_bytes, whole_bytes // 4)
+
+        # Tiling is not supported with mrf, so the style images are scaled down instead.
+        mrf_style_layers = ('relu3_1', 'relu4_1')
+        whole_bytes = estimate_stylize_memory((1, 512, 512, 3), style_shapes, mrf_style_layers, CONTENT_LAYER,
+                                              use_mrf=True)
+        plan = plan_stylize(512, 512, style_shapes, whole_bytes // 2, mrf_style_layers, CONTENT_LAYER, use_mrf=True)
+        self.assertIsNone(plan.tile_size)
+        self.assertLess(plan.style_scale, 1.0)
+
+    def test_plan_stylize_tiled_plan_fits(self):
+        style_shapes = [(512, 512)]
+        whole_bytes = estimate_stylize_memory((1, 2048, 2048, 3), style_shapes, STYLE_LAYERS, CONTENT_LAYER)
+        for divisor in (2, 4, 8, 16, 32, 64):
+            memory_limit = whole_bytes // divisor
+            plan = plan_stylize(2048, 2048, style_shapes, memory_limit, STYLE_LAYERS, CONTENT_LAYER)
+            if plan.tile_size is None:
+                continue
+            # Both the tiles and the coarse pass must fit.
+            coarse_size = 2048 // 2 ** (plan.pyramid_levels - 1)
+            scaled_style_shapes = [(int(512 * plan.style_scale), int(512 * plan.style_scale))]
+            coarse_bytes = estimate_stylize_memory((1, coarse_size, coarse_size, 3), scaled_style_shapes,
+                                                   STYLE_LAYERS, CONTENT_LAYER)
+            self.assertLessEqual(coarse_bytes, plan.estimated_bytes)
+            self.assertLessEqual(plan.estimated_bytes, memory_limit)
+
+    def test_plan_stylize_cannot_tile(self):
+        style_shapes = [(512, 512)]
+        whole_bytes = estimate_stylize_memory((1, 2048, 2048, 3), style_shapes, STYLE_LAYERS, CONTENT_LAYER)
+        plan = plan_stylize(2048, 2048, style_shapes, whole_bytes // 4, STYLE_LAYERS, CONTENT_LAYER, can_tile=False)
+        self.assertIsNone(plan.tile_size)
+        self.assertLess(plan.output_scale, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,25 +1,64 @@
 # This file contains utility functions to implement support for mrf.
 # Please refer to https://arxiv.org/abs/1601.04589 for more details.
 
+import numpy as np
 import tensorflow as tf
+from typing import Union, Tuple, List
 
+# The number of style patches matched against the generated patches at a time. The response of one block has size
+# (number of generated patches) * MRF_BLOCK_SIZE, so the memory is linear in the image area instead of quadratic.
+MRF_BLOCK_SIZE = 4096
+MRF_PATCH_SIZE = 3  # Same as in the paper https://arxiv.org/abs/1601.04589.
+# 'exact' compares every generated patch with every style patch. 'patchmatch' keeps a nearest neighbor field between
+# iterations and only refines it with a few candidates per patch, see approximate_patch_matching.
+MRF_MATCHERS = ('exact', 'patchmatch')
 
-def mrf_loss(style_layer, generated_layer, patch_size=3, name=''):
-    # type: (tf.Tensor, tf.Tensor, int, str) -> tf.Tensor
+
+def mrf_loss(style_layer, generated_layer, patch_size=MRF_PATCH_SIZE, name='', style_patch_bank=None,
+             block_size=MRF_BLOCK_SIZE, matcher='exact'):
+    # type: (Union[None,np.ndarray,tf.Tensor], tf.Tensor, int, str, Union[None,Tuple[tf.Tensor,tf.Tensor]], Union[None,int], str) -> tf.Tensor
     """
 
-    :param style_layer: The vgg feature layer by feeding it the style image.
+    :param style_layer: The vgg feature layer by feeding it the style image. If it is a numpy array, the style patch
+    bank is computed once by create_style_patch_bank instead of in every iteration.
     :param generated_layer: The vgg feature layer by feeding it the generated image.
     :param patch_size: The patch size of the mrf.
     :param name: Name scope of this loss.
+    :param style_patch_bank: The output of create_style_patch_bank or get_style_patch_bank. If it is provided,
+    style_layer is only used for its shape and may be None.
+    :param block_size: The number of style patches matched at a time. See patch_matching.
+    :param matcher: One of MRF_MATCHERS.
     :return: the mrf loss between the two inputted layers represented as a scalar tensor.
     """
+    if matcher not in MRF_MATCHERS:
+        raise AssertionError('Unknown mrf matcher %s. It must be one of %s.' % (matcher, str(MRF_MATCHERS)))
 
-    # TODO: Maybe I should make style_layer static to improve speed.
     with tf.name_scope('mrf_loss' + name):
         generated_layer_patches = create_local_patches(generated_layer, patch_size)
-        style_layer_patches = create_local_patches(style_layer, patch_size)
-        generated_layer_nn_matched_patches = patch_matching(generated_layer_patches, style_layer_patches, patch_size)
+        if style_patch_bank is None:
+            if isinstance(style_layer, np.ndarray):
+                style_patch_bank = create_style_patch_bank([style_layer], patch_size)
+            else:
+                style_patch_bank = get_style_patch_bank(create_local_patches(style_layer, patch_size))
+        if matcher == 'patchmatch':
+            # The propagation step needs the style patches on their original grid. Subsampled or pooled banks are
+            # treated as a single row, so only the random search applies to them.
+            num_style_patches = style_patch_bank[0].get_shape().as_list()[0]
+            style_patches_height, style_patches_width = 1, num_style_patches
+            if style_layer is not None:
+                if isinstance(style_layer, np.ndarray):
+                    _, style_height, style_width, _ = style_layer.shape
+                else:
+                    _, style_height, style_width, _ = style_layer.get_shape().as_list()
+                if (style_height - patch_size + 1) * (style_width - patch_size + 1) == num_style_patches:
+                    style_patches_height = style_height - patch_size + 1
+                    style_patches_width = style_width - patch_size + 1
+            generated_layer_nn_matched_patches = approximate_patch_matching(
+                generated_layer_patches, style_patch_bank, style_patches_height, style_patches_width)
+        else:
+            generated_layer_nn_matched_patches = patch_matching(generated_layer_patches, None, patch_size,
+                                                                style_patch_bank=style_patch_bank,
+                                                                block_size=block_size)
         _, height, width, number = map(lambda i: i.value, generated_layer.get_shape())
         size = height * width * number
         # Normalize by the size of the image as well as the patch area.
@@ -28,6 +67,168 @@ def mrf_loss(style_layer, generated_layer, patch_size=3, name=''):
         return loss
 
 
+def create_style_patch_bank(style_layers, patch_size, stride=1, max_num_patches=None, deduplicate_threshold=None,
+                            seed=0):
+    # type: (List[np.ndarray], int, int, Union[None,int], Union[None,float], int) -> Tuple[tf.Variable,tf.Variable]
+    """
+    The style layers are constant during stylization, so their patch bank is computed once instead of in every
+    iteration. Only the style layers (and the indices of the kept patches) are stored in the graph. The bank itself is
+    9 times larger than a style layer, so it is computed in the initializers of two local variables instead of being
+    embedded as constants, which would quickly reach the 2GB GraphDef limit. Run tf.initialize_local_variables() before
+    using the bank.
+    The patches of the same layer of several style images are pooled into one bank, so that one matching pass covers all
+    the style images. The bank can be made smaller, see select_style_patches.
+    :param style_layers: The same feature layer of each style image, each with dimension (1, height, width, feature)
+    :param patch_size: The patch size of the mrf.
+    :param stride: See select_style_patches.
+    :param max_num_patches: See select_style_patches.
+    :param deduplicate_threshold: See select_style_patches.
+    :param seed: See select_style_patches.
+    :return: Same as get_style_patch_bank, as non-trainable local variables.
+    """
+    indices = select_style_patches(style_layers, patch_size, stride=stride, max_num_patches=max_num_patches,
+                                   deduplicate_threshold=deduplicate_threshold, seed=seed)
+    style_layer_patches = [tf.reshape(create_local_patches(tf.constant(np.asarray(style_layer, dtype=np.float32)),
+                                                           patch_size), [-1, patch_size * patch_size *
+                                                                         style_layer.shape[3]])
+                           for style_layer in style_layers]
+    style_layer_patches = tf.concat(0, style_layer_patches) if len(style_layer_patches) > 1 else style_layer_patches[0]
+    if indices is not None:
+        style_layer_patches = tf.gather(style_layer_patches, indices)
+    normalized_style_patches, style_patch_norms = get_style_patch_bank(style_layer_patches)
+    return (tf.Variable(normalized_style_patches, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        name='normalized_style_patches'),
+            tf.Variable(style_patch_norms, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        name='style_patch_norms'))
+
+
+def select_style_patches(style_layers, patch_size, stride=1, max_num_patches=None, deduplicate_threshold=None,
+                         seed=0):
+    # type: (List[np.ndarray], int, int, Union[None,int], Union[None,float], int) -> Union[None,np.ndarray]
+    """
+    Chooses which patches of the pooled style layers are kept in the patch bank: every stride-th patch in each
+    direction, then the ones left after dropping near-identical patches, then a random subset.
+    :param style_layers: The same feature layer of each style image, each with dimension (1, height, width, feature)
+    :param patch_size: The patch size of the mrf.
+    :param stride: Only every stride-th patch in each direction is kept. Neighboring patches overlap a lot, so a stride
+    of 2 keeps most of the variety with a quarter of the patches.
+    :param max_num_patches: If not None, at most this many patches are kept, chosen randomly.
+    :param deduplicate_threshold: If not None, a patch is dropped if the cosine similarity between it and a kept patch
+    is above this threshold. See deduplicate_style_patches.
+    :param seed: The random seed for the subset and for deduplicate_style_patches.
+    :return: The sorted indices of the kept patches among the patches of all style layers in row major order, or None
+    if all patches are kept.
+    """
+    if stride < 1:
+        raise AssertionError('The stride must be at least 1. Got %d.' % stride)
+    indices = []
+    num_patches = 0
+    for style_layer in style_layers:
+        _, height, width, _ = style_layer.shape
+        out_height = height - patch_size + 1
+        out_width = width - patch_size + 1
+        if out_height <= 0 or out_width <= 0:
+            raise AssertionError('The style layer with shape %s is smaller than the patch size %d.'
+                                 % (str(style_layer.shape), patch_size))
+        rows = np.arange(0, out_height, stride)
+        cols = np.arange(0, out_width, stride)
+        indices.append((rows[:, np.newaxis] * out_width + cols[np.newaxis, :]).ravel() + num_patches)
+        num_patches += out_height * out_width
+    indices = np.concatenate(indices)
+    if deduplicate_threshold is not None:
+        style_patches = np.concatenate([extract_style_patches(style_layer, patch_size)
+                                        for style_layer in style_layers], axis=0)
+        indices = indices[deduplicate_style_patches(style_patches[indices], deduplicate_threshold, seed=seed)]
+    if max_num_patches is not None and indices.size > max_num_patches:
+        indices = np.sort(np.random.RandomState(seed).choice(indices, max_num_patches, replace=False))
+    if indices.size == num_patches:
+        return None
+    return indices.astype(np.int32)
+
+
+def extract_style_patches(style_layer, patch_size):
+    # type: (np.ndarray, int) -> np.ndarray
+    """
+    The numpy version of create_local_patches.
+    :param style_layer: Feature layer with dimension (1, height, width, feature)
+    :param patch_size: The patch size of the mrf.
+    :return: The patches in row major order, with dimension (num_patches, patch_size * patch_size * feature)
+    """
+    style_layer = np.asarray(style_layer, dtype=np.float32)
+    _, height, width, depth = style_layer.shape
+    out_height = height - patch_size + 1
+    out_width = width - patch_size + 1
+    # Same order as tf.extract_image_patches: each patch is flattened as (row, col, feature).
+    style_patches = np.stack([style_layer[0, i:i + out_height, j:j + out_width, :]
+                              for i in range(patch_size) for j in range(patch_size)], axis=2)
+    return style_patches.reshape((out_height * out_width, patch_size * patch_size * depth))
+
+
+def deduplicate_style_patches(style_patches, threshold, num_hash_bits=16, num_hash_tables=4, seed=0):
+    # type: (np.ndarray, float, int, int, int) -> np.ndarray
+    """
+    Drops near-identical patches, which are common in flat regions of the style image and only slow down the matching.
+    Comparing all pairs of patches is too slow, so the patches are put into buckets by the signs of their projections
+    onto num_hash_bits random directions and are only compared within each bucket. This is repeated num_hash_tables
+    times with different directions on the patches kept so far.
+    Two patches with an angle theta between them share a bucket of one table with probability (1 - theta / pi) **
+    num_hash_bits. With the default parameters a pair with a cosine similarity of 0.999 is compared with probability
+    above 0.99 and a pair with 0.99 with probability around 0.93, but a pair with 0.95 only with probability around
+    0.55. So only near-exact duplicates are reliably removed and a lower threshold removes fewer patches than it
+    suggests.
+    :param style_patches: Style patches with dimension (num_patches, patch_size * patch_size * feature)
+    :param threshold: A patch is dropped if its cosine similarity with a kept patch in one of its buckets is above this.
+    :param num_hash_bits: The number of random directions of each table.
+    :param num_hash_tables: The number of times the patches are put into buckets.
+    :param seed: The random seed of the directions.
+    :return: The sorted indices of the kept patches.
+    """
+    num_patches = style_patches.shape[0]
+    vectors = style_patches.reshape((num_patches, -1))
+    vectors = vectors / np.sqrt(np.maximum(np.sum(np.square(vectors), axis=1, keepdims=True), 1e-12))
+    random_state = np.random.RandomState(seed)
+    kept = np.arange(num_patches)
+    for _ in range(num_hash_tables):
+        directions = random_state.randn(vectors.shape[1], num_hash_bits).astype(np.float32)
+        buckets = np.dot(np.dot(vectors[kept], directions) > 0, 2 ** np.arange(num_hash_bits))
+        kept_in_table = []
+        for bucket in np.unique(buckets):
+            remaining = kept[buckets == bucket]
+            while remaining.size > 0:
+                kept_in_table.append(remaining[0])
+                similarities = np.dot(vectors[remaining[1:]], vectors[remaining[0]])
+                remaining = remaining[1:][similarities <= threshold]
+        kept = np.sort(kept_in_table)
+    return kept
+
+
+def get_style_patch_bank(style_layer_patches):
+    # type: (tf.Tensor) -> Tuple[tf.Tensor,tf.Tensor]
+    """
+    :param style_layer_patches: Size (..., patch_size * patch_size * feature), e.g. the output of create_local_patches.
+    :return: The l2 normalized style patches with dimension (num_patches, patch_size * patch_size * feature) and the
+    norms of the patches with dimension (num_patches,). The original patches are the normalized ones times their norms,
+    so they are not stored separately.
+    """
+    patch_depth = style_layer_patches.get_shape().as_list()[-1]
+    style_patches = tf.reshape(style_layer_patches, [-1, patch_depth])
+    # Same as tf.nn.l2_normalize.
+    style_patch_norms = tf.sqrt(tf.maximum(tf.reduce_sum(tf.square(style_patches), 1), 1e-12))
+    return style_patches / tf.expand_dims(style_patch_norms, 1), style_patch_norms
+
+
+def gather_style_patches(style_patch_bank, indices):
+    # type: (Tuple[tf.Tensor,tf.Tensor], tf.Tensor) -> tf.Tensor
+    """
+    :param style_patch_bank: The output of create_style_patch_bank or get_style_patch_bank.
+    :param indices: Integer tensor of any shape.
+    :return: The original (not normalized) style patches at the indices, with dimension
+    indices.shape + (patch_size * patch_size * feature,)
+    """
+    normalized_style_patches, style_patch_norms = style_patch_bank
+    return tf.gather(normalized_style_patches, indices) * tf.expand_dims(tf.gather(style_patch_norms, indices), -1)
+
+
 def create_local_patches(layer, patch_size, padding='VALID'):
     # type: (tf.Tensor, int, str) -> tf.Tensor
     """
@@ -41,59 +242,148 @@ def create_local_patches(layer, patch_size, padding='VALID'):
                                     strides=[1, 1, 1, 1], rates=[1, 1, 1, 1], padding=padding)
 
 
-def patch_matching(generated_layer_patches, style_layer_patches, patch_size):
-    # type: (tf.Tensor, tf.Tensor, int) -> tf.Tensor
+def patch_matching(generated_layer_patches, style_layer_patches, patch_size, style_patch_bank=None, block_size=None):
+    # type: (tf.Tensor, Union[None,tf.Tensor], int, Union[None,Tuple[tf.Tensor,tf.Tensor]], Union[None,int]) -> tf.Tensor
     """
-    The patch matching is implemented as an additional convolutional layer for fast computation.
-    In this case patches sampled from the style image are treated as the filters.
+    The patch matching is implemented as a matrix multiplication between the normalized generated patches and the
+    normalized style patches for fast computation.
     :param generated_layer_patches: Size (batch, height, width, patch_size * patch_size * feature)
     :param style_layer_patches:Size (1, height, width, patch_size * patch_size * feature)
     :param patch_size: the patch size for mrf.
+    :param style_patch_bank: The output of create_style_patch_bank or get_style_patch_bank. If it is provided,
+    style_layer_patches is not used.
+    :param block_size: If not None, the style patches are matched this many at a time. Otherwise all of them are
+    matched in one multiplication, whose output grows quadratically with the image size.
     :return: Best matching patch with size (batch, height, width, patch_size * patch_size * feature)
     """
+    if style_patch_bank is None:
+        style_patch_bank = get_style_patch_bank(style_layer_patches)
+
+    # All patches of all images in the batch are matched at once, with shape (batch * height * width, patch_depth).
+    _, height, width, patch_depth = generated_layer_patches.get_shape().as_list()
     # Every patch and every feature layer are treated as equally important after normalization.
+    normalized_generated_layer_patches = tf.nn.l2_normalize(tf.reshape(generated_layer_patches, [-1, patch_depth]),
+                                                            dim=1)
+    argmax = get_nearest_style_patch_indices(normalized_generated_layer_patches, style_patch_bank[0],
+                                             block_size=block_size)
+    best_match = gather_style_patches(style_patch_bank, argmax)
+    best_match = tf.reshape(best_match, [-1, height, width, patch_depth])
+    return best_match
+
+
+def get_nearest_style_patch_indices(normalized_generated_patches, normalized_style_patches, block_size=None):
+    # type: (tf.Tensor, tf.Tensor, Union[None,int]) -> tf.Tensor
+    """
+    Finds the style patch with the highest normalized cross correlation for each generated patch. The style patches are
+    split into blocks of block_size. Each block is one matrix multiplication and the running best score and index are
+    kept across the blocks.
+    :param normalized_generated_patches: Size (num_generated_patches, patch_size * patch_size * feature)
+    :param normalized_style_patches: Size (num_style_patches, patch_size * patch_size * feature)
+    :param block_size: The number of style patches in each block. If None, all style patches are in one block.
+    :return: The index of the best matching style patch for each generated patch, with size (num_generated_patches,)
+    """
+    num_style_patches = normalized_style_patches.get_shape().as_list()[0]
+    if block_size is None or block_size >= num_style_patches:
+        block_size = num_style_patches
+    if block_size <= 0:
+        raise AssertionError('The block size must be positive. Got %d.' % block_size)
+    best_scores = None
+    best_indices = None
+    for start in range(0, num_style_patches, block_size):
+        current_block_size = min(block_size, num_style_patches - start)
+        block = tf.slice(normalized_style_patches, [start, 0], [current_block_size, -1])
+        # The blocks are matched one after another so that only one response is in memory at any time.
+        with tf.control_dependencies([] if best_scores is None else [best_scores, best_indices]):
+            similarities = tf.matmul(normalized_generated_patches, block, transpose_b=True)
+        scores = tf.reduce_max(similarities, 1)
+        indices = tf.argmax(similarities, 1) + start
+        if best_scores is None:
+            best_scores, best_indices = scores, indices
+        else:
+            # Ties go to the earlier block, same as argmax over all the style patches at once.
+            improved = tf.greater(scores, best_scores)
+            best_scores = tf.select(improved, scores, best_scores)
+            best_indices = tf.select(improved, indices, best_indices)
+    return best_indices
+
+
+def approximate_patch_matching(generated_layer_patches, style_patch_bank, style_patches_height, style_patches_width):
+    # type: (tf.Tensor, Tuple[tf.Tensor,tf.Tensor], int, int) -> tf.Tensor
+    """
+    An approximate replacement of patch_matching in the spirit of PatchMatch (Barnes et al. 2009). The best style patch
+    of each generated patch is kept in a nearest neighbor field (a non-trainable variable) between iterations. Every
+    time the output is evaluated, the field is refined: each generated patch compares its current match with the
+    matches of its four neighbors shifted by one (propagation), with style patches at random offsets of exponentially
+    decreasing radius around its current match (random search) and with one uniformly random style patch. The
+    correspondences change slowly during optimization, so a few candidates per patch are enough instead of comparing
+    against every style patch.
+    The nearest neighbor field is a local variable initialized randomly. Run tf.initialize_local_variables() before the
+    output is evaluated.
+    :param generated_layer_patches: Size (batch, height, width, patch_size * patch_size * feature). The batch size must
+    be known.
+    :param style_patch_bank: The output of create_style_patch_bank or get_style_patch_bank.
+    :param style_patches_height: The number of rows of the style patches.
+    :param style_patches_width: The number of columns of the style patches.
+    :return: Best matching patch found so far with size (batch, height, width, patch_size * patch_size * feature)
+    """
+    batch_size, height, width, patch_depth = generated_layer_patches.get_shape().as_list()
+    nnf_shape = [batch_size, height, width]
+    num_style_patches = style_patches_height * style_patches_width
+    normalized_style_patches = style_patch_bank[0]
     normalized_generated_layer_patches = tf.nn.l2_normalize(generated_layer_patches, dim=[3])
-    normalized_style_layer_patches = tf.nn.l2_normalize(style_layer_patches, dim=[3])
-    # A better way to do this is to treat them as convolutions.
-    # They have to be in dimension
-    # (height * width, patch_size, patch_size, feature) <=> (batch, in_height, in_width, in_channels)
-    # (patch_size, patch_size, feature, height * width) <= > (filter_height, filter_width, in_channels, out_channels)
-    # Initially they are in [batch, out_rows, out_cols, patch_size * patch_size * depth]
-    original_shape = normalized_style_layer_patches.get_shape().as_list()
-    height = original_shape[1]
-    width = original_shape[2]
-    depth = original_shape[3] / patch_size / patch_size
-    normalized_style_layer_patches = tf.squeeze(normalized_style_layer_patches)
-
-    normalized_style_layer_patches = tf.reshape(normalized_style_layer_patches,
-                                                [height, width, patch_size, patch_size, depth])
-    normalized_style_layer_patches = tf.reshape(normalized_style_layer_patches,
-                                                [height * width, patch_size, patch_size, depth])
-    normalized_style_layer_patches = tf.transpose(normalized_style_layer_patches, perm=[1, 2, 3, 0])
-    style_layer_patches_reshaped = tf.reshape(style_layer_patches, [height, width, patch_size, patch_size, depth])
-    style_layer_patches_reshaped = tf.reshape(style_layer_patches_reshaped,
-                                              [height * width, patch_size, patch_size, depth])
-
-    normalized_generated_layer_patches_per_batch = tf.unpack(normalized_generated_layer_patches, axis=0)
-    ret = []
-    for batch in normalized_generated_layer_patches_per_batch:
-        original_shape = batch.get_shape().as_list()
-        height = original_shape[0]
-        width = original_shape[1]
-        depth = original_shape[2] / patch_size / patch_size
-        batch = tf.squeeze(batch)
-
-        batch = tf.reshape(batch, [height, width, patch_size, patch_size, depth])
-        batch = tf.reshape(batch, [height * width, patch_size, patch_size, depth])
-        # According to images-analogies github, for cross-correlation, we should flip the kernels
-        # That is normalized_style_layer_patches should be [:, ::-1, ::-1, :]
-        # I didn't see that in any other source, nor do I see why I should do so.
-        convs = tf.nn.conv2d(batch, normalized_style_layer_patches, strides=[1, 1, 1, 1], padding='VALID')
-        argmax = tf.squeeze(tf.argmax(convs, dimension=3))
-        # best_match has shape [height * width, patch_size, patch_size, depth]
-        best_match = tf.gather(style_layer_patches_reshaped, indices=argmax)
-        best_match = tf.reshape(best_match, [height, width, patch_size, patch_size, depth])
-        best_match = tf.reshape(best_match, [height, width, patch_size * patch_size * depth])
-        ret.append(best_match)
-    ret = tf.pack(ret)
-    return ret
+
+    nnf = tf.Variable(tf.random_uniform(nnf_shape, 0, num_style_patches, dtype=tf.int32), trainable=False,
+                      collections=[tf.GraphKeys.LOCAL_VARIABLES], name='nnf')
+
+    def to_index(style_y, style_x):
+        style_y = tf.clip_by_value(style_y, 0, style_patches_height - 1)
+        style_x = tf.clip_by_value(style_x, 0, style_patches_width - 1)
+        return style_y * style_patches_width + style_x
+
+    def shift(tensor, axis, offset):
+        # Element i becomes element i - offset along the axis. The border repeats itself.
+        length = nnf_shape[axis]
+        begin = [0, 0, 0]
+        size = list(nnf_shape)
+        size[axis] = length - 1
+        border_begin = [0, 0, 0]
+        border_size = list(nnf_shape)
+        border_size[axis] = 1
+        if offset > 0:
+            return tf.concat(axis, [tf.slice(tensor, border_begin, border_size), tf.slice(tensor, begin, size)])
+        else:
+            begin[axis] = 1
+            border_begin[axis] = length - 1
+            return tf.concat(axis, [tf.slice(tensor, begin, size), tf.slice(tensor, border_begin, border_size)])
+
+    nnf_y = tf.floordiv(nnf, style_patches_width)
+    nnf_x = tf.mod(nnf, style_patches_width)
+    candidates = [nnf]
+    # Propagation: if the left neighbor matches style patch (y, x), this patch probably matches (y, x + 1).
+    for axis, offset in ((1, 1), (1, -1), (2, 1), (2, -1)):
+        if nnf_shape[axis] > 1:
+            neighbor_y = shift(nnf_y, axis, offset)
+            neighbor_x = shift(nnf_x, axis, offset)
+            if axis == 1:
+                candidates.append(to_index(neighbor_y + offset, neighbor_x))
+            else:
+                candidates.append(to_index(neighbor_y, neighbor_x + offset))
+    # Random search around the current match.
+    radius = max(style_patches_height, style_patches_width) // 2
+    while radius >= 1:
+        candidates.append(to_index(nnf_y + tf.random_uniform(nnf_shape, -radius, radius + 1, dtype=tf.int32),
+                                   nnf_x + tf.random_uniform(nnf_shape, -radius, radius + 1, dtype=tf.int32)))
+        radius //= 2
+    candidates.append(tf.random_uniform(nnf_shape, 0, num_style_patches, dtype=tf.int32))
+
+    # Each candidate costs one gather of the style patches. They are scored one after another to bound the memory.
+    scores = []
+    for candidate in candidates:
+        with tf.control_dependencies(scores[-1:]):
+            candidate_patches = tf.gather(normalized_style_patches, candidate)
+        scores.append(tf.reduce_sum(tf.mul(normalized_generated_layer_patches, candidate_patches), 3))
+    best_candidate = tf.argmax(tf.pack(scores, axis=3), 3)
+    candidates = tf.pack(candidates, axis=3)
+    new_nnf = tf.reduce_sum(tf.mul(candidates, tf.one_hot(best_candidate, len(scores), dtype=tf.int32)), 3)
+    new_nnf = tf.assign(nnf, new_nnf)
+    return gather_style_patches(style_patch_bank, new_nnf)
@@ -131,6 +131,115 @@ class MrfUtilTest(tf.test.TestCase):
                 height * width * feature) / patch_size ** 2
             self.assertAlmostEqual(actual_output.eval(feeddict), expected_output)
 
+    def test_create_style_patch_bank(self):
+        with self.test_session() as sess:
+            patch_size = 3
+            init_style_layer = np.random.rand(1, 16, 15, 4).astype(np.float32)
+            style_layer = tf.placeholder(tf.float32, shape=(1, 16, 15, 4))
+            expected_output = sess.run(get_style_patch_bank(create_local_patches(style_layer, patch_size)),
+                                       feed_dict={style_layer: init_style_layer})
+            actual_output = create_style_patch_bank([init_style_layer], patch_size)
+            # Only the style layer is stored in the graph, not the 9 times larger bank.
+            self.assertLess(sess.graph.as_graph_def().ByteSize(), expected_output[0].nbytes)
+            sess.run(tf.initialize_local_variables())
+            for actual, expected in zip(sess.run(actual_output), expected_output):
+                np.testing.assert_array_almost_equal(actual, expected)
+            np.testing.assert_array_almost_equal(
+                gather_style_patches(actual_output, tf.range(13 * 14)).eval(),
+                extract_style_patches(init_style_layer, patch_size))
+
+    def test_mrf_loss_with_constant_style_layer(self):
+        with self.test_session():
+            patch_size = 2
+            generated_layer = tf.placeholder(tf.float32, shape=(2, 4, 4, 3))
+            style_layer = tf.placeholder(tf.float32, shape=(1, 4, 4, 3))
+            init_generated_layer = np.random.rand(2, 4, 4, 3).astype(np.float32)
+            init_style_layer = np.random.rand(1, 4, 4, 3).astype(np.float32)
+            expected_output = mrf_loss(style_layer, generated_layer, patch_size=patch_size).eval(
+                {generated_layer: init_generated_layer, style_layer: init_style_layer})
+            actual_output = mrf_loss(init_style_layer, generated_layer, patch_size=patch_size)
+            tf.initialize_local_variables().run()
+            actual_output = actual_output.eval({generated_layer: init_generated_layer})
+            self.assertAlmostEqual(actual_output, expected_output, places=5)
+
+    def test_patch_matching_in_blocks(self):
+        with self.test_session() as sess:
+            patch_size = 2
+            generated_layer = tf.placeholder(tf.float32, shape=(2, 5, 4, 3))
+            style_layer = tf.placeholder(tf.float32, shape=(1, 6, 5, 3))
+            generated_layer_patches = create_local_patches(generated_layer, patch_size)
+            style_layer_patches = create_local_patches(style_layer, patch_size)
+            expected_output = patch_matching(generated_layer_patches, style_layer_patches, patch_size)
+            # 20 style patches, so the last block is smaller than the others.
+            actual_output = patch_matching(generated_layer_patches, style_layer_patches, patch_size, block_size=3)
+            feeddict = {generated_layer: np.random.rand(2, 5, 4, 3), style_layer: np.random.rand(1, 6, 5, 3)}
+            actual_output, expected_output = sess.run([actual_output, expected_output], feed_dict=feeddict)
+            np.testing.assert_array_almost_equal(actual_output, expected_output)
+
+    def test_approximate_patch_matching(self):
+        # The matcher starts from a random field and searches randomly, so both random generators are seeded to make
+        # the number of iterations needed deterministic.
+        np.random.seed(0)
+        with tf.Graph().as_default() as graph, self.test_session(graph=graph) as sess:
+            tf.set_random_seed(0)
+            patch_size = 2
+            init_layer = np.random.rand(1, 6, 6, 3).astype(np.float32)
+            generated_layer = tf.placeholder(tf.float32, shape=(1, 6, 6, 3))
+            generated_layer_patches = create_local_patches(generated_layer, patch_size)
+            style_patch_bank = create_style_patch_bank([init_layer], patch_size)
+            actual_output = approximate_patch_matching(generated_layer_patches, style_patch_bank, 5, 5)
+            sess.run(tf.initialize_local_variables())
+            feeddict = {generated_layer: init_layer}
+            # The generated layer is the style layer, so every patch should eventually be matched with itself.
+            for _ in range(100):
+                actual = actual_output.eval(feeddict)
+            np.testing.assert_array_almost_equal(actual, generated_layer_patches.eval(feeddict))
+
+    def test_select_style_patches(self):
+        patch_size = 2
+        style_layer = np.random.rand(1, 5, 5, 3).astype(np.float32)
+        self.assertIsNone(select_style_patches([style_layer, style_layer], patch_size))
+        # 4 by 4 patches in each style layer.
+        np.testing.assert_array_equal(select_style_patches([style_layer], patch_size, stride=2), [0, 2, 8, 10])
+        np.testing.assert_array_equal(select_style_patches([style_layer, style_layer], patch_size, stride=3),
+                                      [0, 3, 12, 15, 16, 19, 28, 31])
+        # Pooling the same style layer twice gives two copies of each patch, and deduplication removes the copies.
+        np.testing.assert_array_equal(select_style_patches([style_layer, style_layer], patch_size,
+                                                           deduplicate_threshold=0.9999), np.arange(16))
+        subset = select_style_patches([style_layer, style_layer], patch_size, max_num_patches=10)
+        self.assertEqual(subset.shape, (10,))
+        self.assertEqual(len(np.unique(subset)), 10)
+        with self.test_session() as sess:
+            normalized_style_patches, style_patch_norms = create_style_patch_bank([style_layer, style_layer],
+                                                                                  patch_size, max_num_patches=10)
+            self.assertEqual(normalized_style_patches.get_shape().as_list(), [10, 12])
+            self.assertEqual(style_patch_norms.get_shape().as_list(), [10])
+            sess.run(tf.initialize_local_variables())
+            style_patches = np.concatenate([extract_style_patches(style_layer, patch_size)] * 2)
+            np.testing.assert_array_almost_equal(
+                gather_style_patches((normalized_style_patches, style_patch_norms), tf.range(10)).eval(),
+                style_patches[subset])
+
+    def test_patch_matching_unknown_batch_size(self):
+        with self.test_session() as sess:
+            patch_size = 2
+            generated_layer = tf.placeholder(tf.float32, shape=(None, 4, 4, 3))
+            style_layer = tf.placeholder(tf.float32, shape=(1, 5, 5, 3))
+            generated_layer_patches = create_local_patches(generated_layer, patch_size)
+            style_layer_patches = create_local_patches(style_layer, patch_size)
+            actual_output = patch_matching(generated_layer_patches, style_layer_patches, patch_size)
+            init_generated_layer = np.random.rand(3, 4, 4, 3)
+            init_style_layer = np.random.rand(1, 5, 5, 3)
+            actual_output = sess.run(actual_output, feed_dict={generated_layer: init_generated_layer,
+                                                               style_layer: init_style_layer})
+            self.assertEqual(actual_output.shape, (3, 3, 3, 12))
+            # Each image in the batch is matched the same way as when it is matched on its own.
+            for i in range(3):
+                expected_output = sess.run(
+                    patch_matching(generated_layer_patches, style_layer_patches, patch_size),
+                    feed_dict={generated_layer: init_generated_layer[i:i + 1], style_layer: init_style_layer})
+                np.testing.assert_array_almost_equal(actual_output[i:i + 1], expected_output)
+
 
 if __name__ == '__main__':
     tf.test.main()
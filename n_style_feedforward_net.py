@@ -30,7 +30,7 @@ import skip_noise_4_feedforward_net
 import vgg
 from general_util import *
 from mrf_util import mrf_loss
-from neural_util import gramian, total_variation, precompute_image_features
+from neural_util import gramian, total_variation, precompute_images_features
 
 # For compatibility among tensorflow versions.
 try:
@@ -65,7 +65,8 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
                         style_semantic_masks=None, semantic_masks_weight=1.0, semantic_masks_num_layers=1,
                         do_restore_and_train=False, do_restore_and_generate=False, from_screenshot=False,
                         from_webcam=False, test_img_dir=None, one_hot_vector_for_restore_and_generate=None,
-                        content_img_style_weight_mask=None, style_weight_mask_for_training=None):
+                        content_img_style_weight_mask=None, style_weight_mask_for_training=None,
+                        batch_vgg_passes=False, style_features_cache_dir=None):
     """
     Stylize images.
 
@@ -133,6 +134,11 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
     :param content_img_style_weight_mask: This is EXPERIMENTAL! see stylize for more documentation.
     :param style_weight_mask_for_training: This is EXPERIMENTAL! This is the np array containing random masks to be
     used for training.
+    :param batch_vgg_passes: If true, the generated images and the content images are concatenated along the batch
+    axis and passed through the vgg network once (with batch size 2 * batch_size) instead of twice. It has no effect
+    when there is no content loss.
+    :param style_features_cache_dir: If not None, the precomputed style features are cached in this directory so that
+    restarting the training skips passing the style images through the vgg network.
     :return:iterator[tuple[int|None,List[image]]]
 
     """
@@ -182,7 +188,6 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
 
 
     content_features = {}
-    style_features = [{} for _ in styles]
     output_semantic_mask_features = {}
     content_img_preprocessed = None
     prev_content_preprocessed_file_i = 0
@@ -192,9 +197,8 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
     print('Finished loading VGG.')
 
     if not do_restore_and_generate:
-        # # Compute style features in feedforward mode.
-        for i in range(len(styles)):
-            style_features[i] = precompute_image_features(styles[i], STYLE_LAYERS, style_shapes[i], vgg_data, mean_pixel, use_mrf, use_semantic_masks)
+        # # Compute style features in feedforward mode. Styles with the same shape are batched together.
+        style_features = precompute_images_features(styles, STYLE_LAYERS, vgg_data, mean_pixel, use_mrf, use_semantic_masks, cache_dir=style_features_cache_dir)
         print('Finished passing style images to VGG for precomputing features.')
 
         if content_preprocessed_folder is not None and content_preprocessed_folder != '' and not style_only:
@@ -258,18 +262,31 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
 
         # Feed the generated images, content images, and style images to vgg network and get the vgg features for each
         # layer to compute loss.
-        net = vgg.pre_read_net(vgg_data, image)
-        net_layer_sizes = vgg.get_net_layer_sizes(net)
+        vgg_layers = (CONTENT_LAYER,) + tuple(STYLE_LAYERS)
         if not do_restore_and_generate:
-            learning_rate_decayed_init = tf.constant(learning_rate)
-            learning_rate_decayed = tf.get_variable(name='learning_rate_decayed', trainable=False,
-                                                    initializer=learning_rate_decayed_init)
             # compute content features in feed-forward mode.
             content_images = tf.placeholder(tf.float32, [batch_size, input_shape[1], input_shape[2], 3],
                                             name='content_images_placeholder')
             content_pre = vgg.preprocess(content_images, mean_pixel)
-            content_net = vgg.pre_read_net(vgg_data, content_pre)
-            content_features[CONTENT_LAYER] = content_net[CONTENT_LAYER]
+        if batch_vgg_passes and not (do_restore_and_generate or style_only or use_semantic_masks):
+            # One vgg pass over a batch of 2 * batch_size is cheaper than two passes over batch_size. The first half of
+            # each layer belongs to the generated images and the second half to the content images.
+            batched_net = vgg.pre_read_net(vgg_data, tf.concat(0, [image, content_pre]), required_layers=vgg_layers)
+            net = {}
+            for layer in vgg_layers:
+                net[layer], content_layer = tf.split(0, 2, batched_net[layer])
+                if layer == CONTENT_LAYER:
+                    content_features[CONTENT_LAYER] = content_layer
+        else:
+            net = vgg.pre_read_net(vgg_data, image, required_layers=vgg_layers)
+        net_layer_sizes = vgg.get_net_layer_sizes(net)
+        if not do_restore_and_generate:
+            learning_rate_decayed_init = tf.constant(learning_rate)
+            learning_rate_decayed = tf.get_variable(name='learning_rate_decayed', trainable=False,
+                                                    initializer=learning_rate_decayed_init)
+            if CONTENT_LAYER not in content_features:
+                content_net = vgg.pre_read_net(vgg_data, content_pre, required_layers=(CONTENT_LAYER,))
+                content_features[CONTENT_LAYER] = content_net[CONTENT_LAYER]
 
             if use_semantic_masks:
                 output_semantic_mask_features, style_features, content_semantic_mask, style_semantic_masks_images = neural_doodle_util.construct_masks_and_features(style_semantic_masks, styles, style_features, batch_size, input_shape[1], input_shape[2], semantic_masks_num_layers, STYLE_LAYERS, net_layer_sizes, semantic_masks_weight, vgg_data, mean_pixel, mask_resize_as_feature, use_mrf)
@@ -343,11 +360,6 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
             else:
                 losses_for_each_style = [style_loss + content_loss + tv_loss for style_loss in
                                          style_loss_for_each_style]
-            overall_loss = 0
-            for loss_for_each_style in losses_for_each_style:
-                overall_loss += loss_for_each_style
-                # TODO: There might be a bug here because it is not possible to feed multiple styles all at the same
-                # time, so the overall loss would be impossible to calculate and the current result is wrong.
             # optimizer setup
             # Training using adam optimizer. Setting comes from https://arxiv.org/abs/1610.07629.
             if multiple_styles_train_scale_offset_only:
@@ -376,17 +388,26 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
                     for i, loss in
                     enumerate(losses_for_each_style)]
 
-            def print_progress(i, feed_dict, last=False):
+            def get_progress_fetches(style_i):
+                # The values printed by print_progress. They are fetched in the same session.run as the training step
+                # so that printing does not cost extra forward passes.
+                progress_fetches = [learning_rate_decayed, style_loss_for_each_style[style_i], tv_loss,
+                                    losses_for_each_style[style_i]]
+                if not (style_only or use_semantic_masks):
+                    progress_fetches.append(content_loss)
+                return progress_fetches
+
+            def print_progress(i, progress_values):
                 stderr.write(
                     'Iteration %d/%d\n' % (i + 1, iterations))
-                if last or (print_iterations and i % print_iterations == 0):
-                    stderr.write('Learning rate %f\n' % (learning_rate_decayed.eval()))
-                    # Assume that the feed_dict is for the last content and style image.
+                if progress_values:
+                    # The values are for the last content and style image.
+                    stderr.write('Learning rate %f\n' % progress_values[0])
                     if not (style_only or use_semantic_masks):
-                        stderr.write('  content loss: %g\n' % content_loss.eval(feed_dict=feed_dict))
-                    stderr.write('    style loss: %g\n' % style_loss_for_each_style[-1].eval(feed_dict=feed_dict))
-                    stderr.write('       tv loss: %g\n' % tv_loss.eval(feed_dict=feed_dict))
-                    stderr.write('    total loss: %g\n' % overall_loss.eval(feed_dict=feed_dict))
+                        stderr.write('  content loss: %g\n' % progress_values[4])
+                    stderr.write('    style loss: %g\n' % progress_values[1])
+                    stderr.write('       tv loss: %g\n' % progress_values[2])
+                    stderr.write('    total loss: %g\n' % progress_values[3])
 
         # Optimization
         # It used to track and record only the best one with lowest loss. This is no longer necessary and I think
@@ -395,6 +416,9 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
 
         saver = tf.train.Saver(max_to_keep=1)
         with tf.Session() as sess:
+            # The mrf style patch banks are local variables. They are not saved in the checkpoints and are always
+            # computed from the style features.
+            sess.run(tf.initialize_local_variables())
             if do_restore_and_generate:
                 ckpt = tf.train.get_checkpoint_state(save_dir)
                 if ckpt and ckpt.model_checkpoint_path:
@@ -676,13 +700,21 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
                             content_img_style_weight_mask_batch_i = get_batch_indices(style_weight_mask_for_training_shape[0], i * batch_size, batch_size)
                             feed_dict[content_img_style_weight_mask_placeholder] = style_weight_mask_for_training[content_img_style_weight_mask_batch_i, :, :, :]
 
+                        progress_fetches = []
+                        if style_i == len(styles) - 1 and (last_step or (print_iterations and
+                                                                                 i % print_iterations == 0)):
+                            progress_fetches = get_progress_fetches(style_i)
                         if style_only or use_semantic_masks:
-                            _, style_loss_summary_str, tv_loss_summary_str = sess.run(
+                            fetched = sess.run(
                                 [train_step_for_each_style[style_i],
-                                 style_loss_summary_for_each_style[style_i], tv_loss_summary], feed_dict=feed_dict)
+                                 style_loss_summary_for_each_style[style_i], tv_loss_summary] + progress_fetches,
+                                feed_dict=feed_dict)
+                            style_loss_summary_str, tv_loss_summary_str = fetched[1:3]
 
                         else:
-                            _, content_loss_summary_str, style_loss_summary_str, tv_loss_summary_str = sess.run([train_step_for_each_style[style_i], content_loss_summary, style_loss_summary_for_each_style[style_i], tv_loss_summary], feed_dict=feed_dict)
+                            fetched = sess.run([train_step_for_each_style[style_i], content_loss_summary, style_loss_summary_for_each_style[style_i], tv_loss_summary] + progress_fetches, feed_dict=feed_dict)
+                            content_loss_summary_str, style_loss_summary_str, tv_loss_summary_str = fetched[1:4]
+                        progress_values = fetched[len(fetched) - len(progress_fetches):]
 
                         if not (style_only or use_semantic_masks):
                             summary_writer.add_summary(content_loss_summary_str, i)
@@ -692,7 +724,7 @@ def style_synthesis_net(path_to_network, height, width, styles, iterations, batc
                         # train_step_for_each_style[style_i].run(feed_dict=feed_dict)
 
                         if style_i == len(styles) - 1:
-                            print_progress(i, feed_dict=feed_dict, last=last_step)
+                            print_progress(i, progress_values)
 
                         if (checkpoint_iterations and i % checkpoint_iterations == 0) or last_step:
                             # Do checkpoint only when it reached the last style image.
@@ -22,6 +22,7 @@ from sys import stderr
 
 import cv2
 import tensorflow as tf
+from typing import Tuple
 
 import johnson_feedforward_net_util
 import neural_doodle_util
@@ -171,7 +172,8 @@ class Stylizer:
         # self.device_string = '/cpu:0' if gpu_id < 0 else ("/gpu:%d" %gpu_id) # This one won't work for some reason
         self.device_string = '/cpu:0' if gpu_id < 0 else ''
         with self.graph.as_default(), tf.device(self.device_string):
-            self.one_hot_style_vector = tf.placeholder(tf.float32, [1, self.num_styles], name='input_style_placeholder')
+            # Either one style vector for the whole batch or one style vector for each image in the batch.
+            self.one_hot_style_vector = tf.placeholder(tf.float32, [None, self.num_styles], name='input_style_placeholder')
             if self.use_johnson:
                 if self.use_semantic_masks:
                     self.inputs = tf.placeholder(tf.float32, shape=[batch_size, self.input_shape[1], self.input_shape[2], semantic_masks_num_layers])
@@ -201,10 +203,13 @@ class Stylizer:
             # similar to the preprocessed content/style images. The image generated is in the normal rgb, not the
             # preprocessed/shifted version. Same reason applies to the other generator network below.
             self.image = vgg.preprocess(self.image, self.mean_pixel)
+            # The generator networks built so far, keyed by their input shape. See _build_generator.
+            self.generators = {(batch_size, self.input_shape[1], self.input_shape[2], 3): (
+                self.inputs, self.image, self.skip_noise_list if self.use_skip_noise_4 else None)}
     
             # Feed the generated images, content images, and style images to vgg network and get the vgg features for each
             # layer to compute loss.
-            net = vgg.pre_read_net(vgg_data, self.image)
+            net = vgg.pre_read_net(vgg_data, self.image, required_layers=(CONTENT_LAYER,) + tuple(STYLE_LAYERS))
             net_layer_sizes = vgg.get_net_layer_sizes(net)
             # Optimization
             # It used to track and record only the best one with lowest loss. This is no longer necessary and I think
@@ -244,78 +249,84 @@ class Stylizer:
                 print("Finished loading from npy file. There are %d variables loaded." %(len(variables_loaded)))
 
 
-    def stylize(self, img_dir, one_hot_vector_for_restore_and_generate):
-        with self.graph.as_default(), tf.device(self.device_string):
+    def _build_generator(self, input_shape):
+        # type: (Tuple[int,int,int,int]) -> None
+        """
+        Rebuilds the generator network (reusing its variables) for a new input shape. The networks already built are
+        cached, so switching back and forth between shapes does not keep growing the graph.
+        :param input_shape: The shape of the input with format (batch_size, height, width, 3).
+        """
+        if input_shape not in self.generators:
+            batch_size, height, width, _ = input_shape
+            if self.use_semantic_masks:
+                inputs = tf.placeholder(tf.float32, shape=[batch_size, height, width, self.semantic_masks_num_layers])
+            else:
+                inputs = tf.placeholder(tf.float32, shape=[batch_size, height, width, 3])
+            if self.content_img_style_weight_mask is not None:
+                content_img_style_weight_mask_placeholder = tf.placeholder(tf.float32, shape=[batch_size, height, width, 1], name='content_img_style_weight_mask')
+                inputs_concatenated = neural_util.concat_content_img_style_weight_mask_to_input(inputs, content_img_style_weight_mask_placeholder)
+            else:
+                inputs_concatenated = inputs
+            skip_noise_list = None
+            if self.use_johnson:
+                image = johnson_feedforward_net_util.net(inputs_concatenated, one_hot_style_vector=self.one_hot_style_vector, reuse=True)
+            elif self.use_skip_noise_4:
+                image, skip_noise_list = skip_noise_4_feedforward_net.net(inputs_concatenated, reuse=True)
+            else:
+                raise AssertionError
+            image = vgg.preprocess(image, self.mean_pixel)
+            self.generators[input_shape] = (inputs, image, skip_noise_list)
+        self.inputs, self.image, skip_noise_list = self.generators[input_shape]
+        if skip_noise_list is not None:
+            self.skip_noise_list = skip_noise_list
 
+    def stylize(self, img_dir, one_hot_vector_for_restore_and_generate):
+        """
+        :param img_dir: The path to the content image.
+        :param one_hot_vector_for_restore_and_generate: The style vector with shape (1, num_styles).
+        :return: The stylized image.
+        """
+        return self.batch_stylize(img_dir, one_hot_vector_for_restore_and_generate)[0]
 
+    def batch_stylize(self, img_dir, style_vectors):
+        """
+        Stylizes the same content image with every row of style_vectors in one forward pass of the generator.
+        :param img_dir: The path to the content image.
+        :param style_vectors: A numpy array with shape (num_outputs, num_styles). Each row is a one hot vector or a blend
+        of styles.
+        :return: A list of num_outputs stylized images.
+        """
+        with self.graph.as_default(), tf.device(self.device_string):
             content_image = imread(img_dir)
 
             content_pre = np.array([vgg.preprocess(content_image, self.mean_pixel)])
+            assert style_vectors is not None
+            style_vectors = np.array(style_vectors)
+            num_outputs = style_vectors.shape[0]
+            # Every output shares the content image and gets its own style vector.
+            content_pre = np.repeat(content_pre, num_outputs, axis=0)
 
             if content_pre.shape != self.input_shape:
-
                 self.input_shape = content_pre.shape
+                self._build_generator(self.input_shape)
 
-                if self.use_johnson:
-                    if self.use_semantic_masks:
-                        self.inputs = tf.placeholder(tf.float32, shape=[self.batch_size, self.input_shape[1], self.input_shape[2],
-                                                                        self.semantic_masks_num_layers])
-                    else:
-                        self.inputs = tf.placeholder(tf.float32, shape=[self.batch_size, self.input_shape[1], self.input_shape[2], 3])
-
-                    if self.content_img_style_weight_mask is not None:
-                        content_img_style_weight_mask_placeholder = tf.placeholder(tf.float32, shape=[self.batch_size, self.input_shape[1], self.input_shape[2], 1], name='content_img_style_weight_mask')
-                        input_concatenated = neural_util.concat_content_img_style_weight_mask_to_input(self.inputs, content_img_style_weight_mask_placeholder)
-                        self.image = johnson_feedforward_net_util.net(input_concatenated, one_hot_style_vector=self.one_hot_style_vector, reuse=True)
-                    else:
-                        self.image = johnson_feedforward_net_util.net(self.inputs, one_hot_style_vector=self.one_hot_style_vector, reuse=True)
-                elif self.use_skip_noise_4:
-                    if self.use_semantic_masks:
-                        self.inputs = tf.placeholder(tf.float32, shape=[self.batch_size, self.input_shape[1], self.input_shape[2], self.semantic_masks_num_layers])
-                    else:
-                        self.inputs = tf.placeholder(tf.float32, shape=[self.batch_size, self.input_shape[1], self.input_shape[2], 3])
-                    if self.content_img_style_weight_mask is not None:
-                        content_img_style_weight_mask_placeholder = tf.placeholder(tf.float32, shape=[self.batch_size, self.input_shape[1], self.input_shape[2], 1], name='content_img_style_weight_mask')
-                        input_concatenated = neural_util.concat_content_img_style_weight_mask_to_input(self.inputs, content_img_style_weight_mask_placeholder)
-                        self.image, self.skip_noise_list = skip_noise_4_feedforward_net.net(input_concatenated, reuse=True)
-                    else:
-                        self.image, self.skip_noise_list = skip_noise_4_feedforward_net.net(self.inputs, reuse=True)
-                else:
-                    raise AssertionError
-                self.image = vgg.preprocess(self.image, self.mean_pixel)
-
-            feed_dict = {}
+            feed_dict = {self.one_hot_style_vector: style_vectors}
 
-            if self.one_hot_style_vector is not None:
-                assert one_hot_vector_for_restore_and_generate is not None
-                feed_dict[self.one_hot_style_vector] = one_hot_vector_for_restore_and_generate
-
-            if self.use_johnson:
-                if self.use_semantic_masks:
-                    raise NotImplementedError
-                    # feed_dict[self.inputs] = mask_pre_list
-                elif self.style_only:
-                    feed_dict[self.inputs] = np.random.uniform(size=(self.input_shape[0], self.input_shape[1], self.input_shape[2], self.input_shape[3]))
-                else:
-                    feed_dict[self.inputs] = content_pre
-            elif self.use_skip_noise_4:
-                if self.use_semantic_masks:
-                    raise NotImplementedError
-                    # feed_dict[self.inputs] = mask_pre_list
-                elif self.style_only:
-                    feed_dict[self.inputs] = np.random.uniform(size=(self.input_shape[0], self.input_shape[1], self.input_shape[2], self.input_shape[3]))
-                else:
-                    feed_dict[self.inputs] = content_pre
+            if self.use_semantic_masks:
+                raise NotImplementedError
+                # feed_dict[self.inputs] = mask_pre_list
+            elif self.style_only:
+                feed_dict[self.inputs] = np.random.uniform(size=self.input_shape)
+            else:
+                feed_dict[self.inputs] = content_pre
+            if self.use_skip_noise_4:
                 for noise_i, skip_noise in enumerate(self.skip_noise_list):
                     skip_noise_shape = map(lambda i: i.value, skip_noise.get_shape())
-
-
                     feed_dict[skip_noise] = np.random.uniform(
                         size=(skip_noise_shape[0], skip_noise_shape[1], skip_noise_shape[2], skip_noise_4_feedforward_net.nums_noise[noise_i]))
-            else:
-                raise AssertionError
 
-            generated_image = self.image.eval(feed_dict=feed_dict, session=self.sess)
+            generated_images = self.image.eval(feed_dict=feed_dict, session=self.sess)
             # No need to unprocess the generated image because we've preprocessed the generated image before
             # feeding it to the network.
-            return scipy.misc.imresize(generated_image[0, :, :, :], (self.input_shape[1], self.input_shape[2]))
\ No newline at end of file
+            return [scipy.misc.imresize(generated_image, (self.input_shape[1], self.input_shape[2]))
+                    for generated_image in generated_images]
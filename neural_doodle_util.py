@@ -77,40 +77,32 @@ def masks_average_pool(masks):
 
 
 def gramian_with_mask(layer, masks):
-    # type: (Union[np.ndarray,tf.Tensor], tf.Tensor, bool) -> tf.Tensor
+    # type: (Union[np.ndarray,tf.Tensor], tf.Tensor) -> tf.Tensor
     """
     It computes the gramian of the given layer with given masks. Each mask will have its independent gramian for that
-    layer.
+    layer. The gramians of all masks and all batches are computed in one batched matrix multiplication.
     :param layer: The vgg feature layer with shape (num_batch, height, width, num_features)
     :param masks: mask with shape (num_batch, height, width, num_masks)
     :return: a tensor with dimension gramians of dimension (num_masks, num_batch, num_features, num_features)
     """
-    mask_list = tf.unpack(masks, axis=3) # A list of masks with dimension (1,height, width)
-
-    gram_list = []
-
-    for mask in mask_list:
-        mask = tf.expand_dims(mask, dim=3)
-        layer_dotted_with_mask = vgg_layer_dot_mask(mask, layer)
-        layer_dotted_with_mask_gram = gramian(layer_dotted_with_mask)
-        # Normalization is very importantant here. Because otherwise there is no way to compare two gram matrices
-        # with different masks applied to them.
-        layer_dotted_with_mask_gram_normalized = layer_dotted_with_mask_gram / (tf.reduce_mean(mask) + 0.000001) # Avoid division by zero.
-        gram_list.append(layer_dotted_with_mask_gram_normalized)
-    grams = tf.pack(gram_list)
-
-    if isinstance(layer, np.ndarray):
-        _, _, _, num_features = layer.shape
-    else:
-        _,_,_,num_features  =  map(lambda i: i.value, layer.get_shape())
-
-    number_colors,_, gram_height, gram_width,  = map(lambda i: i.value, grams.get_shape())
-
-    assert num_features == gram_height
-    assert num_features == gram_width
-    assert number_colors == len(mask_list)
-
-    return grams
+    layer = tf.convert_to_tensor(layer, dtype=tf.float32)
+    masks = tf.convert_to_tensor(masks, dtype=tf.float32)
+    _, height, width, num_features = map(lambda i: i.value, layer.get_shape())
+    num_masks = masks.get_shape()[3].value
+    size = height * width * num_features
+
+    # The features with shape (num_batch, 1, height * width, num_features) times the masks with shape
+    # (num_batch, num_masks, height * width, 1) gives the features dotted with each mask.
+    feats = tf.expand_dims(tf.reshape(layer, (-1, height * width, num_features)), 1)
+    masks_flat = tf.expand_dims(tf.transpose(tf.reshape(masks, (-1, height * width, num_masks)), perm=[0, 2, 1]), 3)
+    layer_dotted_with_masks = tf.mul(feats, masks_flat)
+    # Shape (num_batch, num_masks, num_features, num_features).
+    grams = tf.batch_matmul(layer_dotted_with_masks, layer_dotted_with_masks, adj_x=True) / size
+    # Normalization is very importantant here. Because otherwise there is no way to compare two gram matrices
+    # with different masks applied to them.
+    mask_means = tf.reduce_mean(masks, [0, 1, 2]) + 0.000001  # Avoid division by zero.
+    grams = grams / tf.reshape(mask_means, (1, num_masks, 1, 1))
+    return tf.transpose(grams, perm=[1, 0, 2, 3])
 
 
 def construct_masks_and_features(style_semantic_masks, styles, style_features, batch_size, height, width, semantic_masks_num_layers, style_layer_names, net_layer_sizes, semantic_masks_weight, vgg_data, mean_pixel, mask_resize_as_feature, use_mrf, average_pool = False):
@@ -161,7 +153,7 @@ def construct_masks_and_features(style_semantic_masks, styles, style_features, b
                                  'off. Otherwise it is not possible to treat it as an image and pass it through the '
                                  'vgg network.')
         content_semantic_mask_pre = vgg.preprocess(output_semantic_mask_placeholder, mean_pixel)
-        semantic_mask_net, _ = vgg.pre_read_net(vgg_data, content_semantic_mask_pre)
+        semantic_mask_net = vgg.pre_read_net(vgg_data, content_semantic_mask_pre, required_layers=style_layer_names)
         for layer in style_layer_names:
             output_semantic_mask_feature = semantic_mask_net[layer] * semantic_masks_weight
             output_semantic_mask_features[layer] = output_semantic_mask_feature
@@ -179,7 +171,8 @@ def construct_masks_and_features(style_semantic_masks, styles, style_features, b
         if not mask_resize_as_feature:
             style_semantic_masks_pres.append(
                 np.array([vgg.preprocess(style_semantic_masks[i], mean_pixel)]))
-            semantic_mask_net, _ = vgg.pre_read_net(vgg_data, style_semantic_masks_pres[-1])
+            semantic_mask_net = vgg.pre_read_net(vgg_data, style_semantic_masks_pres[-1],
+                                                 required_layers=style_layer_names)
         else:
             style_semantic_masks_for_each_layer.append(
                 masks_average_pool(style_semantic_masks_placeholders[-1]))
@@ -32,6 +32,32 @@ class NeuralDoodleUtilTest(tf.test.TestCase):
             actual_output = masked_gramian.eval(feeddict)
             np.testing.assert_almost_equal(actual_output, expected_output, decimal=4)
 
+    def test_gramian_with_mask_multiple_masks_and_batches(self):
+        with self.test_session():
+            batch_size = 2
+            height = 4
+            width = 3
+            num_features = 5
+            num_masks = 3
+            size = height * width * num_features * 1.0
+
+            init_input_layer = np.random.rand(batch_size, height, width, num_features).astype(np.float32)
+            init_masks = np.random.rand(batch_size, height, width, num_masks).astype(np.float32)
+            init_masks[..., 2] = 0  # An empty mask.
+            input_layer = tf.placeholder(dtype=tf.float32, shape=(batch_size, height, width, num_features))
+            masks = tf.placeholder(dtype=tf.float32, shape=(batch_size, height, width, num_masks))
+            masked_gramian = gramian_with_mask(input_layer, masks)
+
+            expected_output = np.zeros((num_masks, batch_size, num_features, num_features))
+            for mask_i in range(num_masks):
+                mask_mean = np.mean(init_masks[..., mask_i]) + 0.000001
+                for batch_i in range(batch_size):
+                    masked_features = (init_input_layer[batch_i] * init_masks[batch_i, :, :, mask_i:mask_i + 1]) \
+                        .reshape((height * width, num_features))
+                    expected_output[mask_i, batch_i] = np.dot(masked_features.T, masked_features) / size / mask_mean
+            actual_output = masked_gramian.eval({input_layer: init_input_layer, masks: init_masks})
+            np.testing.assert_almost_equal(actual_output, expected_output, decimal=4)
+
 
 if __name__ == '__main__':
     tf.test.main()
@@ -3,7 +3,8 @@
 from argparse import ArgumentParser
 
 from general_util import *
-from stylize import stylize
+from stylize import stylize, stylize_tiled, EarlyStopping, OPTIMIZERS
+from mrf_util import MRF_BLOCK_SIZE, MRF_MATCHERS
 
 # default arguments
 CONTENT_WEIGHT = 5e0
@@ -17,6 +18,11 @@ ITERATIONS = 1000
 PRINT_ITERATIONS = 100
 CHECKPOINT_ITERATIONS = 100
 VGG_PATH = 'imagenet-vgg-verydeep-19.mat'
+STYLE_FEATURES_CACHE_DIR = 'style_features_cache/'
+OPTIMIZER = 'adam'
+PYRAMID_LEVELS = 1
+STOP_WINDOW = 100
+TILE_OVERLAP = 64
 
 
 def build_parser():
@@ -78,6 +84,42 @@ def build_parser():
                         dest='use_mrf', help='If true, it uses Markov Random Fields loss instead of Gramian loss. '
                                              '(default %(default)s).', action='store_true')
     parser.set_defaults(use_mrf=False)
+    parser.add_argument('--mrf-block-size', type=int,
+                        dest='mrf_block_size', help='The number of style patches matched at a time by the mrf loss. '
+                                                    'Lower it if mrf runs out of memory with large images '
+                                                    '(default %(default)s).',
+                        metavar='MRF_BLOCK_SIZE', default=MRF_BLOCK_SIZE)
+    parser.add_argument('--mrf-matcher', type=str, choices=MRF_MATCHERS,
+                        dest='mrf_matcher', help='How the mrf loss finds the nearest style patches. "patchmatch" keeps '
+                                                 'the matches between iterations and only refines them, which is much '
+                                                 'faster for large images. It does not work with the lbfgs '
+                                                 'optimizer (default %(default)s).',
+                        metavar='MRF_MATCHER', default='exact')
+    parser.add_argument('--mrf-style-stride', type=int,
+                        dest='mrf_style_stride', help='Only use every n-th style patch in each direction in the mrf '
+                                                      'loss (default %(default)s).',
+                        metavar='MRF_STYLE_STRIDE', default=1)
+    parser.add_argument('--mrf-max-style-patches', type=int,
+                        dest='mrf_max_style_patches', help='If set, the mrf loss uses a random subset of at most this '
+                                                           'many style patches per layer.',
+                        metavar='MRF_MAX_STYLE_PATCHES')
+    parser.add_argument('--mrf-deduplicate-threshold', type=float,
+                        dest='mrf_deduplicate_threshold', help='If set, drop style patches whose cosine similarity '
+                                                               'with another style patch is above this, e.g. '
+                                                               '0.999. Only near-exact duplicates are reliably '
+                                                               'removed.',
+                        metavar='MRF_DEDUPLICATE_THRESHOLD')
+    parser.add_argument('--mrf-pool-styles',
+                        dest='mrf_pool_styles', help='If set, pool the patches of all style images and match them in '
+                                                     'one pass instead of one pass per style image.',
+                        action='store_true')
+    parser.set_defaults(mrf_pool_styles=False)
+    parser.add_argument('--no-blend-style-grams',
+                        dest='blend_style_grams', help='If set, compare the output against the gramian of each style '
+                                                       'image separately instead of against one blended gramian. The '
+                                                       'gradients are the same but each iteration is slower with '
+                                                       'multiple style images.', action='store_false')
+    parser.set_defaults(blend_style_grams=True)
     parser.add_argument('--content-weight', type=float,
                         dest='content_weight', help='How much we weigh the content loss (default %(default)s).',
                         metavar='CONTENT_WEIGHT', default=CONTENT_WEIGHT)
@@ -94,6 +136,16 @@ def build_parser():
     parser.add_argument('--learning-rate', type=float,
                         dest='learning_rate', help='Learning rate (default %(default)s).',
                         metavar='LEARNING_RATE', default=LEARNING_RATE)
+    parser.add_argument('--optimizer', type=str, choices=OPTIMIZERS,
+                        dest='optimizer', help='The optimizer to use. lbfgs usually needs far fewer iterations than '
+                                               'adam. (default %(default)s).',
+                        metavar='OPTIMIZER', default=OPTIMIZER)
+    parser.add_argument('--pyramid-levels', type=int,
+                        dest='pyramid_levels', help='If larger than 1, stylize at lower resolutions first and use the '
+                                                    'upsampled result as the initial image of the next level. The '
+                                                    'coarsest level runs ITERATIONS iterations and each finer level '
+                                                    'runs a quarter of that. (default %(default)s).',
+                        metavar='PYRAMID_LEVELS', default=PYRAMID_LEVELS)
     parser.add_argument('--initial',
                         dest='initial', help='The initial image that the program starts with. If left blank, it will '
                                              'start with random noise.',
@@ -106,6 +158,37 @@ def build_parser():
                         dest='checkpoint_iterations', help='The program saves the current image every this number of '
                                                            'rounds.',
                         metavar='CHECKPOINT_ITERATIONS', default=CHECKPOINT_ITERATIONS, required=False)
+    parser.add_argument('--style-features-cache-dir',
+                        dest='style_features_cache_dir', help='The directory to cache the precomputed style features '
+                                                              'in. Set it to an empty string to disable the cache. '
+                                                              '(default %(default)s).',
+                        metavar='STYLE_FEATURES_CACHE_DIR', default=STYLE_FEATURES_CACHE_DIR, required=False)
+    parser.add_argument('--stop-window', type=int,
+                        dest='stop_window', help='The number of iterations over which the loss improvement is '
+                                                 'measured for early stopping. (default %(default)s).',
+                        metavar='STOP_WINDOW', default=STOP_WINDOW, required=False)
+    parser.add_argument('--stop-relative-tolerance', type=float,
+                        dest='stop_relative_tolerance', help='Stop early if the loss improved by less than this '
+                                                             'fraction of itself over the stop window.',
+                        metavar='STOP_RELATIVE_TOLERANCE', required=False)
+    parser.add_argument('--stop-absolute-tolerance', type=float,
+                        dest='stop_absolute_tolerance', help='Stop early if the loss improved by less than this '
+                                                             'amount over the stop window.',
+                        metavar='STOP_ABSOLUTE_TOLERANCE', required=False)
+    parser.add_argument('--time-budget', type=float,
+                        dest='time_budget', help='Stop early after this many seconds.',
+                        metavar='TIME_BUDGET', required=False)
+    parser.add_argument('--tile-size', type=int,
+                        dest='tile_size', help='If set, the output is stylized in overlapping tiles of this size, so '
+                                               'that outputs too large to fit in memory can be stylized. ITERATIONS is '
+                                               'then the number of iterations for each tile. It does not support mrf, '
+                                               'semantic masks, the style weight mask, the lbfgs optimizer or '
+                                               '--no-blend-style-grams.',
+                        metavar='TILE_SIZE', required=False)
+    parser.add_argument('--tile-overlap', type=int,
+                        dest='tile_overlap', help='The minimum overlap in pixels between neighboring tiles. '
+                                                  '(default %(default)s).',
+                        metavar='TILE_OVERLAP', default=TILE_OVERLAP, required=False)
     return parser
 
 
@@ -164,26 +247,63 @@ def main():
         parser.error("To save intermediate images, the checkpoint output "
                      "parameter must contain `%s` (e.g. `foo%s.jpg`)")
 
+    if options.use_mrf and options.mrf_matcher == 'patchmatch' and options.optimizer == 'lbfgs':
+        parser.error("The patchmatch mrf matcher does not work with the lbfgs optimizer.")
+
     checkpoint_dir = os.path.dirname(options.checkpoint_output)
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
+
+    early_stopping = None
+    if options.stop_relative_tolerance is not None or options.stop_absolute_tolerance is not None or \
+                    options.time_budget is not None:
+        early_stopping = EarlyStopping(window=options.stop_window,
+                                       relative_tolerance=options.stop_relative_tolerance,
+                                       absolute_tolerance=options.stop_absolute_tolerance,
+                                       time_budget=options.time_budget)
+
     output_dir = os.path.dirname(options.output)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for iteration, image in stylize(network=options.network, content=content_image, styles=style_images,
-                                    shape=target_shape, iterations=options.iterations,
-                                    content_weight=options.content_weight, style_weight=options.style_weight,
-                                    tv_weight=options.tv_weight, style_blend_weights=style_blend_weights,
-                                    learning_rate=options.learning_rate, initial=initial, use_mrf=options.use_mrf,
-                                    use_semantic_masks=options.use_semantic_masks,
-                                    output_semantic_mask=output_semantic_mask,
-                                    style_semantic_masks=style_semantic_masks,
-                                    semantic_masks_weight=options.semantic_masks_weight,
-                                    print_iterations=options.print_iterations,
-                                    checkpoint_iterations=options.checkpoint_iterations,
-                                    semantic_masks_num_layers=options.semantic_masks_num_layers,
-                                    content_img_style_weight_mask=content_img_style_weight_mask):
+    if options.tile_size:
+        if options.use_mrf or options.use_semantic_masks or content_img_style_weight_mask is not None:
+            parser.error("Tiled mode does not support mrf, semantic masks or the style weight mask.")
+        if options.optimizer != 'adam' or not options.blend_style_grams:
+            parser.error("Tiled mode only supports the adam optimizer with blended style gramians.")
+        stylize_iterator = stylize_tiled(network=options.network, content=content_image, styles=style_images,
+                                         shape=target_shape, iterations=options.iterations,
+                                         tile_size=options.tile_size, tile_overlap=options.tile_overlap,
+                                         content_weight=options.content_weight, style_weight=options.style_weight,
+                                         tv_weight=options.tv_weight, style_blend_weights=style_blend_weights,
+                                         learning_rate=options.learning_rate, initial=initial,
+                                         print_iterations=options.print_iterations,
+                                         style_features_cache_dir=options.style_features_cache_dir or None,
+                                         early_stopping=early_stopping, pyramid_levels=options.pyramid_levels)
+    else:
+        stylize_iterator = stylize(network=options.network, content=content_image, styles=style_images,
+                                   shape=target_shape, iterations=options.iterations,
+                                   content_weight=options.content_weight, style_weight=options.style_weight,
+                                   tv_weight=options.tv_weight, style_blend_weights=style_blend_weights,
+                                   learning_rate=options.learning_rate, initial=initial, use_mrf=options.use_mrf,
+                                   use_semantic_masks=options.use_semantic_masks,
+                                   output_semantic_mask=output_semantic_mask,
+                                   style_semantic_masks=style_semantic_masks,
+                                   semantic_masks_weight=options.semantic_masks_weight,
+                                   print_iterations=options.print_iterations,
+                                   checkpoint_iterations=options.checkpoint_iterations,
+                                   semantic_masks_num_layers=options.semantic_masks_num_layers,
+                                   content_img_style_weight_mask=content_img_style_weight_mask,
+                                   style_features_cache_dir=options.style_features_cache_dir or None,
+                                   optimizer=options.optimizer, pyramid_levels=options.pyramid_levels,
+                                   early_stopping=early_stopping, blend_style_grams=options.blend_style_grams,
+                                   mrf_block_size=options.mrf_block_size, mrf_matcher=options.mrf_matcher,
+                                   mrf_style_stride=options.mrf_style_stride,
+                                   mrf_max_style_patches=options.mrf_max_style_patches,
+                                   mrf_deduplicate_threshold=options.mrf_deduplicate_threshold,
+                                   mrf_pool_styles=options.mrf_pool_styles)
+
+    for iteration, image in stylize_iterator:
         output_file = None
         if iteration is not None:
             if options.checkpoint_output:
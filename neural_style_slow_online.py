@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from typing import Union, Tuple
+
+import memory_util
 from general_util import *
-from stylize import stylize
+from stylize import stylize, stylize_tiled, EarlyStopping, StylizeEngine, CONTENT_LAYER, STYLE_LAYERS_WITH_CONTENT
 
 # default arguments
 # TODO: Consider giving user options to specify those parameters (not a good idea in general but good for debugging)
@@ -19,6 +22,35 @@ CHECKPOINT_ITERATIONS = 100
 VGG_PATH = 'imagenet-vgg-verydeep-19.mat'
 MAX_HEIGHT = 1024
 MAX_WIDTH = 1024
+# The memory budget of one job in bytes. Jobs estimated to need more are tiled or run with smaller style images, or as
+# a last resort produce a smaller output.
+MEMORY_LIMIT = 4 * 1024 ** 3
+STYLE_FEATURES_CACHE_DIR = 'style_features_cache/'
+# Set this to larger than 1 to stylize large outputs coarse-to-fine. The engine is not used in pyramid mode.
+PYRAMID_LEVELS = 1
+# Stop a job once the loss improved by less than 0.1% over the last 100 iterations, or after the time budget (seconds).
+STOP_WINDOW = 100
+STOP_RELATIVE_TOLERANCE = 0.001
+TIME_BUDGET = None
+
+# The engine of the last request. It is reused as long as the next request has the same output shape, which saves
+# rebuilding the graph and reloading the vgg network.
+_stylize_engine = None  # type: Union[None,StylizeEngine]
+
+
+def get_stylize_engine(shape, use_content):
+    # type: (Tuple[int,int,int,int], bool) -> StylizeEngine
+    """
+    :return: A StylizeEngine for the given configuration. The engine is reused if the last request had the same one.
+    """
+    global _stylize_engine
+    if _stylize_engine is None or _stylize_engine.shape != shape or _stylize_engine.use_content != use_content:
+        if _stylize_engine is not None:
+            _stylize_engine.close()
+            _stylize_engine = None
+        _stylize_engine = StylizeEngine(VGG_PATH, shape, use_content=use_content,
+                                        learning_rate=LEARNING_RATE, style_features_cache_dir=STYLE_FEATURES_CACHE_DIR)
+    return _stylize_engine
 
 
 def slow_stylize(content_dir, style_dirs, output, style_blend_weights = None, initial = None, content_img_style_weight_mask_dir = None, checkpoint_output = None):
@@ -47,6 +79,23 @@ def slow_stylize(content_dir, style_dirs, output, style_blend_weights = None, in
             
     style_images = read_and_resize_images(style_dirs, None, None)  # We don't need to resize style images.
 
+    # Picks a mode that fits in memory before building any graph. Tiled mode does not support style weight masks.
+    use_style_weight_mask = bool(content_img_style_weight_mask_dir)
+    plan = memory_util.plan_stylize(content_image.shape[0], content_image.shape[1],
+                                    [style_image.shape[:2] for style_image in style_images], MEMORY_LIMIT,
+                                    STYLE_LAYERS_WITH_CONTENT, CONTENT_LAYER, can_tile=not use_style_weight_mask)
+    print('Memory plan: %s' % str(plan))
+    if plan.style_scale != 1.0:
+        style_images = [np_resize_image(style_image, max(1, int(style_image.shape[0] * plan.style_scale)),
+                                        max(1, int(style_image.shape[1] * plan.style_scale)))
+                        for style_image in style_images]
+    if plan.output_scale != 1.0:
+        new_height = max(1, int(content_image.shape[0] * plan.output_scale))
+        new_width = max(1, int(content_image.shape[1] * plan.output_scale))
+        print('Warning: the output does not fit in the memory limit. It is scaled down from %dx%d to %dx%d.'
+              % (content_image.shape[0], content_image.shape[1], new_height, new_width))
+        content_image = np_resize_image(content_image, new_height, new_width)
+
     target_shape = (1, int(content_image.shape[0]), int(content_image.shape[1]), 3)
 
     if style_blend_weights is None:
@@ -79,7 +128,7 @@ def slow_stylize(content_dir, style_dirs, output, style_blend_weights = None, in
         initial = imread(initial, shape=(content_image.shape[0], content_image.shape[1]))
 
     content_img_style_weight_mask = None
-    if content_img_style_weight_mask_dir and content_img_style_weight_mask_dir != '':
+    if use_style_weight_mask:
         content_img_style_weight_mask = (
             read_and_resize_bw_mask_images([content_img_style_weight_mask_dir], content_image.shape[0], content_image.shape[1], 1,
                                            1))
@@ -95,19 +144,44 @@ def slow_stylize(content_dir, style_dirs, output, style_blend_weights = None, in
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for iteration, image in stylize(network=VGG_PATH, content=content_image, styles=style_images,
-                                    shape=target_shape, iterations=ITERATIONS,
-                                    content_weight=CONTENT_WEIGHT, style_weight=STYLE_WEIGHT,
-                                    tv_weight=TV_WEIGHT, style_blend_weights=style_blend_weights,
-                                    learning_rate=LEARNING_RATE, initial=initial, use_mrf=False,
-                                    use_semantic_masks=False,
-                                    output_semantic_mask=output_semantic_mask,
-                                    style_semantic_masks=style_semantic_masks,
-                                    semantic_masks_weight=SEMANTIC_MASKS_WEIGHT,
-                                    print_iterations=PRINT_ITERATIONS,
-                                    checkpoint_iterations=CHECKPOINT_ITERATIONS,
-                                    semantic_masks_num_layers=SEMANTIC_MASKS_NUM_LAYERS,
-                                    content_img_style_weight_mask=content_img_style_weight_mask):
+    early_stopping = EarlyStopping(window=STOP_WINDOW, relative_tolerance=STOP_RELATIVE_TOLERANCE,
+                                   time_budget=TIME_BUDGET)
+    if plan.tile_size is not None:
+        stylize_iterator = stylize_tiled(network=VGG_PATH, content=content_image, styles=style_images,
+                                         shape=target_shape, iterations=ITERATIONS, tile_size=plan.tile_size,
+                                         content_weight=CONTENT_WEIGHT, style_weight=STYLE_WEIGHT,
+                                         tv_weight=TV_WEIGHT, style_blend_weights=style_blend_weights,
+                                         learning_rate=LEARNING_RATE, initial=initial,
+                                         print_iterations=PRINT_ITERATIONS,
+                                         style_features_cache_dir=STYLE_FEATURES_CACHE_DIR,
+                                         early_stopping=early_stopping, pyramid_levels=plan.pyramid_levels)
+    elif content_img_style_weight_mask is None and PYRAMID_LEVELS == 1:
+        engine = get_stylize_engine(target_shape, content_image is not None)
+        stylize_iterator = engine.stylize(content=content_image, styles=style_images, iterations=ITERATIONS,
+                                          content_weight=CONTENT_WEIGHT, style_weight=STYLE_WEIGHT,
+                                          tv_weight=TV_WEIGHT, style_blend_weights=style_blend_weights,
+                                          initial=initial, print_iterations=PRINT_ITERATIONS,
+                                          checkpoint_iterations=CHECKPOINT_ITERATIONS,
+                                          early_stopping=early_stopping)
+    else:
+        # The engine does not support style weight masks or pyramid mode.
+        stylize_iterator = stylize(network=VGG_PATH, content=content_image, styles=style_images,
+                                   shape=target_shape, iterations=ITERATIONS,
+                                   content_weight=CONTENT_WEIGHT, style_weight=STYLE_WEIGHT,
+                                   tv_weight=TV_WEIGHT, style_blend_weights=style_blend_weights,
+                                   learning_rate=LEARNING_RATE, initial=initial, use_mrf=False,
+                                   use_semantic_masks=False,
+                                   output_semantic_mask=output_semantic_mask,
+                                   style_semantic_masks=style_semantic_masks,
+                                   semantic_masks_weight=SEMANTIC_MASKS_WEIGHT,
+                                   print_iterations=PRINT_ITERATIONS,
+                                   checkpoint_iterations=CHECKPOINT_ITERATIONS,
+                                   semantic_masks_num_layers=SEMANTIC_MASKS_NUM_LAYERS,
+                                   content_img_style_weight_mask=content_img_style_weight_mask,
+                                   style_features_cache_dir=STYLE_FEATURES_CACHE_DIR,
+                                   pyramid_levels=PYRAMID_LEVELS, early_stopping=early_stopping)
+
+    for iteration, image in stylize_iterator:
         output_file = None
         if iteration is not None:
             if checkpoint_output:
@@ -8,6 +8,13 @@ import tensorflow as tf
 from typing import Union, Tuple, List, Dict
 
 import vgg
+from general_util import get_np_arrays_digest, load_np_arrays_from_cache, save_np_arrays_to_cache
+
+# precompute_images_features passes style images with the same shape through vgg together until the batch has this many
+# pixels. A batch then never needs more memory than one 1024x1024 style image passed alone, and large style images are
+# passed one at a time as before.
+MAX_STYLE_BATCH_NUM_PIXELS = 1024 * 1024
+MAX_STYLE_BATCH_SIZE = 8
 
 
 def get_tensor_num_elements(tensor):
@@ -61,22 +68,16 @@ def instance_norm(input_layer, name='instance_norm', reuse=False):
     :return: a tensor with shape (batch_size, height, width, num_features) with the normalization applied.
     """
     with tf.variable_scope(name, reuse=reuse):
-        input_layers = tf.unpack(input_layer)
-        return_val = []
         num_channels = input_layer.get_shape().as_list()[3]
         # The scale and offset variable is reused for all batches in this norm.
         scale = tf.get_variable('scale', [num_channels], tf.float32, tf.random_uniform_initializer())
         offset = tf.get_variable('offset', [num_channels], tf.float32, tf.constant_initializer())
-        for l in input_layers:
-            l = tf.expand_dims(l, 0)
-            # NOTE: Tensorflow norm has some issues when the actual variance is near zero. I have to apply abs on it.
-            mean, variance = tf.nn.moments(l, [0, 1, 2])
-            variance = tf.abs(variance)
-            variance_epsilon = 0.001
-            return_val.append(
-                tf.squeeze(tf.nn.batch_normalization(l, mean, variance, offset, scale, variance_epsilon, name=name),
-                           [0]))
-        return_val = tf.pack(return_val)
+        # The moments of each sample have shape (batch_size, 1, 1, num_features) and are broadcast against the layer.
+        mean, variance = tf.nn.moments(input_layer, [1, 2], keep_dims=True)
+        # NOTE: Tensorflow norm has some issues when the actual variance is near zero. I have to apply abs on it.
+        variance = tf.abs(variance)
+        variance_epsilon = 0.001
+        return_val = tf.nn.batch_normalization(input_layer, mean, variance, offset, scale, variance_epsilon, name=name)
         return return_val
 
 
@@ -85,31 +86,27 @@ def conditional_instance_norm(input_layer, input_style_placeholder, name='condit
     """
     Instance-normalize the layer conditioned on the style as in https://arxiv.org/abs/1610.07629
     :param input_layer: tensor with shape (batch_size, height, width, num_features)
-    :param input_style_placeholder: a one hot vector (1 x N tensor) with length N where N is the number of different
-    style images.
+    :param input_style_placeholder: a style vector with shape (1, N) shared by the whole batch, or a matrix with shape
+    (batch_size, N) with one style vector per sample, where N is the number of different style images. The vectors are
+    usually one hot but may also be a mix of several styles.
     :param name: name of the variable scope
     :param reuse: reuse variables if set to true. Otherwise create new ones.
     :return: a tensor with shape (batch_size, height, width, num_features) with the normalization applied.
     """
     with tf.variable_scope(name, reuse=reuse):
-        input_layers = tf.unpack(input_layer)
-        return_val = []
         num_styles = input_style_placeholder.get_shape().as_list()[1]
         num_channels = input_layer.get_shape().as_list()[3]
         scale = tf.get_variable('scale', [num_styles, num_channels], tf.float32, tf.random_uniform_initializer())
         offset = tf.get_variable('offset', [num_styles, num_channels], tf.float32, tf.constant_initializer())
-        scale_for_current_style = tf.matmul(input_style_placeholder, scale)
-        offset_for_current_style = tf.matmul(input_style_placeholder, offset)
-        for l in input_layers:
-            l = tf.expand_dims(l, 0)
-            # NOTE: Tensorflow norm has some issues when the actual variance is near zero. I have to apply abs on it.
-            mean, variance = tf.nn.moments(l, [0, 1, 2])
-            variance = tf.abs(variance)
-            variance_epsilon = 0.001
-            return_val.append(tf.squeeze(tf.nn.batch_normalization(
-                l, mean, variance, offset_for_current_style, scale_for_current_style, variance_epsilon, name=name),
-                [0]))
-        return_val = tf.pack(return_val)
+        # Shape (1 or batch_size, 1, 1, num_features) so that they broadcast against the layer.
+        scale_for_current_style = tf.reshape(tf.matmul(input_style_placeholder, scale), [-1, 1, 1, num_channels])
+        offset_for_current_style = tf.reshape(tf.matmul(input_style_placeholder, offset), [-1, 1, 1, num_channels])
+        mean, variance = tf.nn.moments(input_layer, [1, 2], keep_dims=True)
+        # NOTE: Tensorflow norm has some issues when the actual variance is near zero. I have to apply abs on it.
+        variance = tf.abs(variance)
+        variance_epsilon = 0.001
+        return_val = tf.nn.batch_normalization(input_layer, mean, variance, offset_for_current_style,
+                                               scale_for_current_style, variance_epsilon, name=name)
         return return_val
 
 
@@ -120,17 +117,13 @@ def gramian(layer):
     :return: The gramian of the layer -- a tensor with dimension gramians of dimension (batches, channels, channels)
     """
     # Instead of iterating over #channels width by height matrices and computing similarity, we vectorize and compute
-    # the entire gramian in a single matrix multiplication.
+    # the gramians of the entire batch in a single batched matrix multiplication.
     _, height, width, number = map(lambda i: i.value, layer.get_shape())
     size = height * width * number
-    layer_unpacked = tf.unpack(layer)
-    grams = []
-    for single_layer in layer_unpacked:
-        feats = tf.reshape(single_layer, (-1, number))
-        # Note: the normalization factor might be wrong. I've seen many different forms of normalization. The current
-        # one works though.
-        grams.append(tf.matmul(tf.transpose(feats), feats) / size)
-    return tf.pack(grams)
+    feats = tf.reshape(layer, (-1, height * width, number))
+    # Note: the normalization factor might be wrong. I've seen many different forms of normalization. The current
+    # one works though.
+    return tf.batch_matmul(feats, feats, adj_x=True) / size
 
 
 def total_variation(image_batch):
@@ -165,37 +158,107 @@ def total_variation(image_batch):
     return total_var
 
 
-def precompute_image_features(img, layers, shape, vgg_data, mean_pixel, use_mrf, use_semantic_masks):
-    # type: (np.ndarray, Union[Tuple[str], List[str]], Union[Tuple[int], List[int]], Dict[str, np.ndarray], List[float], bool, bool) -> Dict[str, np.ndarray]
+def get_image_features_cache_key(img, layers, shape, vgg_data, mean_pixel, use_mrf, use_semantic_masks):
+    # type: (np.ndarray, Union[Tuple[str], List[str]], Union[Tuple[int], List[int]], Dict[str, np.ndarray], List[float], bool, bool) -> str
+    """
+    :return: The key under which precompute_image_features caches the features of this image. It changes whenever the
+    image, its shape, the layers, the mrf/semantic masks flags or the vgg weights change. See
+    precompute_image_features for the meaning of each parameter.
+    """
+    return get_np_arrays_digest(np.asarray(img, dtype=np.float32), tuple(shape), tuple(layers),
+                                np.asarray(mean_pixel, dtype=np.float32), bool(use_mrf), bool(use_semantic_masks),
+                                vgg.get_weights_digest(vgg_data))
+
+
+def precompute_image_features(img, layers, shape, vgg_data, mean_pixel, use_mrf, use_semantic_masks, cache_dir=None):
+    # type: (np.ndarray, Union[Tuple[str], List[str]], Union[Tuple[int], List[int]], Dict[str, np.ndarray], List[float], bool, bool, Union[None,str]) -> Dict[str, np.ndarray]
     """
     Precompute the features of the image by passing it through the vgg network and storing the computed layers.
     :param img: the image of which the features would be precomputed. It must have shape (height, width, 3)
     :param layers: A list of string specifying which layers would we be returning. Check vgg.py for layer names.
-    :param shape: shape of the image placeholder.
-    :param vgg_data: The vgg network represented as a dictionary. It can be obtained by vgg.pre_read_net.
+    :param shape: shape of the image placeholder. It must be (1,) + img.shape.
+    :param vgg_data: The vgg network represented as a dictionary. It can be obtained by vgg.read_net.
     :param mean_pixel: The mean pixel value for the vgg network. It can be obtained by vgg.read_net or just hardcoded.
     :param use_mrf: Whether we're using mrf loss. If true, it does not calculate and store the gram matrix.
     :param use_semantic_masks: Whether we're using semantic masks. If true, it does not calculate and store the gram
     matrix.
+    :param cache_dir: If not None, the features are looked up in this directory before running the vgg network and
+    saved there (as .npy files) after computing them, so that the next run with the same image and settings skips the
+    vgg network entirely.
     :return: A dictionary containing the precomputed feature for each layer.
     """
-    features_dict = {}
-    g = tf.Graph()
-    # Choose to use cpu here because we only need to compute this once and using cpu would provide us more memory
-    # than the gpu and therefore allow us to process larger style images using the extra memory. This will not have
-    # an effect on the training speed later since the gram matrix size is not related to the size of the image.
-    with g.as_default(), g.device('/cpu:0'), tf.Session():
-        image = tf.placeholder('float', shape=shape)
-        net = vgg.pre_read_net(vgg_data, image)
-        style_pre = np.array([vgg.preprocess(img, mean_pixel)])
-        for layer in layers:
-            if use_mrf or use_semantic_masks:
-                features = net[layer].eval(feed_dict={image: style_pre})
-                features_dict[layer] = features
-            else:
-                # Calculate and store gramian.
-                features = net[layer].eval(feed_dict={image: style_pre})
-                features = np.reshape(features, (-1, features.shape[3]))
-                gram = np.matmul(features.T, features) / features.size
-                features_dict[layer] = gram
-    return features_dict
+    if tuple(shape) != (1,) + tuple(img.shape):
+        raise AssertionError('The shape of the image placeholder %s does not match the shape of the image %s.'
+                             % (str(shape), str(img.shape)))
+    return precompute_images_features([img], layers, vgg_data, mean_pixel, use_mrf, use_semantic_masks,
+                                      cache_dir=cache_dir)[0]
+
+
+def get_style_batch_size(height, width, num_imgs, max_batch_size=MAX_STYLE_BATCH_SIZE):
+    # type: (int, int, int, int) -> int
+    """
+    :param height: The height of the style images.
+    :param width: The width of the style images.
+    :param num_imgs: The number of style images with that shape.
+    :param max_batch_size: The maximum number of images in one batch.
+    :return: The number of style images with that shape that precompute_images_features passes through vgg at once.
+    """
+    return max(1, min(num_imgs, max_batch_size, MAX_STYLE_BATCH_NUM_PIXELS // (height * width)))
+
+
+def precompute_images_features(imgs, layers, vgg_data, mean_pixel, use_mrf, use_semantic_masks, cache_dir=None,
+                               max_batch_size=MAX_STYLE_BATCH_SIZE):
+    # type: (List[np.ndarray], Union[Tuple[str], List[str]], Dict[str, np.ndarray], List[float], bool, bool, Union[None,str], int) -> List[Dict[str, np.ndarray]]
+    """
+    Batched version of precompute_image_features. Images with the same shape share one graph and are passed through
+    the vgg network together, and all layers are fetched in a single session.run, so each image costs a fraction of one
+    vgg forward pass instead of one pass per layer. For the meaning of the other parameters please refer to
+    precompute_image_features.
+    :param imgs: A list of images of which the features would be precomputed. Each must have shape (height, width, 3)
+    but they do not need to have the same shape.
+    :param max_batch_size: The maximum number of images passed through the vgg network at once. Batches are also
+    limited to MAX_STYLE_BATCH_NUM_PIXELS pixels, see get_style_batch_size.
+    :return: A list containing one dictionary of precomputed features for each image.
+    """
+    features_dicts = [None for _ in imgs]
+    cache_keys = [None for _ in imgs]
+    # Group the images that are not cached yet by their shape.
+    img_indices_per_shape = {}
+    for img_i, img in enumerate(imgs):
+        if cache_dir is not None:
+            cache_keys[img_i] = get_image_features_cache_key(img, layers, (1,) + img.shape, vgg_data, mean_pixel,
+                                                             use_mrf, use_semantic_masks)
+            features_dicts[img_i] = load_np_arrays_from_cache(cache_dir, cache_keys[img_i], layers)
+        if features_dicts[img_i] is None:
+            img_indices_per_shape.setdefault(img.shape, []).append(img_i)
+
+    for img_shape, img_indices in img_indices_per_shape.items():
+        g = tf.Graph()
+        # Choose to use cpu here because we only need to compute this once and using cpu would provide us more memory
+        # than the gpu and therefore allow us to process larger style images using the extra memory. This will not
+        # have an effect on the training speed later since the gram matrix size is not related to the size of the
+        # image.
+        with g.as_default(), g.device('/cpu:0'), tf.Session() as sess:
+            image = tf.placeholder('float', shape=(None,) + img_shape)
+            net = vgg.pre_read_net(vgg_data, image, required_layers=layers)
+            layer_tensors = [net[layer] for layer in layers]
+            batch_size = get_style_batch_size(img_shape[0], img_shape[1], len(img_indices), max_batch_size)
+            for batch_start in range(0, len(img_indices), batch_size):
+                batch_img_indices = img_indices[batch_start:batch_start + batch_size]
+                batch_pre = np.array([vgg.preprocess(imgs[img_i], mean_pixel) for img_i in batch_img_indices])
+                batch_features = sess.run(layer_tensors, feed_dict={image: batch_pre})
+                for batch_i, img_i in enumerate(batch_img_indices):
+                    features_dict = {}
+                    for layer, layer_features in zip(layers, batch_features):
+                        features = layer_features[batch_i:batch_i + 1]
+                        if use_mrf or use_semantic_masks:
+                            features_dict[layer] = features
+                        else:
+                            # Calculate and store gramian.
+                            features = np.reshape(features, (-1, features.shape[3]))
+                            gram = np.matmul(features.T, features) / features.size
+                            features_dict[layer] = gram
+                    features_dicts[img_i] = features_dict
+                    if cache_dir is not None:
+                        save_np_arrays_to_cache(cache_dir, cache_keys[img_i], features_dict)
+    return features_dicts
@@ -1,4 +1,5 @@
 from neural_util import *
+from vgg_test import get_fake_conv_weights
 
 
 class SquareTest(tf.test.TestCase):
@@ -27,6 +28,73 @@ class SquareTest(tf.test.TestCase):
             expected_output = np.concatenate((input_tensor_init,content_img_style_weight_mask_init), axis=3)
             np.testing.assert_array_equal(actual_output, expected_output)
 
+    def test_get_style_batch_size(self):
+        self.assertEqual(get_style_batch_size(256, 256, 3), 3)
+        self.assertEqual(get_style_batch_size(256, 256, 100), MAX_STYLE_BATCH_SIZE)
+        self.assertEqual(get_style_batch_size(512, 512, 100), 4)
+        self.assertEqual(get_style_batch_size(2048, 2048, 8), 1)
+        self.assertEqual(get_style_batch_size(256, 256, 3, max_batch_size=1), 1)
+
+    def test_precompute_images_features(self):
+        conv_weights = get_fake_conv_weights()
+        mean_pixel = np.array([1.0, 2.0, 3.0])
+        layers = ('relu1_1', 'relu2_1')
+        imgs = [np.random.rand(8, 8, 3), np.random.rand(6, 4, 3), np.random.rand(8, 8, 3)]
+        for use_mrf in (False, True):
+            actual_output = precompute_images_features(imgs, layers, conv_weights, mean_pixel, use_mrf, False,
+                                                       max_batch_size=1)
+            actual_output_batched = precompute_images_features(imgs, layers, conv_weights, mean_pixel, use_mrf, False)
+            for img_i, img in enumerate(imgs):
+                expected_output = precompute_image_features(img, layers, (1,) + img.shape, conv_weights, mean_pixel,
+                                                            use_mrf, False)
+                for layer in layers:
+                    np.testing.assert_allclose(actual_output[img_i][layer], expected_output[layer], rtol=1e-4)
+                    np.testing.assert_allclose(actual_output_batched[img_i][layer], expected_output[layer], rtol=1e-4)
+
+    def test_gramian(self):
+        with self.test_session():
+            layer_init = np.random.rand(3, 4, 5, 6).astype(np.float32)
+            layer = tf.placeholder(tf.float32, shape=(None, 4, 5, 6))
+            actual_output = gramian(layer).eval(feed_dict={layer: layer_init})
+            feats = layer_init.reshape((3, 20, 6))
+            expected_output = np.array([np.dot(feats[i].T, feats[i]) for i in range(3)]) / (4 * 5 * 6)
+            np.testing.assert_allclose(actual_output, expected_output, rtol=1e-5)
+
+    def test_instance_norm(self):
+        with self.test_session() as sess:
+            layer_init = np.random.rand(3, 4, 5, 6).astype(np.float32)
+            layer = tf.placeholder(tf.float32, shape=(None, 4, 5, 6))
+            output = instance_norm(layer)
+            sess.run(tf.initialize_all_variables())
+            with tf.variable_scope('instance_norm', reuse=True):
+                scale = tf.get_variable('scale').eval()
+            actual_output = output.eval(feed_dict={layer: layer_init})
+            mean = layer_init.mean(axis=(1, 2), keepdims=True)
+            variance = layer_init.var(axis=(1, 2), keepdims=True)
+            expected_output = (layer_init - mean) / np.sqrt(variance + 0.001) * scale
+            np.testing.assert_allclose(actual_output, expected_output, rtol=1e-4, atol=1e-5)
+
+    def test_conditional_instance_norm(self):
+        with self.test_session() as sess:
+            layer_init = np.random.rand(2, 4, 5, 6).astype(np.float32)
+            style_init = np.array([[1, 0, 0], [0, 0.5, 0.5]], dtype=np.float32)
+            layer = tf.placeholder(tf.float32, shape=(None, 4, 5, 6))
+            style = tf.placeholder(tf.float32, shape=(None, 3))
+            output = conditional_instance_norm(layer, style)
+            sess.run(tf.initialize_all_variables())
+            with tf.variable_scope('conditional_instance_norm', reuse=True):
+                scale = tf.get_variable('scale').eval()
+            actual_output = output.eval(feed_dict={layer: layer_init, style: style_init})
+            mean = layer_init.mean(axis=(1, 2), keepdims=True)
+            variance = layer_init.var(axis=(1, 2), keepdims=True)
+            expected_output = (layer_init - mean) / np.sqrt(variance + 0.001) * \
+                              np.dot(style_init, scale).reshape((2, 1, 1, 6))
+            np.testing.assert_allclose(actual_output, expected_output, rtol=1e-4, atol=1e-5)
+            # A single style vector is shared by the whole batch.
+            actual_output = output.eval(feed_dict={layer: layer_init, style: style_init[:1]})
+            expected_output = (layer_init - mean) / np.sqrt(variance + 0.001) * scale[0]
+            np.testing.assert_allclose(actual_output, expected_output, rtol=1e-4, atol=1e-5)
+
     # TODO: add unit tests for each function, but I'm too lazy to manually compute the gramian/variation etc.
 
 if __name__ == '__main__':
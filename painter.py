@@ -22,12 +22,10 @@ class Painter(object):
         imsave(self.outdir + id_str + u"_" + unicode(0) + u".jpg", output)
 
     def batch_colorize(self,id_str):
-        for style_i in range(38):
-            one_hot_style_vector = np.zeros((1,38))
-            one_hot_style_vector[0,style_i] = 1
-
-            # one_hot_style_vector = np.array([style_weights])
-            output = self.painter.stylize(os.path.join('./static/images/line/', id_str + '.png'), one_hot_style_vector)
+        # Each row is the one hot vector of one style. All styles are rendered in one forward pass.
+        one_hot_style_vectors = np.identity(38)
+        outputs = self.painter.batch_stylize(os.path.join('./static/images/line/', id_str + '.png'), one_hot_style_vectors)
+        for style_i, output in enumerate(outputs):
             imsave(self.outdir + id_str + u"_" + unicode(style_i) + u".jpg", output)
 
 
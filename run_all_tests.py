@@ -9,6 +9,9 @@ from mrf_util_test import *
 from johnson_feedforward_net_util_test import *
 from general_util_test import *
 from conv_util_test import *
+from vgg_test import *
+from stylize_test import *
+from memory_util_test import *
 import unittest
 
 # Not importing the following util test because it will require human input to verify the effect of the function.
@@ -10,17 +10,19 @@ weighted mask for the content image ("content_img_style_weight_mask" in the code
 The code skeleton was borrowed from https://github.com/anishathalye/neural-style.
 """
 
+import collections
+import time
 from sys import stderr
 
 import numpy as np
 import tensorflow as tf
-from typing import Union, Tuple, List, Iterable
+from typing import Union, Tuple, List, Iterable, Dict
 
 import neural_doodle_util
 import neural_util
 import vgg
-from general_util import get_np_array_num_elements
-from mrf_util import mrf_loss
+from general_util import get_np_array_num_elements, np_resize_image
+from mrf_util import mrf_loss, create_style_patch_bank, MRF_BLOCK_SIZE, MRF_MATCHERS, MRF_PATCH_SIZE
 
 try:
     reduce
@@ -31,14 +33,86 @@ CONTENT_LAYER = 'relu4_2'
 STYLE_LAYERS = ('relu1_1', 'relu2_1', 'relu3_1', 'relu4_1', 'relu5_1')  # This is used for texture generation (without content)
 STYLE_LAYERS_WITH_CONTENT = ('relu1_1', 'relu2_1', 'relu3_1', 'relu4_1', 'relu5_1')
 STYLE_LAYERS_MRF = ('relu3_1', 'relu4_1')  # According to https://arxiv.org/abs/1601.04589.
+# Same as the initial STYLE_LAYERS. stylize rebinds STYLE_LAYERS, so the functions building their own graph use this.
+STYLE_LAYERS_WITHOUT_CONTENT = ('relu1_1', 'relu2_1', 'relu3_1', 'relu4_1', 'relu5_1')
+OPTIMIZERS = ('adam', 'lbfgs')
+
+
+class EarlyStopping(object):
+    """
+    A stopping policy that decides whether the optimization has converged from the loss of each training step. It stops
+    when the loss improved by less than the tolerances over the last 'window' steps, or when the wall-clock budget runs
+    out. The time budget is counted from the creation of the object, so create a new one for each job.
+    """
+
+    def __init__(self, window=100, relative_tolerance=None, absolute_tolerance=None, time_budget=None):
+        # type: (int, Union[None,float], Union[None,float], Union[None,float]) -> None
+        """
+        :param window: The number of steps over which the loss improvement is measured.
+        :param relative_tolerance: Stop if the loss improved by less than this fraction of itself over the window.
+        :param absolute_tolerance: Stop if the loss improved by less than this amount over the window.
+        :param time_budget: Stop after this many seconds.
+        """
+        if window <= 0:
+            raise AssertionError("The early stopping window must be positive. It is now %d" % window)
+        self.window = window
+        self.relative_tolerance = relative_tolerance
+        self.absolute_tolerance = absolute_tolerance
+        self.time_budget = time_budget
+        self.start_time = time.time()
+        self.losses = collections.deque(maxlen=window + 1)
+
+    def reset(self):
+        # type: () -> None
+        """
+        Forgets the loss history. It is called at the start of each optimization.
+        """
+        self.losses.clear()
+
+    def split(self, time_budget_fraction):
+        # type: (float) -> EarlyStopping
+        """
+        Used to give a share of the time budget to one part of a job that runs several optimizations one after another,
+        such as a pyramid level or a tile, so that the first parts can not use up the whole budget.
+        :param time_budget_fraction: The share of the remaining time budget given to the part.
+        :return: A new EarlyStopping with the same tolerances, whose time budget is that share of the remaining time
+        budget and starts now. The time the part leaves unused stays in the remaining budget of this one.
+        """
+        time_budget = None
+        if self.time_budget is not None:
+            remaining_time = max(0.0, self.time_budget - (time.time() - self.start_time))
+            time_budget = remaining_time * time_budget_fraction
+        return EarlyStopping(window=self.window, relative_tolerance=self.relative_tolerance,
+                             absolute_tolerance=self.absolute_tolerance, time_budget=time_budget)
+
+    def update(self, loss):
+        # type: (float) -> bool
+        """
+        :param loss: The loss of the current step.
+        :return: True if the optimization should stop.
+        """
+        if self.time_budget is not None and time.time() - self.start_time >= self.time_budget:
+            return True
+        self.losses.append(loss)
+        if len(self.losses) <= self.window:
+            return False
+        improvement = self.losses[0] - self.losses[-1]
+        if self.relative_tolerance is not None and improvement < self.relative_tolerance * abs(self.losses[0]):
+            return True
+        if self.absolute_tolerance is not None and improvement < self.absolute_tolerance:
+            return True
+        return False
 
 
 def stylize(network, content, styles, shape, iterations, content_weight=5.0, style_weight=100.0, tv_weight=100.0,
             style_blend_weights=None, learning_rate=10.0, initial=None, use_mrf=False, use_semantic_masks=False,
             mask_resize_as_feature=True, output_semantic_mask=None, style_semantic_masks=None,
             semantic_masks_weight=1.0, print_iterations=None, checkpoint_iterations=None,
-            semantic_masks_num_layers=4, content_img_style_weight_mask=None):
-    # type: (str, Union[None,np.ndarray], List[np.ndarray], Tuple[int,int,int,int], int, float, float, float, Union[None,List[float]], float, Union[None,np.ndarray], bool, bool, bool, Union[None,np.ndarray], Union[None,List[np.ndarray], float, Union[None,int], Union[None,int], Union[None,int], Union[None,np.ndarray], Union[None,int]]) -> Iterable[Tuple[Union[None,int],np.ndarray]]
+            semantic_masks_num_layers=4, content_img_style_weight_mask=None, style_features_cache_dir=None,
+            optimizer='adam', pyramid_levels=1, pyramid_iterations=None, early_stopping=None, blend_style_grams=True,
+            mrf_block_size=MRF_BLOCK_SIZE, mrf_matcher='exact', mrf_style_stride=1, mrf_max_style_patches=None,
+            mrf_deduplicate_threshold=None, mrf_pool_styles=False):
+    # type: (str, Union[None,np.ndarray], List[np.ndarray], Tuple[int,int,int,int], int, float, float, float, Union[None,List[float]], float, Union[None,np.ndarray], bool, bool, bool, Union[None,np.ndarray], Union[None,List[np.ndarray], float, Union[None,int], Union[None,int], Union[None,int], Union[None,np.ndarray], Union[None,int]], Union[None,str], str, int, Union[None,List[int]], Union[None,EarlyStopping], bool, Union[None,int], str, int, Union[None,int], Union[None,float], bool) -> Iterable[Tuple[Union[None,int],np.ndarray]]
     """
     Stylize images.
     :param network: Path to pretrained vgg19 network. It can be downloaded at
@@ -55,7 +129,7 @@ def stylize(network, content, styles, shape, iterations, content_weight=5.0, sty
     :param tv_weight: The weight for total-variation loss. The larger the weight, the smoother the output will be.
     :param style_blend_weights: If inputting multiple style images, this controls the balance between their styles.
     If left as None, it will treat all style images as equal.
-    :param learning_rate: As name suggests.
+    :param learning_rate: As name suggests. It is only used by the adam optimizer.
     :param initial: The initial starting point for the output. If left blank, the initial would just be noise.
     :param use_mrf: Whether we use markov-random-field loss instead of gramian loss. mrf_util.py contains more info.
     :param use_semantic_masks: Whether we use semantic masks as additional semantic information. Please check the paper
@@ -79,6 +153,43 @@ def stylize(network, content, styles, shape, iterations, content_weight=5.0, sty
     completely white mask would mean that we stylize the output image just as before, while a completely dark mask
     would mean that we do not stylize the output image at all, so it should look pretty much the same as content image.
     If you do not wish to use this feature, just leave it as None.
+    :param style_features_cache_dir: If not None, the precomputed style features are cached in this directory so that
+    running the same style images again skips passing them through the vgg network.
+    :param optimizer: One of OPTIMIZERS. 'adam' takes one adam step per iteration. 'lbfgs' uses scipy's L-BFGS-B, where
+    one iteration is one L-BFGS iteration. It usually needs far fewer iterations than adam to reach the same loss.
+    L-BFGS is run from one checkpoint to the next, so its history is restarted at every checkpoint.
+    :param pyramid_levels: If larger than 1, the image is first stylized at 1/2^(pyramid_levels-1) of the output size,
+    then the result is upsampled and used as the initial image of the next level, whose size is doubled, until it
+    reaches the output size. Most of the structure converges at the cheap low resolution levels. Only the checkpoints
+    of the last (full resolution) level are yielded.
+    :param pyramid_iterations: The number of iterations of each pyramid level, from the coarsest to the finest. If left
+    as None, the coarsest level runs 'iterations' iterations and each finer level runs a quarter of the level before.
+    :param early_stopping: If not None, an EarlyStopping that can end the optimization before 'iterations' iterations.
+    With adam it is updated with the loss of every training step, with lbfgs with the loss at every checkpoint. When
+    it stops, the best image so far is yielded as the final one. In pyramid mode the tolerances apply to every level
+    and the time budget is split between the levels in proportion to their cost (iterations times pixels), so the
+    coarse levels can not use up the budget of the full resolution level. Time a level leaves unused goes to the finer
+    levels.
+    :param blend_style_grams: If true and using the gramian style loss, the gramians of all style images are blended
+    into one target per layer, sum_i(w_i * G_i) / sum_i(w_i). Since sum_i(w_i * |G - G_i|^2) equals
+    sum_i(w_i) * |G - blended target|^2 plus a constant, the gradients are exactly the same as comparing against each
+    style separately, but each iteration costs the same as with one style image. The reported style loss is lower by
+    that constant.
+    :param mrf_block_size: The number of style patches matched at a time by the mrf loss. Lower it if mrf runs out of
+    memory with large images. If None, all style patches are matched at once.
+    :param mrf_matcher: One of MRF_MATCHERS. 'exact' compares every generated patch with every style patch in every
+    iteration. 'patchmatch' keeps the matches between iterations and refines them with a few candidates per patch,
+    which is much faster for large images but needs some iterations before the matches are good. It only works with
+    the adam optimizer.
+    :param mrf_style_stride: Only every mrf_style_stride-th style patch in each direction is used by the mrf loss.
+    :param mrf_max_style_patches: If not None, the mrf loss uses a random subset of at most this many style patches per
+    layer (per style image unless mrf_pool_styles is true).
+    :param mrf_deduplicate_threshold: If not None, style patches whose cosine similarity with another style patch is
+    above this are dropped. The duplicates are found approximately, so only near-exact duplicates (e.g. 0.999) are
+    reliably removed. See mrf_util.deduplicate_style_patches.
+    :param mrf_pool_styles: If true, the patches of all style images are pooled into one bank per layer and matched in
+    one pass, so multiple style images cost about the same as one. Each generated patch is then matched with the
+    closest patch of any style image and style_blend_weights only scale the loss as a whole.
     :return: a tuple where the first item is either the current iteration or None, indicating it has finished training.
     The second item is the image that has the lowest loss so far. The tuples are yielded every 'checkpoint_iterations'
     iterations as well as the last iteration.
@@ -103,14 +214,68 @@ def stylize(network, content, styles, shape, iterations, content_weight=5.0, sty
                 content_img_style_weight_mask.dtype))
     if len(styles) == 0:
         raise AssertionError("Must feed in at least one style image.")
+    if optimizer not in OPTIMIZERS:
+        raise AssertionError("Unknown optimizer %s. It must be one of %s." % (optimizer, str(OPTIMIZERS)))
+    if mrf_matcher not in MRF_MATCHERS:
+        raise AssertionError("Unknown mrf matcher %s. It must be one of %s." % (mrf_matcher, str(MRF_MATCHERS)))
+    if use_mrf and mrf_matcher == 'patchmatch' and optimizer == 'lbfgs':
+        # The patchmatch matcher refines its matches every time the loss is evaluated, so the loss changes between the
+        # evaluations of one line search and L-BFGS-B can not converge.
+        raise AssertionError("The patchmatch mrf matcher does not work with the lbfgs optimizer. Use adam instead.")
 
-    # Append a (1,) in front of the shapes of the style images. So the style_shapes contains (1, height, width, 3).
-    # 3 corresponds to rgb.
-    style_shapes = [(1,) + style.shape for style in styles]
     if style_blend_weights is None:
         style_blend_weights = [1.0 / len(styles) for _ in styles]
+
+    if pyramid_levels > 1:
+        if pyramid_iterations is None:
+            pyramid_iterations = get_pyramid_iterations(iterations, pyramid_levels)
+        if len(pyramid_iterations) != pyramid_levels:
+            raise AssertionError("pyramid_iterations must have one item for each of the %d pyramid levels."
+                                 % pyramid_levels)
+        height, width = shape[1], shape[2]
+        # The cost of each level relative to the finest one. Each level has a quarter of the pixels of the next one.
+        level_costs = [pyramid_iterations[level] * 0.25 ** (pyramid_levels - 1 - level)
+                       for level in range(pyramid_levels)]
+        for level in range(pyramid_levels):
+            level_height = max(1, int(round(height * 0.5 ** (pyramid_levels - 1 - level))))
+            level_width = max(1, int(round(width * 0.5 ** (pyramid_levels - 1 - level))))
+            if initial is not None:
+                initial = np_resize_image(initial, level_height, level_width)
+            if level == pyramid_levels - 1:
+                break
+            stderr.write('Pyramid level %d/%d with size %dx%d\n' % (level + 1, pyramid_levels, level_height,
+                                                                      level_width))
+            level_content = np_resize_image(content, level_height, level_width) if content is not None else None
+            level_output_semantic_mask = np_resize_image(output_semantic_mask, level_height, level_width) \
+                if output_semantic_mask is not None else None
+            level_style_weight_mask = np_resize_image(content_img_style_weight_mask, level_height, level_width) \
+                if content_img_style_weight_mask is not None else None
+            level_early_stopping = None
+            if early_stopping is not None:
+                level_early_stopping = early_stopping.split(level_costs[level] / sum(level_costs[level:]))
+            for _, initial in stylize(network, level_content, styles, (shape[0], level_height, level_width, shape[3]),
+                                      pyramid_iterations[level], content_weight=content_weight,
+                                      style_weight=style_weight, tv_weight=tv_weight,
+                                      style_blend_weights=style_blend_weights, learning_rate=learning_rate,
+                                      initial=initial, use_mrf=use_mrf, use_semantic_masks=use_semantic_masks,
+                                      mask_resize_as_feature=mask_resize_as_feature,
+                                      output_semantic_mask=level_output_semantic_mask,
+                                      style_semantic_masks=style_semantic_masks,
+                                      semantic_masks_weight=semantic_masks_weight, print_iterations=print_iterations,
+                                      semantic_masks_num_layers=semantic_masks_num_layers,
+                                      content_img_style_weight_mask=level_style_weight_mask,
+                                      style_features_cache_dir=style_features_cache_dir, optimizer=optimizer,
+                                      early_stopping=level_early_stopping, blend_style_grams=blend_style_grams,
+                                      mrf_block_size=mrf_block_size, mrf_matcher=mrf_matcher,
+                                      mrf_style_stride=mrf_style_stride,
+                                      mrf_max_style_patches=mrf_max_style_patches,
+                                      mrf_deduplicate_threshold=mrf_deduplicate_threshold,
+                                      mrf_pool_styles=mrf_pool_styles):
+                pass
+        iterations = pyramid_iterations[-1]
+        stderr.write('Pyramid level %d/%d with size %dx%d\n' % (pyramid_levels, pyramid_levels, height, width))
+
     content_features = {}
-    style_features = [{} for _ in styles]
     output_semantic_mask_features = {}
 
     # The default behavior of tensorflow was to allocate all gpu memory. Here it is set to only use as much gpu memory
@@ -121,27 +286,41 @@ def stylize(network, content, styles, shape, iterations, content_weight=5.0, sty
 
         # Compute content features in feed-forward mode
         content_image = tf.placeholder('float', shape=shape, name='content_image')
-        net = vgg.pre_read_net(vgg_data, content_image)
+        # Only the layers used by the losses are built. Everything deeper is skipped.
+        required_layers = (CONTENT_LAYER,) + tuple(STYLE_LAYERS)
+        net = vgg.pre_read_net(vgg_data, content_image, required_layers=required_layers)
         content_features[CONTENT_LAYER] = net[CONTENT_LAYER]
         net_layer_sizes = vgg.get_net_layer_sizes(net)
 
         if content is not None:
             content_pre = np.array([vgg.preprocess(content, mean_pixel)])
+            # The content features never change, so they are evaluated once here and used as a constant in the loss.
+            # Otherwise the content image would be fed and passed through vgg again in every iteration.
+            content_features[CONTENT_LAYER] = tf.constant(sess.run(net[CONTENT_LAYER],
+                                                                   feed_dict={content_image: content_pre}))
 
         # Compute style features in feed-forward mode.
         if content_img_style_weight_mask is not None:
             style_weight_mask_layer_dict = neural_doodle_util.masks_average_pool(content_img_style_weight_mask)
 
-        for i in range(len(styles)):
-            # Using precompute_image_features, which calculates on cpu and thus allow larger images.
-            style_features[i] = neural_util.precompute_image_features(styles[i], STYLE_LAYERS, style_shapes[i],
-                                                                      vgg_data, mean_pixel, use_mrf, use_semantic_masks)
+        # Using precompute_images_features, which calculates on cpu and thus allow larger images.
+        style_features = neural_util.precompute_images_features(styles, STYLE_LAYERS, vgg_data, mean_pixel, use_mrf,
+                                                                use_semantic_masks, cache_dir=style_features_cache_dir)
 
         if use_semantic_masks:
             output_semantic_mask_features, style_features, content_semantic_mask, style_semantic_masks_images = neural_doodle_util.construct_masks_and_features(
                 style_semantic_masks, styles, style_features, shape[0], shape[1], shape[2], semantic_masks_num_layers,
                 STYLE_LAYERS, net_layer_sizes, semantic_masks_weight, vgg_data, mean_pixel, mask_resize_as_feature,
                 use_mrf, average_pool=False)  # TODO: average pool is not working so well in practice??
+            # Same for the masks. The mask features and the masked style features are evaluated once and used as
+            # constants instead of being recomputed from the fed masks in every iteration.
+            mask_feed_dict = {content_semantic_mask: output_semantic_mask}
+            for styles_iter in range(len(styles)):
+                mask_feed_dict[style_semantic_masks_images[styles_iter]] = style_semantic_masks[styles_iter]
+            output_semantic_mask_features, style_features = sess.run([output_semantic_mask_features, style_features],
+                                                                     feed_dict=mask_feed_dict)
+            output_semantic_mask_features = {layer: tf.constant(features) for layer, features in
+                                             output_semantic_mask_features.iteritems()}
 
         if initial is None:
             initial = tf.random_normal(shape) * 0.256
@@ -149,7 +328,7 @@ def stylize(network, content, styles, shape, iterations, content_weight=5.0, sty
             initial = np.array([vgg.preprocess(initial, mean_pixel)])
             initial = initial.astype('float32')
         image = tf.Variable(initial)
-        net, _ = vgg.net(network, image)
+        net = vgg.pre_read_net(vgg_data, image, required_layers=required_layers)
 
         # content loss
         _, height, width, number = map(lambda i: i.value, content_features[CONTENT_LAYER].get_shape())
@@ -158,34 +337,78 @@ def stylize(network, content, styles, shape, iterations, content_weight=5.0, sty
             net[CONTENT_LAYER] - content_features[CONTENT_LAYER]) /
                                          content_features_size)
         # style loss
+        # The generated layers (and their gramians) do not depend on the style image, so they are built only once.
+        style_layers = {}
+        for style_layer in STYLE_LAYERS:
+            layer = net[style_layer]
+            if content_img_style_weight_mask is not None:
+                # Apply_style_weight_mask_to_feature_layer, then normalize with average of that style weight mask.
+                layer = neural_doodle_util.vgg_layer_dot_mask(style_weight_mask_layer_dict[style_layer], layer) \
+                        / (tf.reduce_mean(style_weight_mask_layer_dict[style_layer]) + 0.000001)
+            if use_mrf and use_semantic_masks:
+                # TODO: Compare the effect of concatenate masks to vgg layers versus dotting them with vgg
+                # layers. If you change this to dot, don't forget to also change that in neural_doodle_util.
+                layer = neural_doodle_util.concatenate_mask_layer_tf(output_semantic_mask_features[style_layer], layer)
+                # layer = neural_doodle_util.vgg_layer_dot_mask(output_semantic_mask_features[style_layer], layer)
+            style_layers[style_layer] = layer
+
         style_loss = 0
-        for i in range(len(styles)):
-            style_losses = []
+        if use_mrf:
+            subsample_style_patches = mrf_style_stride != 1 or mrf_max_style_patches is not None or \
+                                      mrf_deduplicate_threshold is not None
+
+            def get_mrf_style_patch_bank(style_indices, style_layer):
+                if not mrf_pool_styles and not subsample_style_patches:
+                    # mrf_loss builds the full bank from the style layer itself.
+                    return None
+                return create_style_patch_bank([style_features[i][style_layer] for i in style_indices],
+                                               MRF_PATCH_SIZE, stride=mrf_style_stride,
+                                               max_num_patches=mrf_max_style_patches,
+                                               deduplicate_threshold=mrf_deduplicate_threshold)
+
+            if mrf_pool_styles:
+                style_losses = []
+                for style_layer in STYLE_LAYERS:
+                    style_patch_bank = get_mrf_style_patch_bank(range(len(styles)), style_layer)
+                    style_losses.append(mrf_loss(None, style_layers[style_layer], name='pooled%s' % style_layer,
+                                                 style_patch_bank=style_patch_bank, block_size=mrf_block_size,
+                                                 matcher=mrf_matcher))
+                style_loss += style_weight * sum(style_blend_weights) * reduce(tf.add, style_losses)
+            else:
+                for i in range(len(styles)):
+                    style_losses = []
+                    for style_layer in STYLE_LAYERS:
+                        style_losses.append(mrf_loss(style_features[i][style_layer], style_layers[style_layer],
+                                                     name='%d%s' % (i, style_layer),
+                                                     style_patch_bank=get_mrf_style_patch_bank([i], style_layer),
+                                                     block_size=mrf_block_size, matcher=mrf_matcher))
+                    style_loss += style_weight * style_blend_weights[i] * reduce(tf.add, style_losses)
+        else:
+            grams = {}
             for style_layer in STYLE_LAYERS:
-                layer = net[style_layer]
-                if content_img_style_weight_mask is not None:
-                    # Apply_style_weight_mask_to_feature_layer, then normalize with average of that style weight mask.
-                    layer = neural_doodle_util.vgg_layer_dot_mask(style_weight_mask_layer_dict[style_layer], layer) \
-                            / (tf.reduce_mean(style_weight_mask_layer_dict[style_layer]) + 0.000001)
-
-                if use_mrf:
-                    if use_semantic_masks:
-                        # TODO: Compare the effect of concatenate masks to vgg layers versus dotting them with vgg
-                        # layers. If you change this to dot, don't forget to also change that in neural_doodle_util.
-                        layer = neural_doodle_util.concatenate_mask_layer_tf(output_semantic_mask_features[style_layer],
-                                                                             layer)
-                        # layer = neural_doodle_util.vgg_layer_dot_mask(output_semantic_mask_features[style_layer], layer)
-                    style_losses.append(mrf_loss(style_features[i][style_layer], layer, name='%d%s' % (i, style_layer)))
+                if use_semantic_masks:
+                    grams[style_layer] = neural_doodle_util.gramian_with_mask(
+                        style_layers[style_layer], output_semantic_mask_features[style_layer])
                 else:
-                    if use_semantic_masks:
-                        gram = neural_doodle_util.gramian_with_mask(layer, output_semantic_mask_features[style_layer])
-                    else:
-                        gram = neural_util.gramian(layer)
-                    style_gram = style_features[i][style_layer]
+                    grams[style_layer] = neural_util.gramian(style_layers[style_layer])
+            if blend_style_grams:
+                blended_style_grams, total_blend_weight = get_blended_style_grams(style_features, style_blend_weights,
+                                                                                  STYLE_LAYERS)
+                style_losses = []
+                for style_layer in STYLE_LAYERS:
+                    style_gram = blended_style_grams[style_layer]
                     style_gram_size = get_np_array_num_elements(style_gram)
-                    style_losses.append(tf.nn.l2_loss(
-                        gram - style_gram) / style_gram_size)  # TODO: Check normalization constants. the style loss is way too big compared to the other two.
-            style_loss += style_weight * style_blend_weights[i] * reduce(tf.add, style_losses)
+                    style_losses.append(tf.nn.l2_loss(grams[style_layer] - style_gram) / style_gram_size)
+                style_loss = style_weight * total_blend_weight * reduce(tf.add, style_losses)
+            else:
+                for i in range(len(styles)):
+                    style_losses = []
+                    for style_layer in STYLE_LAYERS:
+                        style_gram = style_features[i][style_layer]
+                        style_gram_size = get_np_array_num_elements(style_gram)
+                        style_losses.append(tf.nn.l2_loss(
+                            grams[style_layer] - style_gram) / style_gram_size)  # TODO: Check normalization constants. the style loss is way too big compared to the other two.
+                    style_loss += style_weight * style_blend_weights[i] * reduce(tf.add, style_losses)
         # total variation denoising
         tv_loss = tf.mul(neural_util.total_variation(image), tv_weight)
 
@@ -196,42 +419,578 @@ def stylize(network, content, styles, shape, iterations, content_weight=5.0, sty
             loss = content_loss + style_loss + tv_loss
 
         # optimizer setup
-        train_step = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        # The best image is tracked in the graph. Its update reads the image before the training step changes it.
+        best_image, update_best = get_best_image_tracker(loss, image)
+        if optimizer == 'adam':
+            with tf.control_dependencies([update_best]):
+                train_step = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        else:
+            # One scipy interface for the whole optimization, so that the gradient is built once and before the
+            # variables are initialized. Its step callback stops it at every checkpoint.
+            lbfgs_optimizer = tf.contrib.opt.ScipyOptimizerInterface(
+                loss, var_list=[image], method='L-BFGS-B', options={'maxiter': iterations})
+            lbfgs_image = tf.placeholder(tf.float32, shape=shape, name='lbfgs_image')
+            assign_lbfgs_image = image.assign(lbfgs_image)
+
+            def lbfgs_steps(num_steps):
+                """
+                Runs num_steps L-BFGS iterations, or fewer if it converges before that.
+                :return: True if L-BFGS converged.
+                """
+                num_steps_run = [0]
+
+                def step_callback(packed_image):
+                    num_steps_run[0] += 1
+                    if num_steps_run[0] >= num_steps:
+                        raise _LbfgsCheckpoint(packed_image)
 
-        def print_progress(i, feed_dict, last=False):
+                try:
+                    lbfgs_optimizer.minimize(sess, step_callback=step_callback)
+                except _LbfgsCheckpoint as checkpoint:
+                    # The interface only assigns the variables when scipy returns, so it is done here instead.
+                    sess.run(assign_lbfgs_image, feed_dict={lbfgs_image: checkpoint.packed_image.reshape(shape)})
+                    return False
+                return True
+
+        # The losses printed every print_iterations. They are fetched in the same session.run as the training step.
+        progress_losses = [('    style loss', style_loss), ('       tv loss', tv_loss), ('    total loss', loss)]
+        if content is not None:
+            progress_losses.insert(0, ('  content loss', content_loss))
+
+        def print_progress(i, progress_values):
             stderr.write('Iteration %d/%d\n' % (i + 1, iterations))
-            if last or (print_iterations is not None and print_iterations != 0 and i % print_iterations == 0):
-                if content is not None:
-                    stderr.write('  content loss: %g\n' % content_loss.eval(feed_dict=feed_dict))
-                stderr.write('    style loss: %g\n' % style_loss.eval(feed_dict=feed_dict))
-                stderr.write('       tv loss: %g\n' % tv_loss.eval(feed_dict=feed_dict))
-                stderr.write('    total loss: %g\n' % loss.eval(feed_dict=feed_dict))
+            for (name, _), value in zip(progress_losses, progress_values):
+                stderr.write('%s: %g\n' % (name, value))
 
         # optimization
-        best_loss = float('inf')
-        best = np.zeros(shape=shape)
-        feed_dict = {}
+        # Nothing is fed in the loop. All the static inputs are already constants in the graph.
+        sess.run(tf.initialize_all_variables())
+        # The mrf style patch banks and nearest neighbor fields.
+        sess.run(tf.initialize_local_variables())
+        if early_stopping is not None:
+            early_stopping.reset()
+        last_checkpoint = -1
+        for i in range(iterations):
+            last_step = (i == iterations - 1)
+            is_checkpoint = (checkpoint_iterations and i % checkpoint_iterations == 0) or last_step
+            is_print_step = last_step or (print_iterations and i % print_iterations == 0)
+            progress_fetches = [progress_loss for _, progress_loss in progress_losses] if is_print_step else []
+            if optimizer == 'adam':
+                fetched = sess.run([train_step, loss] + progress_fetches)
+                print_progress(i, fetched[2:])
+                if early_stopping is not None and early_stopping.update(fetched[1]):
+                    stderr.write('Converged at iteration %d/%d\n' % (i + 1, iterations))
+                    last_step = is_checkpoint = True
+                if last_step:
+                    # update_best runs before each training step, so the image after the final step is compared here.
+                    sess.run(update_best)
+            elif is_checkpoint:
+                # Runs all the L-BFGS iterations since the last checkpoint in one go, then records the best image and
+                # the losses in one forward pass.
+                if lbfgs_steps(i - last_checkpoint) and not last_step:
+                    stderr.write('L-BFGS converged at iteration %d/%d\n' % (i + 1, iterations))
+                    last_step = True
+                fetched = sess.run([update_best, loss] + progress_fetches)
+                print_progress(i, fetched[2:])
+                last_checkpoint = i
+                if early_stopping is not None and not last_step and early_stopping.update(fetched[1]):
+                    stderr.write('Converged at iteration %d/%d\n' % (i + 1, iterations))
+                    last_step = True
+
+            if is_checkpoint:
+                yield (
+                    (None if last_step else i),
+                    vgg.unprocess(sess.run(best_image).reshape(shape[1:]), mean_pixel)
+                )
+            if last_step:
+                break
+
+
+class _LbfgsCheckpoint(Exception):
+    """
+    Raised by the L-BFGS step callback in stylize to stop scipy at a checkpoint.
+    """
+
+    def __init__(self, packed_image):
+        # type: (np.ndarray) -> None
+        super(_LbfgsCheckpoint, self).__init__()
+        self.packed_image = packed_image
+
+
+def get_best_image_tracker(loss, image):
+    # type: (tf.Tensor, tf.Variable) -> Tuple[tf.Variable, tf.Operation]
+    """
+    Keeps track of the image with the lowest loss in the graph, so that no extra forward pass is needed to find it.
+    :param loss: The loss of the image.
+    :param image: The image variable being optimized.
+    :return: A variable holding the best image so far, and an op that updates it (and the best loss) with the current
+    image and loss.
+    """
+    best_loss = tf.Variable(float('inf'), trainable=False, name='best_loss')
+    best_image = tf.Variable(tf.zeros(image.get_shape()), trainable=False, name='best_image')
+    improved = tf.cast(tf.less(loss, best_loss), tf.float32)
+    # The best loss must only be overwritten after it was compared against.
+    with tf.control_dependencies([improved]):
+        update_best_loss = best_loss.assign(tf.minimum(loss, best_loss))
+    update_best = tf.group(update_best_loss, best_image.assign(improved * image + (1 - improved) * best_image))
+    return best_image, update_best
+
+
+def get_best_images_tracker(losses, images):
+    # type: (tf.Tensor, tf.Variable) -> Tuple[tf.Variable, tf.Operation]
+    """
+    The same as get_best_image_tracker, but for a batch of independent images, each with its own loss.
+    :param losses: The loss of each image, with shape (batch_size,).
+    :param images: The image variable being optimized, with shape (batch_size, height, width, 3).
+    :return: A variable holding the best version of each image so far, and an op that updates it (and the best losses)
+    with the current images and losses.
+    """
+    batch_size = images.get_shape().as_list()[0]
+    best_losses = tf.Variable(tf.fill([batch_size], float('inf')), trainable=False, name='best_losses')
+    best_images = tf.Variable(tf.zeros(images.get_shape()), trainable=False, name='best_images')
+    improved = tf.reshape(tf.cast(tf.less(losses, best_losses), tf.float32), [batch_size, 1, 1, 1])
+    # The best losses must only be overwritten after they were compared against.
+    with tf.control_dependencies([improved]):
+        update_best_losses = best_losses.assign(tf.minimum(losses, best_losses))
+    update_best = tf.group(update_best_losses, best_images.assign(improved * images + (1 - improved) * best_images))
+    return best_images, update_best
+
+
+def get_blended_style_grams(style_features, style_blend_weights, style_layers):
+    # type: (List[Dict[str,np.ndarray]], List[float], Iterable[str]) -> Tuple[Dict[str,np.ndarray], float]
+    """
+    :param style_features: The precomputed gramians of each style image.
+    :param style_blend_weights: The weight of each style image.
+    :param style_layers: The names of the style layers.
+    :return: The weighted mean of the style gramians for each layer, and the sum of the weights.
+    """
+    total_blend_weight = float(sum(style_blend_weights))
+    if total_blend_weight <= 0:
+        raise AssertionError("The style blend weights must have a positive sum to be blended. They are now %s"
+                             % str(style_blend_weights))
+    blended_style_grams = {}
+    for style_layer in style_layers:
+        blended_style_grams[style_layer] = sum(
+            weight * features[style_layer] for features, weight in zip(style_features, style_blend_weights)) \
+                                           / total_blend_weight
+    return blended_style_grams, total_blend_weight
+
+
+def get_pyramid_iterations(iterations, pyramid_levels):
+    # type: (int, int) -> List[int]
+    """
+    :return: The default number of iterations for each pyramid level, from the coarsest to the finest. The coarsest
+    level runs 'iterations' iterations and each finer level, being four times as expensive per iteration, runs a quarter
+    of the level before.
+    """
+    return [max(1, iterations // (4 ** level)) for level in range(pyramid_levels)]
+
+
+def stylize_batch(network, contents, styles, shape, iterations, content_weight=5.0, style_weight=100.0, tv_weight=100.0,
+                  style_blend_weights=None, learning_rate=10.0, initials=None, print_iterations=None,
+                  checkpoint_iterations=None, style_features_cache_dir=None):
+    # type: (str, List[Union[None,np.ndarray]], List[List[np.ndarray]], Tuple[int,int,int,int], int, float, float, float, Union[None,List[List[float]]], float, Union[None,List[Union[None,np.ndarray]]], Union[None,int], Union[None,int], Union[None,str]) -> Iterable[Tuple[Union[None,int],List[np.ndarray]]]
+    """
+    Stylize several independent jobs with the same output size at once. All jobs share one graph, one vgg network and
+    one optimizer, and each image in the batch is optimized against its own content and style images. The loss of one
+    job does not depend on the other images and Adam updates every element independently, so each job ends up with the
+    same result as if it were run through stylize alone, but the convolutions run on the whole batch. Only the gramian
+    style loss is supported (no mrf, semantic masks or style weight masks).
+    :param network: Path to pretrained vgg19 network.
+    :param contents: A list with one content image per job. An item can be None to do texture generation for that job.
+    :param styles: A list with one list of style images per job.
+    :param shape: The shape of the output images. It should be with format (number of jobs, height, width, 3)
+    :param style_blend_weights: A list with one list of style blend weights per job. If left as None, the style images
+    of each job are treated as equal.
+    :param initials: A list with one initial image (or None for noise) per job. If left as None, all jobs start with
+    noise.
+    For the other parameters, please refer to stylize.
+    :return: The same as stylize, except that the second item is a list with the best image so far for each job.
+    :rtype: iterator[tuple[int|None,list[image]]]
+    """
+    num_jobs = shape[0]
+    if len(contents) != num_jobs or len(styles) != num_jobs:
+        raise AssertionError("The number of content images (%d) and style image lists (%d) must be the same as the "
+                             "batch size %d in shape." % (len(contents), len(styles), num_jobs))
+    for job_styles in styles:
+        if len(job_styles) == 0:
+            raise AssertionError("Must feed in at least one style image for each job.")
+    if style_blend_weights is None:
+        style_blend_weights = [[1.0 / len(job_styles) for _ in job_styles] for job_styles in styles]
+    if initials is None:
+        initials = [None for _ in range(num_jobs)]
+    if any(content is not None for content in contents):
+        style_layers = STYLE_LAYERS_WITH_CONTENT
+    else:
+        style_layers = STYLE_LAYERS_WITHOUT_CONTENT
+
+    with tf.Graph().as_default(), tf.Session(
+            config=tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))) as sess:
+        vgg_data, mean_pixel = vgg.read_net(network)
+        required_layers = (CONTENT_LAYER,) + tuple(style_layers)
+
+        # The style images of all jobs go through the vgg network together.
+        all_style_features = neural_util.precompute_images_features(
+            [style for job_styles in styles for style in job_styles], style_layers, vgg_data, mean_pixel, False, False,
+            cache_dir=style_features_cache_dir)
+
+        # Texture generation jobs get a blank content image, which is never used in their loss.
+        content_pre = np.zeros(shape, dtype=np.float32)
+        initial = np.random.normal(scale=0.256, size=shape).astype(np.float32)
+        for job_i in range(num_jobs):
+            if contents[job_i] is not None:
+                content_pre[job_i] = vgg.preprocess(contents[job_i], mean_pixel)
+            if initials[job_i] is not None:
+                initial[job_i] = vgg.preprocess(initials[job_i], mean_pixel)
+        content_image = tf.placeholder('float', shape=shape, name='content_image')
+        content_net = vgg.pre_read_net(vgg_data, content_image, required_layers=(CONTENT_LAYER,))
+        # The content features are evaluated once and used as a constant in the loss.
+        content_features = tf.constant(sess.run(content_net[CONTENT_LAYER], feed_dict={content_image: content_pre}))
+
+        image = tf.Variable(initial)
+        net = vgg.pre_read_net(vgg_data, image, required_layers=required_layers)
+        # Gramians of the whole batch with shape (num_jobs, num_features, num_features).
+        grams = {style_layer: neural_util.gramian(net[style_layer]) for style_layer in style_layers}
+
+        _, height, width, number = map(lambda i: i.value, content_net[CONTENT_LAYER].get_shape())
+        content_features_size = height * width * number
+        job_losses = []
+        style_i = 0
+        for job_i in range(num_jobs):
+            job_image = tf.slice(image, [job_i, 0, 0, 0], [1, -1, -1, -1])
+            job_loss = tf.mul(neural_util.total_variation(job_image), tv_weight)
+            if contents[job_i] is not None:
+                job_content_layer = tf.slice(net[CONTENT_LAYER], [job_i, 0, 0, 0], [1, -1, -1, -1])
+                job_content_features = tf.slice(content_features, [job_i, 0, 0, 0], [1, -1, -1, -1])
+                job_loss += content_weight * (2 * tf.nn.l2_loss(job_content_layer - job_content_features) /
+                                              content_features_size)
+            # The style images of each job are blended into one gramian target per layer, as in stylize.
+            blended_style_grams, total_blend_weight = get_blended_style_grams(
+                all_style_features[style_i:style_i + len(styles[job_i])], style_blend_weights[job_i], style_layers)
+            style_i += len(styles[job_i])
+            style_losses = []
+            for style_layer in style_layers:
+                style_gram = blended_style_grams[style_layer]
+                style_gram_size = get_np_array_num_elements(style_gram)
+                style_losses.append(tf.nn.l2_loss(grams[style_layer][job_i] - style_gram) / style_gram_size)
+            job_loss += style_weight * total_blend_weight * reduce(tf.add, style_losses)
+            job_losses.append(job_loss)
+        job_losses = tf.pack(job_losses)
+        loss = tf.reduce_sum(job_losses)
+
+        # optimizer setup
+        # The best image of each job is tracked in the graph, as in stylize.
+        best_images, update_best = get_best_images_tracker(job_losses, image)
+        with tf.control_dependencies([update_best]):
+            train_step = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+
+        # optimization
+        sess.run(tf.initialize_all_variables())
+        for i in range(iterations):
+            last_step = (i == iterations - 1)
+            is_checkpoint = (checkpoint_iterations and i % checkpoint_iterations == 0) or last_step
+            is_print_step = is_checkpoint or (print_iterations and i % print_iterations == 0)
+            stderr.write('Iteration %d/%d\n' % (i + 1, iterations))
+            # The job losses are fetched in the same session.run as the training step.
+            fetched = sess.run([train_step] + ([job_losses] if is_print_step else []))
+            if is_print_step:
+                stderr.write('    job losses: %s\n' % ', '.join('%g' % job_loss for job_loss in fetched[1]))
+            if last_step:
+                # update_best runs before each training step, so the images after the final step are compared here.
+                sess.run(update_best)
+
+            if is_checkpoint:
+                best = sess.run(best_images)
+                yield (
+                    (None if last_step else i),
+                    [vgg.unprocess(best[job_i], mean_pixel) for job_i in range(num_jobs)]
+                )
+
+
+class StylizeEngine(object):
+    """
+    A long-lived version of stylize for serving many requests. The graph, the vgg network, the losses and the optimizer
+    are built once for a given output shape. The content features, the blended style gramians (see blend_style_grams in
+    stylize) and the loss weights are held in variables that are assigned once at the start of each job, so each new
+    job, with any number of style images, only needs to reassign them and the image variable and reset the optimizer
+    slots. Nothing is fed during the iterations. Only the gramian style loss is supported
+    (no mrf, semantic masks or style weight masks).
+    """
+
+    def __init__(self, network, shape, use_content=True, learning_rate=10.0, style_features_cache_dir=None):
+        # type: (str, Tuple[int,int,int,int], bool, float, Union[None,str]) -> None
+        """
+        :param network: Path to pretrained vgg19 network.
+        :param shape: The shape of the output image. It should be with format (1, height, width, 3)
+        :param use_content: If false, the engine does texture generation only and the jobs must not have content images.
+        :param learning_rate: As name suggests.
+        :param style_features_cache_dir: If not None, the precomputed style features are cached in this directory.
+        """
+        self.shape = shape
+        self.use_content = use_content
+        self.style_features_cache_dir = style_features_cache_dir
+        self.style_layers = STYLE_LAYERS_WITH_CONTENT if use_content else STYLE_LAYERS_WITHOUT_CONTENT
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.sess = tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True)))
+            self.vgg_data, self.mean_pixel = vgg.read_net(network)
+            required_layers = ((CONTENT_LAYER,) if use_content else ()) + tuple(self.style_layers)
+            # The placeholders of the job inputs, by name.
+            self.job_inputs = {}
+            job_input_assigns = []
+
+            def add_job_input(shape, name):
+                placeholder = tf.placeholder(tf.float32, shape=shape, name=name + '_placeholder')
+                variable = tf.Variable(tf.zeros(shape), trainable=False, name=name)
+                self.job_inputs[name] = placeholder
+                job_input_assigns.append(variable.assign(placeholder))
+                return variable
+
+            content_weight = add_job_input((), 'content_weight')
+            style_weight = add_job_input((), 'style_weight')
+            tv_weight = add_job_input((), 'tv_weight')
+
+            self.initial_image = tf.placeholder(tf.float32, shape=shape, name='initial_image')
+            self.image = tf.Variable(tf.zeros(shape), name='image')
+            net = vgg.pre_read_net(self.vgg_data, self.image, required_layers=required_layers)
+
+            # content loss. The content features are computed once per job through content_net.
+            if use_content:
+                self.content_image = tf.placeholder(tf.float32, shape=shape, name='content_image')
+                self.content_net = vgg.pre_read_net(self.vgg_data, self.content_image, required_layers=(CONTENT_LAYER,))
+                content_features = add_job_input(net[CONTENT_LAYER].get_shape().as_list(), 'content_features')
+                content_features_size = _tensor_size(net[CONTENT_LAYER])
+                self.content_loss = content_weight * (2 * tf.nn.l2_loss(
+                    net[CONTENT_LAYER] - content_features) / content_features_size)
+            # style loss. Each style layer has a job input holding the blended gramian of the style images of the job.
+            # The style weight of the job is multiplied by the sum of the style blend weights.
+            style_losses = []
+            for style_layer in self.style_layers:
+                gram = neural_util.gramian(net[style_layer])
+                style_gram = add_job_input(gram.get_shape().as_list(), 'style_gram_%s' % style_layer)
+                style_losses.append(tf.nn.l2_loss(gram - style_gram) / _tensor_size(gram))
+            self.style_loss = style_weight * reduce(tf.add, style_losses)
+            # total variation denoising
+            self.tv_loss = tf.mul(neural_util.total_variation(self.image), tv_weight)
+
+            # overall loss
+            if use_content:
+                self.loss = self.content_loss + self.style_loss + self.tv_loss
+            else:
+                self.loss = self.style_loss + self.tv_loss
+
+            # optimizer setup
+            self.best_image, self.update_best = get_best_image_tracker(self.loss, self.image)
+            with tf.control_dependencies([self.update_best]):
+                self.train_step = tf.train.AdamOptimizer(learning_rate).minimize(self.loss)
+            # The losses printed every print_iterations, fetched in the same session.run as the training step.
+            self.progress_losses = [('    style loss', self.style_loss), ('       tv loss', self.tv_loss),
+                                    ('    total loss', self.loss)]
+            if use_content:
+                self.progress_losses.insert(0, ('  content loss', self.content_loss))
+            # The optimizer slots and the best image are all variables except the image (and the job inputs, which are
+            # assigned afterwards anyway). They are reset at the start of every job.
+            optimizer_variables = [var for var in tf.all_variables() if var is not self.image]
+            self.reset_optimizer = tf.initialize_variables(optimizer_variables)
+            self.assign_job_inputs = tf.group(self.image.assign(self.initial_image), *job_input_assigns)
+            self.sess.run(tf.initialize_all_variables())
+            self.graph.finalize()
+
+    def stylize(self, content, styles, iterations, content_weight=5.0, style_weight=100.0, tv_weight=100.0,
+                style_blend_weights=None, initial=None, print_iterations=None, checkpoint_iterations=None,
+                early_stopping=None, style_features=None):
+        # type: (Union[None,np.ndarray], List[np.ndarray], int, float, float, float, Union[None,List[float]], Union[None,np.ndarray], Union[None,int], Union[None,int], Union[None,EarlyStopping], Union[None,List[Dict[str,np.ndarray]]]) -> Iterable[Tuple[Union[None,int],np.ndarray]]
+        """
+        Runs one job on the engine. The parameters and the output are the same as the ones in stylize (with adam as the
+        optimizer).
+        :param style_features: The precomputed style features of 'styles', as returned by
+        neural_util.precompute_images_features. If left as None, they are computed here.
+        """
+        if (content is not None) != self.use_content:
+            raise AssertionError("The engine was built with use_content=%s and can not run a job %s a content image."
+                                 % (str(self.use_content), 'with' if content is not None else 'without'))
+        if len(styles) == 0:
+            raise AssertionError("Must feed in at least one style image.")
+        if style_blend_weights is None:
+            style_blend_weights = [1.0 / len(styles) for _ in styles]
+
+        if style_features is None:
+            style_features = neural_util.precompute_images_features(styles, self.style_layers, self.vgg_data,
+                                                                    self.mean_pixel, False, False,
+                                                                    cache_dir=self.style_features_cache_dir)
+        blended_style_grams, total_blend_weight = get_blended_style_grams(style_features, style_blend_weights,
+                                                                          self.style_layers)
+        if initial is None:
+            initial = np.random.normal(scale=0.256, size=self.shape)
+        else:
+            initial = np.array([vgg.preprocess(initial, self.mean_pixel)])
+        feed_dict = {self.initial_image: initial.astype(np.float32),
+                     self.job_inputs['content_weight']: content_weight,
+                     self.job_inputs['style_weight']: style_weight * total_blend_weight,
+                     self.job_inputs['tv_weight']: tv_weight}
+        for style_layer in self.style_layers:
+            style_gram_input = self.job_inputs['style_gram_%s' % style_layer]
+            feed_dict[style_gram_input] = blended_style_grams[style_layer].reshape(
+                style_gram_input.get_shape().as_list())
         if content is not None:
-            feed_dict[content_image] = content_pre
-        if use_semantic_masks:
-            feed_dict[content_semantic_mask] = output_semantic_mask
-            for styles_iter in range(len(styles)):
-                feed_dict[style_semantic_masks_images[styles_iter]] = style_semantic_masks[styles_iter]
-        sess.run(tf.initialize_all_variables(), feed_dict=feed_dict)
+            content_pre = np.array([vgg.preprocess(content, self.mean_pixel)])
+            feed_dict[self.job_inputs['content_features']] = self.sess.run(
+                self.content_net[CONTENT_LAYER], feed_dict={self.content_image: content_pre})
+        self.sess.run(self.reset_optimizer)
+        self.sess.run(self.assign_job_inputs, feed_dict=feed_dict)
+
+        # optimization
+        if early_stopping is not None:
+            early_stopping.reset()
         for i in range(iterations):
             last_step = (i == iterations - 1)
-            print_progress(i, feed_dict, last=last_step)
-            train_step.run(feed_dict=feed_dict)
+            progress_fetches = []
+            if last_step or (print_iterations and i % print_iterations == 0):
+                progress_fetches = [progress_loss for _, progress_loss in self.progress_losses]
+            fetched = self.sess.run([self.train_step, self.loss] + progress_fetches)
+            stderr.write('Iteration %d/%d\n' % (i + 1, iterations))
+            for (name, _), value in zip(self.progress_losses, fetched[2:]):
+                stderr.write('%s: %g\n' % (name, value))
+            if early_stopping is not None and early_stopping.update(fetched[1]):
+                stderr.write('Converged at iteration %d/%d\n' % (i + 1, iterations))
+                last_step = True
+            if last_step:
+                # update_best runs before each training step, so the image after the final step is compared here.
+                self.sess.run(self.update_best)
 
             if (checkpoint_iterations and i % checkpoint_iterations == 0) or last_step:
-                this_loss = loss.eval(feed_dict=feed_dict)
-                if this_loss < best_loss:
-                    best_loss = this_loss
-                    best = image.eval()
                 yield (
                     (None if last_step else i),
-                    vgg.unprocess(best.reshape(shape[1:]), mean_pixel)
+                    vgg.unprocess(self.sess.run(self.best_image).reshape(self.shape[1:]), self.mean_pixel)
                 )
+            if last_step:
+                break
+
+    def close(self):
+        self.sess.close()
+
+
+def stylize_tiled(network, content, styles, shape, iterations, tile_size=512, tile_overlap=64, content_weight=5.0,
+                  style_weight=100.0, tv_weight=100.0, style_blend_weights=None, learning_rate=10.0, initial=None,
+                  print_iterations=None, style_features_cache_dir=None, early_stopping=None, pyramid_levels=1):
+    # type: (str, Union[None,np.ndarray], List[np.ndarray], Tuple[int,int,int,int], int, int, int, float, float, float, Union[None,List[float]], float, Union[None,np.ndarray], Union[None,int], Union[None,str], Union[None,EarlyStopping], int) -> Iterable[Tuple[Union[None,int],np.ndarray]]
+    """
+    Stylizes an image too large to fit in memory by optimizing overlapping tiles of the same size one after another. All
+    tiles share one StylizeEngine and are compared against the same style gramians, which are computed once from the
+    whole style images. Each tile starts from the current output, so the overlap with the tiles done before is carried
+    over, and the tiles are blended with weights that fade linearly across the overlap to hide the seams. The peak
+    memory only depends on the tile size. Only the gramian style loss is supported.
+    Since the tiles never see the whole image, it is a good idea to pass in an upsampled result of a lower resolution
+    stylize run as 'initial' so that the large scale structure is consistent.
+    :param tile_size: The height and width of each tile. Tiles are clipped to the output size.
+    :param tile_overlap: The minimum number of pixels two neighboring tiles overlap.
+    :param iterations: The number of iterations to run for each tile.
+    :param early_stopping: If not None, its tolerances apply to the coarse pass and to each tile. Its time budget is
+    split between them in proportion to their number of pixels, and the time one leaves unused goes to the next ones.
+    :param pyramid_levels: If larger than 1, the whole output is first stylized by stylize at 1/2^(pyramid_levels-1) of
+    its size, starting from 'initial', and the upsampled result is used as the initial image of the tiles.
+    For the other parameters, please refer to stylize.
+    :return: a tuple where the first item is either the index of the tile that was just finished or None, indicating
+    it has finished all tiles. The second item is the whole output so far.
+    :rtype: iterator[tuple[int|None,image]]
+    """
+    if tile_overlap < 0 or tile_overlap >= tile_size:
+        raise AssertionError("tile_overlap must be between 0 and tile_size. It is now %d" % tile_overlap)
+    if len(styles) == 0:
+        raise AssertionError("Must feed in at least one style image.")
+    _, height, width, num_colors = shape
+    tile_height = min(tile_size, height)
+    tile_width = min(tile_size, width)
+    tiles = [(y, x) for y in get_tile_starts(height, tile_height, tile_overlap)
+             for x in get_tile_starts(width, tile_width, tile_overlap)]
+    if pyramid_levels > 1:
+        coarse_height = max(1, height // 2 ** (pyramid_levels - 1))
+        coarse_width = max(1, width // 2 ** (pyramid_levels - 1))
+        stderr.write('Coarse pass with size %dx%d\n' % (coarse_height, coarse_width))
+        coarse_early_stopping = None
+        if early_stopping is not None:
+            coarse_num_pixels = coarse_height * coarse_width
+            coarse_early_stopping = early_stopping.split(
+                float(coarse_num_pixels) / (coarse_num_pixels + len(tiles) * tile_height * tile_width))
+        coarse_content = np_resize_image(content, coarse_height, coarse_width) if content is not None else None
+        coarse_initial = np_resize_image(initial, coarse_height, coarse_width) if initial is not None else None
+        for _, initial in stylize(network, coarse_content, styles, (1, coarse_height, coarse_width, num_colors),
+                                  iterations, content_weight=content_weight, style_weight=style_weight,
+                                  tv_weight=tv_weight, style_blend_weights=style_blend_weights,
+                                  learning_rate=learning_rate, initial=coarse_initial,
+                                  print_iterations=print_iterations, style_features_cache_dir=style_features_cache_dir,
+                                  early_stopping=coarse_early_stopping):
+            pass
+        initial = np_resize_image(initial, height, width)
+    engine = StylizeEngine(network, (1, tile_height, tile_width, num_colors), use_content=content is not None,
+                           learning_rate=learning_rate, style_features_cache_dir=style_features_cache_dir)
+    try:
+        style_features = neural_util.precompute_images_features(styles, engine.style_layers, engine.vgg_data,
+                                                                engine.mean_pixel, False, False,
+                                                                cache_dir=style_features_cache_dir)
+        if initial is None:
+            # The same noise as in stylize, but in image space.
+            initial = np.random.normal(scale=0.256, size=(height, width, num_colors)) + engine.mean_pixel
+        weighted_sum = np.zeros((height, width, num_colors))
+        weight_sum = np.zeros((height, width, 1))
+        for tile_i, (y, x) in enumerate(tiles):
+            stderr.write('Tile %d/%d at (%d, %d)\n' % (tile_i + 1, len(tiles), y, x))
+            tile_slice = (slice(y, y + tile_height), slice(x, x + tile_width))
+            # The part of the tile covered by earlier tiles starts from their blended result.
+            done = weight_sum[tile_slice] > 0
+            tile_initial = np.where(done, weighted_sum[tile_slice] / np.maximum(weight_sum[tile_slice], 1e-8),
+                                    initial[tile_slice])
+            tile_content = content[tile_slice] if content is not None else None
+            tile_early_stopping = None
+            if early_stopping is not None:
+                tile_early_stopping = early_stopping.split(1.0 / (len(tiles) - tile_i))
+            for _, tile_image in engine.stylize(tile_content, styles, iterations, content_weight=content_weight,
+                                                style_weight=style_weight, tv_weight=tv_weight,
+                                                style_blend_weights=style_blend_weights, initial=tile_initial,
+                                                print_iterations=print_iterations,
+                                                early_stopping=tile_early_stopping, style_features=style_features):
+                pass
+            tile_weights = get_feather_weights(tile_height, tile_width, y > 0, y + tile_height < height, x > 0,
+                                               x + tile_width < width, tile_overlap)
+            weighted_sum[tile_slice] += tile_image * tile_weights
+            weight_sum[tile_slice] += tile_weights
+            last_tile = tile_i == len(tiles) - 1
+            output = np.where(weight_sum > 0, weighted_sum / np.maximum(weight_sum, 1e-8), initial)
+            yield (None if last_tile else tile_i), output
+    finally:
+        engine.close()
+
+
+def get_tile_starts(size, tile_size, tile_overlap):
+    # type: (int, int, int) -> List[int]
+    """
+    :return: The start positions of tiles of tile_size along one axis of length size, so that neighboring tiles overlap
+    by at least tile_overlap and the last tile ends exactly at size.
+    """
+    if tile_size >= size:
+        return [0]
+    starts = range(0, size - tile_size, tile_size - tile_overlap)
+    starts.append(size - tile_size)
+    return starts
+
+
+def get_feather_weights(height, width, fade_top, fade_bottom, fade_left, fade_right, tile_overlap):
+    # type: (int, int, bool, bool, bool, bool, int) -> np.ndarray
+    """
+    :return: The blending weights of a tile with shape (height, width, 1). They fade linearly from almost 0 to 1 over
+    tile_overlap pixels on each side that overlaps with another tile, and are 1 everywhere else.
+    """
+    def fade(length, fade_start, fade_end):
+        weights = np.ones(length)
+        ramp = np.linspace(0, 1, min(tile_overlap, length) + 2)[1:-1]
+        if fade_start:
+            weights[:len(ramp)] = np.minimum(weights[:len(ramp)], ramp)
+        if fade_end:
+            weights[length - len(ramp):] = np.minimum(weights[length - len(ramp):], ramp[::-1])
+        return weights
+
+    return np.outer(fade(height, fade_top, fade_bottom), fade(width, fade_left, fade_right))[..., np.newaxis]
 
 
 def _tensor_size(tensor):
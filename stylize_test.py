@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+import stylize as stylize_module
+from stylize import EarlyStopping, StylizeEngine, get_blended_style_grams, get_feather_weights, get_tile_starts, \
+    stylize, stylize_batch
+from vgg import convert_net_to_npy, DEFAULT_MEAN_PIXEL
+from vgg_test import get_fake_conv_weights
+
+
+def write_fake_network(network_dir):
+    # type: (str) -> str
+    """
+    :return: The path to a converted .npy weight store with small random weights, which can be used as the network.
+    """
+    weights_path, _ = convert_net_to_npy(os.path.join(network_dir, 'vgg.mat'), get_fake_conv_weights(),
+                                         DEFAULT_MEAN_PIXEL)
+    return weights_path
+
+
+class StylizeTest(unittest.TestCase):
+    def setUp(self):
+        self.network_dir = tempfile.mkdtemp()
+        self.network = write_fake_network(self.network_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.network_dir)
+
+    def test_early_stopping_relative_tolerance(self):
+        early_stopping = EarlyStopping(window=2, relative_tolerance=0.1)
+        self.assertFalse(early_stopping.update(100.0))
+        self.assertFalse(early_stopping.update(50.0))
+        # 100 -> 30 is still a large improvement.
+        self.assertFalse(early_stopping.update(30.0))
+        # 50 -> 48 is less than 10% of 50.
+        self.assertTrue(early_stopping.update(48.0))
+        early_stopping.reset()
+        self.assertFalse(early_stopping.update(48.0))
+
+    def test_early_stopping_absolute_tolerance(self):
+        early_stopping = EarlyStopping(window=1, absolute_tolerance=1.0)
+        self.assertFalse(early_stopping.update(10.0))
+        self.assertFalse(early_stopping.update(8.0))
+        self.assertTrue(early_stopping.update(7.5))
+
+    def test_early_stopping_time_budget(self):
+        early_stopping = EarlyStopping(time_budget=0.0)
+        time.sleep(0.001)
+        self.assertTrue(early_stopping.update(10.0))
+
+    def test_early_stopping_split(self):
+        early_stopping = EarlyStopping(window=3, relative_tolerance=0.1, time_budget=100.0)
+        part = early_stopping.split(0.25)
+        self.assertEqual(part.window, 3)
+        self.assertEqual(part.relative_tolerance, 0.1)
+        self.assertLessEqual(part.time_budget, 25.0)
+        self.assertGreater(part.time_budget, 24.0)
+        self.assertIsNone(EarlyStopping(window=3).split(0.25).time_budget)
+        # Once the budget is used up, the parts stop right away.
+        self.assertTrue(EarlyStopping(time_budget=0.0).split(0.5).update(10.0))
+
+    def test_get_tile_starts(self):
+        self.assertEqual(get_tile_starts(400, 512, 64), [0])
+        self.assertEqual(get_tile_starts(600, 512, 64), [0, 88])
+        self.assertEqual(get_tile_starts(1000, 400, 100), [0, 300, 600])
+
+    def test_get_feather_weights(self):
+        weights = get_feather_weights(4, 5, False, False, True, False, 2)
+        self.assertEqual(weights.shape, (4, 5, 1))
+        np.testing.assert_allclose(weights[0, :, 0], [1.0 / 3, 2.0 / 3, 1, 1, 1])
+        np.testing.assert_allclose(weights[:, 4, 0], np.ones(4))
+
+    def test_get_blended_style_grams(self):
+        style_features = [{'relu1_1': np.full((2, 2), 1.0), 'relu2_1': np.full((3, 3), 2.0)},
+                          {'relu1_1': np.full((2, 2), 4.0), 'relu2_1': np.full((3, 3), 8.0)}]
+        blended_style_grams, total_blend_weight = get_blended_style_grams(style_features, [1.0, 3.0],
+                                                                          ('relu1_1', 'relu2_1'))
+        self.assertEqual(total_blend_weight, 4.0)
+        np.testing.assert_allclose(blended_style_grams['relu1_1'], np.full((2, 2), (1.0 + 3.0 * 4.0) / 4.0))
+        np.testing.assert_allclose(blended_style_grams['relu2_1'], np.full((3, 3), (2.0 + 3.0 * 8.0) / 4.0))
+        with self.assertRaises(AssertionError):
+            get_blended_style_grams(style_features, [1.0, -1.0], ('relu1_1',))
+        with self.assertRaises(AssertionError):
+            get_blended_style_grams(style_features, [0.0, 0.0], ('relu1_1',))
+
+    def test_stylize_rejects_patchmatch_with_lbfgs(self):
+        content = np.zeros((1, 8, 8, 3), dtype=np.float32)
+        styles = [np.zeros((8, 8, 3), dtype=np.float32)]
+        with self.assertRaises(AssertionError):
+            next(stylize('', content, styles, content.shape, 1, use_mrf=True, optimizer='lbfgs',
+                         mrf_matcher='patchmatch'))
+
+    def test_stylize_lbfgs(self):
+        content = np.random.rand(16, 16, 3).astype(np.float32) * 255
+        styles = [np.random.rand(16, 16, 3).astype(np.float32) * 255]
+        outputs = list(stylize(self.network, content, styles, (1, 16, 16, 3), 4, checkpoint_iterations=2,
+                               optimizer='lbfgs'))
+        # Checkpoints at iteration 0 and 2, and the final image. L-BFGS may converge earlier on the tiny network.
+        self.assertIn([iteration for iteration, _ in outputs], ([0, 2, None], [0, None], [None]))
+        for _, image in outputs:
+            self.assertEqual(image.shape, (16, 16, 3))
+            self.assertTrue(np.all(np.isfinite(image)))
+
+    def test_stylize_batch(self):
+        content = np.random.rand(16, 16, 3).astype(np.float32) * 255
+        style = np.random.rand(16, 16, 3).astype(np.float32) * 255
+        initial = np.random.rand(16, 16, 3).astype(np.float32) * 255
+        # The first and the last jobs are the same. The second one weighs its style three times as much.
+        outputs = list(stylize_batch(self.network, [content, content, content], [[style], [style], [style]],
+                                     (3, 16, 16, 3), 3, style_blend_weights=[[1.0], [3.0], [1.0]],
+                                     initials=[initial, initial, initial]))
+        self.assertEqual([iteration for iteration, _ in outputs], [None])
+        images = outputs[-1][1]
+        self.assertEqual(len(images), 3)
+        for image in images:
+            self.assertEqual(image.shape, (16, 16, 3))
+        # The jobs are independent of each other.
+        np.testing.assert_allclose(images[0], images[2], rtol=1e-4, atol=1e-2)
+        self.assertFalse(np.allclose(images[0], images[1]))
+
+    def test_stylize_engine_runs_jobs_back_to_back(self):
+        content = np.random.rand(16, 16, 3).astype(np.float32) * 255
+        styles = [np.random.rand(16, 16, 3).astype(np.float32) * 255]
+        engine = StylizeEngine(self.network, (1, 16, 16, 3))
+        try:
+            variables = {var.op.name: var for var in engine.graph.get_collection(tf.GraphKeys.VARIABLES)}
+            num_ops = len(engine.graph.get_operations())
+            # The first job has a loss of 0, so its image would stay the best one if the tracker were not reset.
+            list(engine.stylize(content, styles, 3, content_weight=0.0, style_weight=0.0, tv_weight=0.0))
+            self.assertEqual(engine.sess.run(variables['best_loss']), 0.0)
+            outputs = list(engine.stylize(content, styles, 2))
+            self.assertEqual(outputs[-1][1].shape, (16, 16, 3))
+            self.assertEqual(len(engine.graph.get_operations()), num_ops)
+            self.assertGreater(engine.sess.run(variables['best_loss']), 0.0)
+            # Adam multiplies beta1_power by beta1 after every step, starting from beta1 (0.9).
+            self.assertAlmostEqual(engine.sess.run(variables['beta1_power']), 0.9 ** 3, places=5)
+        finally:
+            engine.close()
+
+    def test_stylize_engine_ignores_mrf_style_layers(self):
+        # stylize rebinds the global STYLE_LAYERS when it uses mrf.
+        style_layers = stylize_module.STYLE_LAYERS
+        stylize_module.STYLE_LAYERS = stylize_module.STYLE_LAYERS_MRF
+        try:
+            engine = StylizeEngine(self.network, (1, 16, 16, 3), use_content=False)
+            engine.close()
+        finally:
+            stylize_module.STYLE_LAYERS = style_layers
+        self.assertEqual(engine.style_layers, stylize_module.STYLE_LAYERS_WITHOUT_CONTENT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,94 +1,261 @@
 # The code skeleton mainly comes from https://github.com/anishathalye/neural-style.
 # Copyright (c) 2015-2016 Anish Athalye. Released under GPLv3.
+import hashlib
+import json
+import os
+
 import numpy as np
 import scipy.io
 import scipy.ndimage
 import tensorflow as tf
+from typing import Union, Tuple, List, Dict
+
+VGG19_LAYERS = (
+    'conv1_1', 'relu1_1', 'conv1_2', 'relu1_2', 'pool1',
+
+    'conv2_1', 'relu2_1', 'conv2_2', 'relu2_2', 'pool2',
+
+    'conv3_1', 'relu3_1', 'conv3_2', 'relu3_2', 'conv3_3',
+    'relu3_3', 'conv3_4', 'relu3_4', 'pool3',
+
+    'conv4_1', 'relu4_1', 'conv4_2', 'relu4_2', 'conv4_3',
+    'relu4_3', 'conv4_4', 'relu4_4', 'pool4',
+
+    'conv5_1', 'relu5_1', 'conv5_2', 'relu5_2', 'conv5_3',
+    'relu5_3', 'conv5_4', 'relu5_4'
+)
+
+# The number of features of the conv and relu layers in each block (e.g. conv3_1 is in block 3).
+_VGG19_BLOCK_NUM_FEATURES = {1: 64, 2: 128, 3: 256, 4: 512, 5: 512}
 
+DEFAULT_MEAN_PIXEL = np.array([123.68, 103.939, 116.779])
+# read_net stores a digest of the weights in the returned dictionary under this key. It is used to tell apart features
+# computed with different vgg files.
+DIGEST_KEY = 'digest'
+# The weight constants are created once per graph and shared by every vgg branch built in that graph (generated image,
+# content images, semantic masks...). Without this each call to pre_read_net embedded another ~80MB copy of the
+# weights into the GraphDef. They are stored as an attribute of the graph itself, so they are freed together with the
+# graph. (A module level dictionary keyed by the graph would keep every graph alive, because the constants refer back
+# to their graph.)
+_WEIGHT_CONSTANTS_GRAPH_ATTRIBUTE = '_vgg_weight_constants'
 
 
-def net(data_path, input_image):
+def net(data_path, input_image, required_layers=None):
     # The stride multiplier feature is an attempt to make the style/texture features look larger. It is not fully
     # developed yet so please keep it at 1.
-    layers = (
-        'conv1_1', 'relu1_1', 'conv1_2', 'relu1_2', 'pool1',
+    data, mean_pixel = read_net(data_path)
+    return pre_read_net(data, input_image, required_layers=required_layers), mean_pixel
 
-        'conv2_1', 'relu2_1', 'conv2_2', 'relu2_2', 'pool2',
 
-        'conv3_1', 'relu3_1', 'conv3_2', 'relu3_2', 'conv3_3',
-        'relu3_3', 'conv3_4', 'relu3_4', 'pool3',
+def get_layers_up_to(required_layers):
+    # type: (Union[None,List[str],Tuple[str]]) -> Tuple[str]
+    """
+    :param required_layers: The names of the layers that will be used. If None, all layers are required.
+    :return: The prefix of VGG19_LAYERS that ends at the deepest required layer.
+    """
+    if required_layers is None:
+        return VGG19_LAYERS
+    for layer in required_layers:
+        if layer not in VGG19_LAYERS:
+            raise AssertionError('Layer %s does not exist in the vgg network.' % layer)
+    deepest_layer_i = max(VGG19_LAYERS.index(layer) for layer in required_layers)
+    return VGG19_LAYERS[:deepest_layer_i + 1]
 
-        'conv4_1', 'relu4_1', 'conv4_2', 'relu4_2', 'conv4_3',
-        'relu4_3', 'conv4_4', 'relu4_4', 'pool4',
 
-        'conv5_1', 'relu5_1', 'conv5_2', 'relu5_2', 'conv5_3',
-        'relu5_3', 'conv5_4', 'relu5_4'
-    )
+def get_npy_store_paths(data_path):
+    # type: (str) -> Tuple[str, str]
+    """
+    :param data_path: Path to the vgg19 .mat file (or to an already converted .npy weight store).
+    :return: The path to the flat .npy file holding all weights and the path to the json index describing where each
+    layer lives inside that file.
+    """
+    base_path = os.path.splitext(data_path)[0]
+    return base_path + '.npy', base_path + '_index.json'
 
+
+def _read_mat_net(data_path):
+    # type: (str) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], np.ndarray]
+    """
+    Read the matconvnet .mat file and convert the conv layers into tensorflow layout.
+    :param data_path: Path to pretrained vgg19 network.
+    :return: A dictionary with key = conv layer name and value = (kernels, bias), as well as the mean pixel.
+    """
     data = scipy.io.loadmat(data_path)
-    mean = data['normalization'][0][0][0]
-    mean_pixel = np.mean(mean, axis=(0, 1))
+    if 'normalization' in data:
+        mean = data['normalization'][0][0][0]
+        mean_pixel = np.mean(mean, axis=(0, 1))
+    else:
+        mean_pixel = DEFAULT_MEAN_PIXEL
     weights = data['layers'][0]
-
-    net = {}
-    current = input_image
-    for i, name in enumerate(layers):
-        kind = name[:4]
-        if kind == 'conv':
+    conv_weights = {}
+    for i, name in enumerate(VGG19_LAYERS):
+        if name[:4] == 'conv':
             kernels, bias = weights[i][0][0][0][0]
             # matconvnet: weights are [width, height, in_channels, out_channels]
             # tensorflow: weights are [height, width, in_channels, out_channels]
-            kernels = np.transpose(kernels, (1, 0, 2, 3))
-            bias = bias.reshape(-1)
-            current = _conv_layer(current, kernels, bias)
-        elif kind == 'relu':
-            current = tf.nn.relu(current)
-        elif kind == 'pool':
-            current = _pool_layer(current)
-        net[name] = current
+            kernels = np.ascontiguousarray(np.transpose(kernels, (1, 0, 2, 3)), dtype=np.float32)
+            bias = bias.reshape(-1).astype(np.float32)
+            conv_weights[name] = (kernels, bias)
+    return conv_weights, mean_pixel
 
-    assert len(net) == len(layers)
-    return net, mean_pixel
 
-# Given the path to vgg net, read the data and compute the mean pixel.
-def read_net(data_path):
-    data = scipy.io.loadmat(data_path)
-    if 'normalization' in data:
-        mean = data['normalization'][0][0][0]
-        mean_pixel = np.mean(mean, axis=(0, 1))
-    else:
-        mean_pixel = np.array([123.68, 103.939, 116.779])
-    return data, mean_pixel
+def _compute_weights_digest(conv_weights):
+    # type: (Dict[str, Tuple[np.ndarray, np.ndarray]]) -> str
+    """
+    :return: The sha1 hex digest of all kernels and biases, in the same byte order as the flat .npy weight store.
+    """
+    sha1 = hashlib.sha1()
+    for name in VGG19_LAYERS:
+        if name in conv_weights:
+            for weights in conv_weights[name]:
+                sha1.update(np.ascontiguousarray(weights, dtype=np.float32).tobytes())
+    return sha1.hexdigest()
 
-# Given the data from scipy.io.loadmat(data_path), generate the net directly
-def pre_read_net(data, input_image):
-    layers = (
-        'conv1_1', 'relu1_1', 'conv1_2', 'relu1_2', 'pool1',
 
-        'conv2_1', 'relu2_1', 'conv2_2', 'relu2_2', 'pool2',
+def get_weights_digest(data):
+    # type: (Dict[str, Tuple[np.ndarray, np.ndarray]]) -> str
+    """
+    :param data: The vgg weights returned by read_net.
+    :return: A digest identifying the vgg weights.
+    """
+    if DIGEST_KEY not in data:
+        data[DIGEST_KEY] = _compute_weights_digest(data)
+    return data[DIGEST_KEY]
 
-        'conv3_1', 'relu3_1', 'conv3_2', 'relu3_2', 'conv3_3',
-        'relu3_3', 'conv3_4', 'relu3_4', 'pool3',
 
-        'conv4_1', 'relu4_1', 'conv4_2', 'relu4_2', 'conv4_3',
-        'relu4_3', 'conv4_4', 'relu4_4', 'pool4',
+def convert_net_to_npy(data_path, conv_weights=None, mean_pixel=None):
+    # type: (str, Union[None,Dict[str, Tuple[np.ndarray, np.ndarray]]], Union[None,np.ndarray]) -> Tuple[str, str]
+    """
+    One-time conversion of the vgg19 .mat file into a single flat float32 .npy file plus a small json index. The
+    kernels are stored already transposed into tensorflow layout, so reading them back is just a memory map and no
+    copy or transpose is needed. Several processes reading the same store share one page-cache copy of the weights.
+    :param data_path: Path to pretrained vgg19 network (.mat).
+    :param conv_weights: Optional already converted weights from _read_mat_net, to avoid reading the .mat file again.
+    :param mean_pixel: The mean pixel that goes with conv_weights.
+    :return: The paths to the .npy weight file and the json index.
+    """
+    if conv_weights is None:
+        conv_weights, mean_pixel = _read_mat_net(data_path)
+    weights_path, index_path = get_npy_store_paths(data_path)
+    index = {'mean_pixel': [float(p) for p in mean_pixel], 'layers': {},
+             'digest': _compute_weights_digest(conv_weights)}
+    if os.path.isfile(data_path):
+        # Used by read_net to detect a store converted from an older version of the .mat file.
+        index['source_size'], index['source_mtime'] = _get_source_stat(data_path)
+    flat_arrays = []
+    offset = 0
+    for name in VGG19_LAYERS:
+        if name in conv_weights:
+            kernels, bias = conv_weights[name]
+            index['layers'][name] = {'kernels_offset': offset, 'kernels_shape': list(kernels.shape),
+                                     'bias_offset': offset + kernels.size, 'bias_shape': list(bias.shape)}
+            offset += kernels.size + bias.size
+            flat_arrays.append(kernels.ravel())
+            flat_arrays.append(bias.ravel())
+    # Both files are written to a temporary file first and then renamed, so other processes never see a partially
+    # written file. The index is written last so that a weight file without its index is never picked up by read_net.
+    tmp_weights_path = '%s.%d.tmp' % (weights_path, os.getpid())
+    with open(tmp_weights_path, 'wb') as weights_f:
+        np.save(weights_f, np.concatenate(flat_arrays).astype(np.float32))
+    os.rename(tmp_weights_path, weights_path)
+    tmp_index_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(tmp_index_path, 'w') as index_f:
+        json.dump(index, index_f)
+    os.rename(tmp_index_path, index_path)
+    return weights_path, index_path
 
-        'conv5_1', 'relu5_1', 'conv5_2', 'relu5_2', 'conv5_3',
-        'relu5_3', 'conv5_4', 'relu5_4'
-    )
 
-    weights = data['layers'][0]
+def _get_source_stat(data_path):
+    # type: (str) -> Tuple[int, float]
+    """
+    :return: The size and the modification time of the file at data_path.
+    """
+    stat = os.stat(data_path)
+    return stat.st_size, stat.st_mtime
+
+
+def is_npy_store_up_to_date(data_path):
+    # type: (str) -> bool
+    """
+    :param data_path: Path to the vgg19 .mat file (or to an already converted .npy weight store).
+    :return: True if the converted .npy weight store of data_path exists and was converted from the current version of
+    data_path, i.e. its size and modification time are the ones recorded in the index.
+    """
+    weights_path, index_path = get_npy_store_paths(data_path)
+    if not (os.path.isfile(weights_path) and os.path.isfile(index_path)):
+        return False
+    if not os.path.isfile(data_path) or os.path.abspath(data_path) == os.path.abspath(weights_path):
+        # Only the converted store is available. There is nothing to compare it with.
+        return True
+    with open(index_path, 'r') as index_f:
+        index = json.load(index_f)
+    source_size, source_mtime = _get_source_stat(data_path)
+    return index.get('source_size') == source_size and index.get('source_mtime') == source_mtime
+
+
+def read_npy_net(weights_path, index_path):
+    # type: (str, str) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], np.ndarray]
+    """
+    Memory map a weight store created by convert_net_to_npy.
+    :return: A dictionary with key = conv layer name and value = (kernels, bias), as well as the mean pixel. The
+    kernels and biases are read-only views into the memory mapped file.
+    """
+    with open(index_path, 'r') as index_f:
+        index = json.load(index_f)
+    flat_weights = np.load(weights_path, mmap_mode='r')
+    conv_weights = {}
+    for name, layer_index in index['layers'].items():
+        kernels_size = int(np.prod(layer_index['kernels_shape']))
+        bias_size = int(np.prod(layer_index['bias_shape']))
+        kernels = flat_weights[layer_index['kernels_offset']:layer_index['kernels_offset'] + kernels_size]
+        bias = flat_weights[layer_index['bias_offset']:layer_index['bias_offset'] + bias_size]
+        conv_weights[str(name)] = (kernels.reshape(layer_index['kernels_shape']),
+                                   bias.reshape(layer_index['bias_shape']))
+    if 'digest' in index:
+        conv_weights[DIGEST_KEY] = str(index['digest'])
+    return conv_weights, np.array(index['mean_pixel'])
+
 
+# Given the path to vgg net, read the data and compute the mean pixel.
+def read_net(data_path):
+    # type: (str) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], np.ndarray]
+    """
+    Read the vgg network. If a converted .npy weight store exists next to data_path, it is memory mapped, which takes
+    well under a second. Otherwise (or if the .mat file changed since it was converted) the .mat file is loaded and the
+    store is written next to it so that the next start is fast.
+    :param data_path: Path to pretrained vgg19 network (.mat) or to its converted .npy weight store.
+    :return: A dictionary with key = conv layer name and value = (kernels, bias), as well as the mean pixel. Use
+    get_weights_digest on the dictionary to identify the weights.
+    """
+    weights_path, index_path = get_npy_store_paths(data_path)
+    if is_npy_store_up_to_date(data_path):
+        return read_npy_net(weights_path, index_path)
+    conv_weights, mean_pixel = _read_mat_net(data_path)
+    try:
+        convert_net_to_npy(data_path, conv_weights, mean_pixel)
+        print('Saved converted vgg weights to %s.' % weights_path)
+    except (IOError, OSError):
+        print('Unable to save converted vgg weights to %s. Loading from the .mat file every time.' % weights_path)
+    return conv_weights, mean_pixel
+
+# Given the data from read_net(data_path), generate the net directly
+def pre_read_net(data, input_image, required_layers=None):
+    # type: (Dict[str, Tuple[np.ndarray, np.ndarray]], tf.Tensor, Union[None,List[str],Tuple[str]]) -> Dict[str, tf.Tensor]
+    """
+    :param data: The vgg weights returned by read_net.
+    :param input_image: The preprocessed input image tensor.
+    :param required_layers: The names of the layers that will be used. The graph construction stops at the deepest
+    one, so the deeper layers cost nothing in the forward and backward passes and their weights are never read. If
+    None, all layers are built.
+    :return: A dictionary with key = layer name and value = the output tensor of that layer.
+    """
+    layers = get_layers_up_to(required_layers)
     net = {}
     current = input_image
-    for i, name in enumerate(layers):
+    for name in layers:
         kind = name[:4]
         if kind == 'conv':
-            kernels, bias = weights[i][0][0][0][0]
-            # matconvnet: weights are [width, height, in_channels, out_channels]
-            # tensorflow: weights are [height, width, in_channels, out_channels]
-            kernels = np.transpose(kernels, (1, 0, 2, 3))
-            bias = bias.reshape(-1)
+            kernels, bias = get_weight_constants(data, name)
             current = _conv_layer(current, kernels, bias)
         elif kind == 'relu':
             current = tf.nn.relu(current)
@@ -100,8 +267,33 @@ def pre_read_net(data, input_image):
     return net
 
 
+def get_weight_constants(data, name):
+    # type: (Dict[str, Tuple[np.ndarray, np.ndarray]], str) -> Tuple[tf.Tensor, tf.Tensor]
+    """
+    :param data: The vgg weights returned by read_net.
+    :param name: The name of a conv layer.
+    :return: The kernels and bias of that layer as constants in the default graph. They are created on the first call
+    and the same tensors are returned for every later call in the same graph.
+    """
+    graph = tf.get_default_graph()
+    weight_constants = getattr(graph, _WEIGHT_CONSTANTS_GRAPH_ATTRIBUTE, None)
+    if weight_constants is None:
+        weight_constants = {}
+        setattr(graph, _WEIGHT_CONSTANTS_GRAPH_ATTRIBUTE, weight_constants)
+    key = (id(data), name)
+    if key not in weight_constants:
+        kernels, bias = data[name]
+        # Create the constants outside of whatever name scope or control dependencies the caller is in, so that they
+        # can be shared safely.
+        with graph.control_dependencies(None), graph.name_scope('vgg_weights/'):
+            # data is stored as well to keep its id from being reused by another object.
+            weight_constants[key] = (data, tf.constant(kernels, name=name + '_kernels'),
+                                     tf.constant(bias, name=name + '_bias'))
+    return weight_constants[key][1:]
+
+
 def _conv_layer(input, weights, bias):
-    conv = tf.nn.conv2d(input, tf.constant(weights), strides=(1, 1, 1, 1), padding='SAME')
+    conv = tf.nn.conv2d(input, weights, strides=(1, 1, 1, 1), padding='SAME')
     return tf.nn.bias_add(conv, bias)
 
 
@@ -120,3 +312,33 @@ def get_net_layer_sizes(net):
     for key, val in net.iteritems():
         net_layer_sizes[key] = map(lambda i: i.value, val.get_shape())
     return net_layer_sizes
+
+
+def get_layer_sizes(shape, required_layers=None):
+    # type: (Union[List[int],Tuple[int,int,int,int]], Union[None,List[str],Tuple[str]]) -> Dict[str,List[int]]
+    """
+    Computes the same layer sizes as get_net_layer_sizes, but from the input shape alone without building the network.
+    :param shape: The shape of the input image with format (batch_size, height, width, 3).
+    :param required_layers: Same as in net().
+    :return: A dictionary from layer name to its shape [batch_size, height, width, num_features].
+    """
+    batch_size, height, width, num_features = shape
+    layer_sizes = {}
+    for name in get_layers_up_to(required_layers):
+        if name[:4] == 'pool':
+            # Max pooling with stride 2 and 'SAME' padding rounds up.
+            height = (height + 1) // 2
+            width = (width + 1) // 2
+        else:
+            num_features = _VGG19_BLOCK_NUM_FEATURES[int(name[4])]
+        layer_sizes[name] = [batch_size, height, width, num_features]
+    return layer_sizes
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Convert the vgg19 .mat file into a memory mappable .npy weight store.')
+    parser.add_argument('--network', dest='network', help='path to pre-trained vgg 19 network (default %(default)s).',
+                        metavar='VGG_PATH', default='imagenet-vgg-verydeep-19.mat')
+    options = parser.parse_args()
+    print('Saved converted vgg weights to %s and %s.' % convert_net_to_npy(options.network))
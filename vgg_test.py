@@ -0,0 +1,123 @@
+import gc
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from vgg import *
+
+
+def get_fake_conv_weights(num_features=2):
+    # Small random weights with the same layer names as vgg19 so that the network can be built quickly.
+    conv_weights = {}
+    in_channels = 3
+    for name in VGG19_LAYERS:
+        if name[:4] == 'conv':
+            conv_weights[name] = (np.random.rand(3, 3, in_channels, num_features).astype(np.float32),
+                                  np.random.rand(num_features).astype(np.float32))
+            in_channels = num_features
+    return conv_weights
+
+
+class VggTest(tf.test.TestCase):
+    def test_get_layers_up_to(self):
+        self.assertEqual(get_layers_up_to(None), VGG19_LAYERS)
+        self.assertEqual(get_layers_up_to(['relu1_1']), ('conv1_1', 'relu1_1'))
+        self.assertEqual(get_layers_up_to(('relu2_1', 'relu1_1')),
+                         ('conv1_1', 'relu1_1', 'conv1_2', 'relu1_2', 'pool1', 'conv2_1', 'relu2_1'))
+
+    def test_get_layers_up_to_unknown_layer(self):
+        with self.assertRaises(AssertionError):
+            get_layers_up_to(['relu6_1'])
+
+    def test_pre_read_net_truncated(self):
+        with self.test_session():
+            conv_weights = get_fake_conv_weights()
+            image = tf.placeholder(tf.float32, shape=(1, 8, 8, 3))
+            full_net = pre_read_net(conv_weights, image)
+            truncated_net = pre_read_net(conv_weights, image, required_layers=('relu2_1',))
+            self.assertEqual(len(full_net), len(VGG19_LAYERS))
+            self.assertEqual(len(truncated_net), 7)
+            self.assertNotIn('conv2_2', truncated_net)
+
+            feed_dict = {image: np.random.rand(1, 8, 8, 3)}
+            np.testing.assert_array_almost_equal(truncated_net['relu2_1'].eval(feed_dict),
+                                                 full_net['relu2_1'].eval(feed_dict))
+
+    def test_get_layer_sizes(self):
+        with self.test_session():
+            image = tf.placeholder(tf.float32, shape=(2, 9, 7, 3))
+            net_layer_sizes = get_net_layer_sizes(pre_read_net(get_fake_conv_weights(), image,
+                                                               required_layers=('relu4_2',)))
+            layer_sizes = get_layer_sizes((2, 9, 7, 3), required_layers=('relu4_2',))
+            self.assertItemsEqual(layer_sizes.keys(), net_layer_sizes.keys())
+            for name in layer_sizes:
+                # The fake weights have fewer features than vgg19, so only the batch, height and width are compared.
+                self.assertEqual(layer_sizes[name][:3], net_layer_sizes[name][:3])
+            self.assertEqual(layer_sizes['relu3_1'], [2, 3, 2, 256])
+            self.assertEqual(layer_sizes['pool1'], [2, 5, 4, 64])
+
+    def test_pre_read_net_shares_weights(self):
+        with self.test_session():
+            conv_weights = get_fake_conv_weights()
+            image_1 = tf.placeholder(tf.float32, shape=(1, 8, 8, 3))
+            image_2 = tf.placeholder(tf.float32, shape=(2, 4, 4, 3))
+            net_1 = pre_read_net(conv_weights, image_1, required_layers=('relu2_1',))
+            num_const_ops = len([op for op in tf.get_default_graph().get_operations() if op.type == 'Const'])
+            net_2 = pre_read_net(conv_weights, image_2, required_layers=('relu2_1',))
+            # The second net should not create any new weight constants.
+            self.assertEqual(num_const_ops,
+                             len([op for op in tf.get_default_graph().get_operations() if op.type == 'Const']))
+            # conv layer = bias_add(conv2d(input, kernels), bias)
+            self.assertEqual(net_1['conv2_1'].op.inputs[0].op.inputs[1].name,
+                             net_2['conv2_1'].op.inputs[0].op.inputs[1].name)
+
+    def test_pre_read_net_graph_is_freed(self):
+        conv_weights = get_fake_conv_weights()
+        graph = tf.Graph()
+        with graph.as_default():
+            pre_read_net(conv_weights, tf.placeholder(tf.float32, shape=(1, 8, 8, 3)), required_layers=('relu2_1',))
+        graph_ref = weakref.ref(graph)
+        del graph
+        gc.collect()
+        # The cached weight constants must not keep the graph alive.
+        self.assertIsNone(graph_ref())
+
+    def test_convert_net_to_npy_round_trip(self):
+        conv_weights = get_fake_conv_weights()
+        mean_pixel = np.array([1.5, 2.5, 3.5])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            weights_path, index_path = convert_net_to_npy(os.path.join(tmp_dir, 'vgg.mat'), conv_weights, mean_pixel)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), sorted([os.path.basename(weights_path),
+                                                                  os.path.basename(index_path)]))
+            npy_weights, npy_mean_pixel = read_npy_net(weights_path, index_path)
+            np.testing.assert_array_equal(npy_mean_pixel, mean_pixel)
+            self.assertEqual(get_weights_digest(npy_weights), get_weights_digest(dict(conv_weights)))
+            for name, (kernels, bias) in conv_weights.items():
+                np.testing.assert_array_equal(npy_weights[name][0], kernels)
+                np.testing.assert_array_equal(npy_weights[name][1], bias)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_is_npy_store_up_to_date(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data_path = os.path.join(tmp_dir, 'vgg.mat')
+            with open(data_path, 'w') as f:
+                f.write('old')
+            self.assertFalse(is_npy_store_up_to_date(data_path))
+            weights_path, _ = convert_net_to_npy(data_path, get_fake_conv_weights(), DEFAULT_MEAN_PIXEL)
+            self.assertTrue(is_npy_store_up_to_date(data_path))
+            self.assertTrue(is_npy_store_up_to_date(weights_path))
+            with open(data_path, 'w') as f:
+                f.write('newer')
+            self.assertFalse(is_npy_store_up_to_date(data_path))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    tf.test.main()